@@ -3,30 +3,46 @@
 from concurrent.futures import ThreadPoolExecutor
 
 import collections
-import difflib
 import grpc
+import multiprocessing
+import multiprocessing.pool
 import os
 import sys
 import time
+import typing
 
 from lookout.sdk import service_analyzer_pb2_grpc
 from lookout.sdk import service_analyzer_pb2
 from lookout.sdk import service_data_pb2_grpc
 from lookout.sdk import service_data_pb2
 
+from . import metrics
 from .extract import TreeExtractor
+from .extract import added_lines
+from .languages import include_pattern
+from .model import LanguageModels
 from .settings import *
-from .stats import Stats
+from .stats import Match
 
 
 #TODO(smola): set from single source
 version = "alpha"
 grpc_max_msg_size = 100 * 1024 * 1024 #100mb
-
-class Analyzer(service_analyzer_pb2_grpc.AnalyzerServicer):
-    def __init__(self, data_srv_addr, model_path):
-        super(Analyzer).__init__()
-        self.data_srv_addr = data_srv_addr
+# Number of changes in flight per worker.
+PENDING_FACTOR = 2
+
+class ChangeAnalyzer:
+    """
+    Finds the lines of a change matching a pattern of the model of its
+    language. Models are loaded on first use (see LanguageModels).
+    """
+
+    def __init__(self,
+            model_path: str,
+            languages: typing.List[str]=DEFAULT_LANGUAGES) -> None:
+        self.model_path = model_path
+        self.languages = languages
+        self.models = LanguageModels(model_path, languages)
         self.tree_extractor = TreeExtractor(
             min_depth=DEFAULT_MIN_SUBTREE_DEPTH,
             max_depth=DEFAULT_MAX_SUBTREE_DEPTH,
@@ -34,61 +50,135 @@ class Analyzer(service_analyzer_pb2_grpc.AnalyzerServicer):
             max_size=DEFAULT_MAX_SUBTREE_SIZE
         )
 
-        logger.info('Loading model: %s' % model_path)
-        self.stats = Stats.load(model_path)
-        logger.info('Loaded model: %s' % model_path)
+    def analyze(self, change) -> typing.List[typing.Tuple[str,int,str]]:
+        """
+        Return (path, line, text) tuples, one per line with a match, with
+        the best-scored pattern matching a subtree starting at that line.
+        Lines are in the order their first subtree is extracted.
+        """
+        logger.debug("analyzing '{}' in {}".format(change.head.path, change.head.language))
+        if change.head.uast is None:
+            return []
+        model = self.models.get(change.head.language)
+        if model is None:
+            return []
+
+        lines = added_lines(change.base.content, change.head.content)
+
+        snippets = list(self.tree_extractor.get_snippets(
+            file=change.head,
+            lines=lines))
+        with metrics.MATCH_SECONDS.time():
+            found = model.match_many([uast for _, uast, _ in snippets])
+        best: typing.Dict[int,Match] = collections.OrderedDict()
+        for (line, _, _), matches in zip(snippets, found):
+            if matches and (line not in best or matches[0].score > best[line].score):
+                best[line] = matches[0]
+
+        results = []
+        for line, match in best.items():
+            metrics.MATCHES.inc()
+            results.append((
+                change.head.path,
+                line,
+                "Something looks wrong here:\n```\n%s\n```" % match.pattern))
+        return results
+
+# Set in the parent before forking, so that forked workers share the model.
+_change_analyzer: typing.Optional[ChangeAnalyzer] = None
+
+def _init_worker(model_path: str, languages: typing.List[str]) -> None:
+    global _change_analyzer
+    if (_change_analyzer is None
+            or _change_analyzer.model_path != model_path
+            or _change_analyzer.languages != languages):
+        _change_analyzer = ChangeAnalyzer(model_path, languages)
+
+def _analyze_change(change) -> typing.Tuple[typing.List[typing.Tuple[str,int,str]],dict]:
+    results = _change_analyzer.analyze(change)
+    return results, metrics.REGISTRY.drain()
 
-    def NotifyReviewEvent(self, request, context):
-        logger.info("got review request {}".format(request))
 
-        # client connection to DataServe
-        channel = grpc.insecure_channel(self.data_srv_addr, options=[
+class Analyzer(service_analyzer_pb2_grpc.AnalyzerServicer):
+    def __init__(self, data_srv_addr, model_path, workers=DEFAULT_ANALYZER_WORKERS,
+            languages=DEFAULT_LANGUAGES):
+        super(Analyzer).__init__()
+        global _change_analyzer
+        self.data_srv_addr = data_srv_addr
+        self.workers = workers
+        self.change_analyzer = ChangeAnalyzer(model_path, languages)
+
+        # Workers are forked before any gRPC channel is opened, since gRPC
+        # does not support forking with open channels. Each worker loads
+        # the models it needs on first use.
+        self.pool = None
+        if workers > 1:
+            _change_analyzer = self.change_analyzer
+            self.pool = multiprocessing.Pool(
+                processes=workers,
+                initializer=_init_worker,
+                initargs=(model_path, languages))
+
+        # client connection to DataServer, shared by all requests
+        self.channel = grpc.insecure_channel(self.data_srv_addr, options=[
                 ("grpc.max_send_message_length", grpc_max_msg_size),
                 ("grpc.max_receive_message_length", grpc_max_msg_size),
             ])
-        stub = service_data_pb2_grpc.DataStub(channel)
-        changes = stub.GetChanges(
+        self.data_stub = service_data_pb2_grpc.DataStub(self.channel)
+
+    def NotifyReviewEvent(self, request, context):
+        with metrics.REVIEWS_SECONDS.time():
+            return self._review(request)
+
+    def _review(self, request):
+        logger.info("got review request {}".format(request))
+
+        # only files of languages with a model are requested, models
+        # trained after startup are picked up by the next review
+        languages = self.change_analyzer.models.available()
+        if not languages:
+            logger.warning("no models found: {}".format(self.change_analyzer.model_path))
+            return service_analyzer_pb2.EventResponse(analyzer_version=version, comments=[])
+
+        changes = self.data_stub.GetChanges(
             service_data_pb2.ChangesRequest(
                 head=request.commit_revision.head,
                 base=request.commit_revision.base,
-                include_pattern='.*\\.go$', #FIXME: allow more languages
+                include_pattern=include_pattern(languages),
                 want_contents=True,
                 want_uast=True,
                 want_language=True,
                 exclude_vendored=True))
 
+        # Changes are analyzed while the stream is consumed, with a bounded
+        # number of changes in flight. Comments are collected in stream
+        # order.
         comments = []
+        pending: typing.Deque[multiprocessing.pool.AsyncResult] = collections.deque()
         for change in changes:
-            logger.debug("analyzing '{}' in {}".format(change.head.path, change.head.language))
-            if change.head.uast is None:
+            if self.pool is None:
+                self._add_comments(comments, self.change_analyzer.analyze(change))
                 continue
-            
-            #TODO(smola): better handling of change.added_lines
-            seqm = difflib.SequenceMatcher(
-                None,
-                change.base.content.splitlines(),
-                change.head.content.splitlines(),
-                )
-            opcodes = seqm.get_opcodes()
-            lines = set()
-            for opcode in opcodes:
-                if opcode[0] in ('insert', 'replace'):
-                    lines |= set(range(opcode[3]+1, opcode[4]+1))
-
-            for line, uast, snippet in self.tree_extractor.get_snippets(
-                    file=change.head,
-                    lines=lines):
-                #TODO(smola): speed up matching
-                matched = self.stats.match(uast)
-                if matched:
-                    comment = service_analyzer_pb2.Comment(
-                        file=change.head.path,
-                        line=line,
-                        text="Something looks wrong here:\n```\n%s\n```" % matched[0])
-                    comments.append(comment)
+            pending.append(self.pool.apply_async(_analyze_change, (change,)))
+            if len(pending) > self.workers * PENDING_FACTOR:
+                self._add_worker_comments(comments, pending.popleft())
+        while pending:
+            self._add_worker_comments(comments, pending.popleft())
         logging.info("{} comments produced".format(len(comments)))
         return service_analyzer_pb2.EventResponse(analyzer_version=version, comments=comments)
 
+    def _add_worker_comments(self, comments, pending) -> None:
+        results, worker_metrics = pending.get()
+        metrics.REGISTRY.merge(worker_metrics)
+        self._add_comments(comments, results)
+
+    def _add_comments(self, comments, results) -> None:
+        for path, line, text in results:
+            comments.append(service_analyzer_pb2.Comment(
+                file=path,
+                line=line,
+                text=text))
+
     def NotifyPushEvent(self, request, context):
         pass
 
@@ -98,9 +188,13 @@ def serve(args):
     data_srv_addr = args.data_service
     model_path = args.model
 
+    analyzer = Analyzer(data_srv_addr, model_path, workers=args.workers,
+        languages=args.languages)
+    if args.metrics_port:
+        logger.info("serving metrics at {}:{}".format(args.metrics_host, args.metrics_port))
+        metrics.start_http_server(args.metrics_host, args.metrics_port)
     logger.info("starting gRPC Analyzer server at port {}".format(port_to_listen))
     server = grpc.server(thread_pool=ThreadPoolExecutor(max_workers=10))
-    analyzer = Analyzer(data_srv_addr, model_path)
     service_analyzer_pb2_grpc.add_AnalyzerServicer_to_server(analyzer, server)
     server.add_insecure_port("{}:{}".format(host_to_bind, port_to_listen))
     server.start()
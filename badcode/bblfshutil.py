@@ -37,9 +37,12 @@ def uast_eq_node(a: UAST, b: UAST) -> bool:
     return a.key == b.key
 
 def uast_eq_node_wildcards(a: UAST, b: UAST) -> bool:
-    if a.key[0] != b.key[0] and a.key[0] != WILDCARD and b.key[0] != WILDCARD:
+    return key_eq_wildcards(a.key, b.key)
+
+def key_eq_wildcards(a: Tuple[str,str], b: Tuple[str,str]) -> bool:
+    if a[0] != b[0] and a[0] != WILDCARD and b[0] != WILDCARD:
         return False
-    if a.key[1] != b.key[1] and a.key[1] != WILDCARD and b.key[1] != WILDCARD:
+    if a[1] != b[1] and a[1] != WILDCARD and b[1] != WILDCARD:
         return False
     return True
 
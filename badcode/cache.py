@@ -0,0 +1,160 @@
+import hashlib
+import logging
+import os
+import pathlib
+import tempfile
+import threading
+import time
+import typing
+from typing import Optional, Union
+
+import bblfsh
+
+from .compact import FileUAST
+
+logger = logging.getLogger(__name__)
+
+# Temporary files older than this, in seconds, are left by crashed writes.
+STALE_TMP_SECONDS = 3600
+
+# Version of the format of cached UASTs, part of their keys.
+FORMAT = 'file-uast-1'
+
+
+class DiskCache:
+    """
+    Persistent cache of bytes in a directory, with byte-based eviction of
+    the least recently used entries.
+
+    It can be shared by several processes: entries are written atomically,
+    reads update the modification time used for eviction, and eviction
+    scans the whole directory, so it accounts for entries written by every
+    process. Within a process, it can be used from several threads.
+    """
+
+    def __init__(self,
+            directory: Union[str,pathlib.Path],
+            max_bytes: int) -> None:
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._size = sum(size for _, _, size in self._entries())
+
+    def _path(self, key: str) -> pathlib.Path:
+        return self.directory / key[:2] / key
+
+    def _entries(self) -> typing.List[typing.Tuple[float,pathlib.Path,int]]:
+        entries = []
+        for subdir in os.scandir(str(self.directory)):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if entry.name.startswith('.tmp'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, pathlib.Path(entry.path), stat.st_size))
+        return entries
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            with open(str(path), 'rb') as f:
+                value = f.read()
+            os.utime(str(path))
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def put(self, key: str, value: bytes) -> None:
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=str(path.parent), prefix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(value)
+        with self._lock:
+            try:
+                old_size = path.stat().st_size
+            except FileNotFoundError:
+                old_size = 0
+            os.replace(tmp_path, str(path))
+            self._size += len(value) - old_size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _remove_stale_tmp(self) -> None:
+        deadline = time.time() - STALE_TMP_SECONDS
+        for subdir in os.scandir(str(self.directory)):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if not entry.name.startswith('.tmp'):
+                    continue
+                try:
+                    if entry.stat().st_mtime < deadline:
+                        os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
+
+    def _evict(self) -> None:
+        # Called with self._lock held.
+        self._remove_stale_tmp()
+        entries = sorted(self._entries())
+        size = sum(size for _, _, size in entries)
+        target = self.max_bytes * 0.9
+        for _, path, entry_size in entries:
+            if size <= target:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+            self.evictions += 1
+        self._size = size
+
+
+class UASTCache:
+    """
+    Persistent cache of filtered UASTs, as FileUAST, keyed by blob id and
+    parser version.
+    """
+
+    def __init__(self, cache: DiskCache, parser_version: str) -> None:
+        self.cache = cache
+        self.parser_version = parser_version
+
+    def _key(self, blob_hash: str) -> str:
+        return hashlib.sha1(
+            ('%s:%s:%s' % (FORMAT, self.parser_version, blob_hash)).encode('utf-8')).hexdigest()
+
+    def get(self, blob_hash: str) -> Optional[FileUAST]:
+        data = self.cache.get(self._key(blob_hash))
+        if data is None:
+            return None
+        return FileUAST.from_bytes(data)
+
+    def put(self, blob_hash: str, uast: FileUAST) -> None:
+        self.cache.put(self._key(blob_hash), uast.to_bytes())
+
+    def __repr__(self) -> str:
+        return 'UASTCache(hits=%d, misses=%d, evictions=%d)' % (
+            self.cache.hits, self.cache.misses, self.cache.evictions)
+
+def get_parser_version(client: bblfsh.BblfshClient) -> Optional[str]:
+    try:
+        response = client.version()
+    except Exception as exc:
+        logger.error('cannot get bblfsh version: %s' % exc)
+        return None
+    return '%s-%s' % (response.version, response.build)
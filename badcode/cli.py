@@ -5,7 +5,9 @@ import os
 from .analyzer import serve
 from .postprocess import postprocess
 from .preprocess import preprocess
+from .preprocess import start_metrics_writer
 from .inspect import inspect
+from .languages import parse_languages
 from .settings import *
 
 def main():
@@ -16,21 +18,64 @@ def main():
     analyzer_parser.add_argument('--host', type=str, default=os.environ.get('BADCODE_HOST', '0.0.0.0'))
     analyzer_parser.add_argument('--port', type=int, default=int(os.environ.get('BADCODE_PORT', 2022)))
     analyzer_parser.add_argument('--data-service', type=str, default=os.environ.get('BADCODE_DATA_SERVICE_URL', 'localhost:10301'))
-    analyzer_parser.add_argument('--model', type=str, default=os.environ.get('BADCODE_MODEL', str(DEFAULT_STATS_PATH) + '_merged_ranked_pruned'))
+    analyzer_parser.add_argument('--model', type=str, default=os.environ.get('BADCODE_MODEL', DEFAULT_MODEL_PATH),
+        help='path of the model of each language, {language} is replaced by its directory name (e.g. go)')
+    analyzer_parser.add_argument('--languages', type=parse_languages, default=os.environ.get('BADCODE_LANGUAGES', ','.join(DEFAULT_LANGUAGES)),
+        help='comma-separated languages to analyze, models are loaded on first use')
+    analyzer_parser.add_argument('--workers', type=int, default=int(os.environ.get('BADCODE_WORKERS', DEFAULT_ANALYZER_WORKERS)),
+        help='number of processes analyzing changes')
+    analyzer_parser.add_argument('--metrics-host', type=str, default=os.environ.get('BADCODE_METRICS_HOST', DEFAULT_METRICS_HOST))
+    analyzer_parser.add_argument('--metrics-port', type=int, default=int(os.environ.get('BADCODE_METRICS_PORT', DEFAULT_METRICS_PORT)),
+        help='port of the Prometheus metrics endpoint (0 to disable)')
     analyzer_parser.set_defaults(func=serve)
 
     def train(args):
-        preprocess(args)
-        postprocess(args)
+        writer = start_metrics_writer('train-main')
+        try:
+            preprocess(args)
+            postprocess(args)
+        finally:
+            writer.flush()
 
     train_parser = subparsers.add_parser('train', help='train with repositories')
     train_parser.add_argument('--stats', type=str, default=str(DEFAULT_STATS_PATH))
     train_parser.add_argument('--bblfshd', type=str, default=DEFAULT_BBLFSHD)
+    train_parser.add_argument('--languages', type=parse_languages, default=','.join(DEFAULT_LANGUAGES),
+        help='comma-separated languages to train, with one model per language')
+    train_parser.add_argument('--uast-cache', type=str, nargs='?', default=None, const=str(DEFAULT_UAST_CACHE_DIR),
+        help='directory of the persistent UAST cache (default: disabled, %s if no value given)' % DEFAULT_UAST_CACHE_DIR)
+    train_parser.add_argument('--uast-cache-size', type=int, default=DEFAULT_UAST_CACHE_SIZE,
+        help='maximum size of the persistent UAST cache in bytes')
+    train_parser.add_argument('--parse-concurrency', type=int, default=DEFAULT_PARSE_CONCURRENCY,
+        help='maximum number of bblfsh parse requests in flight per worker')
+    train_parser.add_argument('--min-score', type=float, default=DEFAULT_MIN_SCORE,
+        help='minimum score of the patterns kept in the model')
+    train_parser.add_argument('--postprocess-workers', type=int, default=1,
+        help='number of processes running independent postprocess stages, each may hold a copy of the stats')
+    train_parser.add_argument('--history-chunk-size', type=int, default=0,
+        help='split histories longer than this many commits in chunks trained by different workers (0 to disable)')
+    train_parser.add_argument('--retries', type=int, default=DEFAULT_JOB_RETRIES,
+        help='number of times a failed repository is retried, alone in a new process')
+    train_parser.add_argument('--approximate-ranking', action='store_true',
+        help='approximate score percentiles in constant memory')
+    train_parser.add_argument('--stats-store', choices=['memory', 'sqlite'], default='memory',
+        help='where postprocess keeps the stats: in memory, or in an SQLite database for models larger than memory (with --approximate-ranking)')
+    train_parser.add_argument('--approximate-counting', action='store_true',
+        help='count patterns per repository in bounded memory, keeping exact counts only for frequent ones')
+    train_parser.add_argument('--count-epsilon', type=float, default=DEFAULT_COUNT_EPSILON,
+        help='maximum overcount of approximate counting, relative to the number of occurrences')
+    train_parser.add_argument('--count-delta', type=float, default=DEFAULT_COUNT_DELTA,
+        help='probability of exceeding --count-epsilon')
+    train_parser.add_argument('--count-capacity', type=int, default=DEFAULT_COUNT_CAPACITY,
+        help='maximum number of candidate patterns tracked by approximate counting')
+    train_parser.add_argument('--count-min', type=int, default=DEFAULT_COUNT_MIN,
+        help='minimum count to keep a pattern with approximate counting')
     train_parser.add_argument('repositories', type=str)
     train_parser.set_defaults(func=train)
 
     inspect_parser = subparsers.add_parser('inspect', help='inspect model')
     inspect_parser.add_argument('--stats', type=str, default=str(DEFAULT_STATS_PATH))
+    inspect_parser.add_argument('--language', type=lambda x: parse_languages(x)[0], default=DEFAULT_LANGUAGES[0])
     inspect_parser.set_defaults(func=inspect)
  
     args = parser.parse_args()
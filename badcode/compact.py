@@ -0,0 +1,357 @@
+import array
+import json
+import struct
+import sys
+from typing import Dict, Generator, Iterable, List, Sequence, Tuple
+
+import bblfsh
+
+from .bblfshutil import UAST
+from .bblfshutil import key_eq_wildcards
+from .bblfshutil import uast_pretty_format
+from .tree import node_fingerprint
+
+Key = Tuple[str,str]
+
+
+class KeyTable:
+    """
+    Interns UAST node keys as integer ids.
+    """
+
+    def __init__(self) -> None:
+        self._ids: Dict[Key,int] = {}
+        self._keys: List[Key] = []
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def intern(self, key: Key) -> int:
+        key_id = self._ids.get(key)
+        if key_id is None:
+            key_id = len(self._keys)
+            self._ids[key] = key_id
+            self._keys.append(key)
+        return key_id
+
+    def key(self, key_id: int) -> Key:
+        return self._keys[key_id]
+
+KEYS = KeyTable()
+
+
+class CompactUAST:
+    """
+    Immutable UAST stored as flat arrays.
+
+    Nodes are laid out in the same order as Tree iteration (each node
+    followed by its children, last child first), so every subtree is a
+    contiguous slice. For each node, the array keeps the interned id of its
+    key and the size of its subtree. Subtrees are views over the arrays of
+    the root tree; use __copy__ to get a detached copy.
+
+    It implements the same API as UAST and can be used wherever a UAST is
+    expected, but both types do not compare equal to each other.
+    """
+
+    __slots__ = ('_keys', '_sizes', '_offset', '_hash', '_fingerprint')
+
+    def __init__(self,
+            keys: array.array,
+            sizes: array.array,
+            offset: int=0) -> None:
+        self._keys = keys
+        self._sizes = sizes
+        self._offset = offset
+        self._hash = None
+        self._fingerprint = None
+
+    @staticmethod
+    def from_tree(tree) -> 'CompactUAST':
+        keys = array.array('I')
+        sizes = array.array('I')
+        for n in tree:
+            keys.append(KEYS.intern(n.key))
+            sizes.append(len(n))
+        return CompactUAST(keys, sizes)
+
+    @staticmethod
+    def from_bblfsh(node: bblfsh.Node) -> 'CompactUAST':
+        keys = array.array('I')
+        parents: List[int] = []
+        stack = [(node, -1)]
+        while stack:
+            n, parent = stack.pop()
+            pos = len(keys)
+            keys.append(KEYS.intern((n.internal_type, n.token)))
+            parents.append(parent)
+            stack.extend((c, pos) for c in n.children if c.internal_type != 'Position')
+        sizes = array.array('I', [1]) * len(keys)
+        for pos in range(len(keys) - 1, 0, -1):
+            sizes[parents[pos]] += sizes[pos]
+        return CompactUAST(keys, sizes)
+
+    @staticmethod
+    def from_keys(
+            key: Key,
+            children: Iterable['CompactUAST']=tuple()) -> 'CompactUAST':
+        keys = array.array('I', [KEYS.intern(key)])
+        sizes = array.array('I', [1])
+        for c in reversed(tuple(children)):
+            keys.extend(c._slice(c._keys))
+            sizes.extend(c._slice(c._sizes))
+            sizes[0] += len(c)
+        return CompactUAST(keys, sizes)
+
+    @property
+    def key(self) -> Key:
+        return KEYS.key(self._keys[self._offset])
+
+    @property
+    def key_id(self) -> int:
+        return self._keys[self._offset]
+
+    @property
+    def children(self) -> Sequence['CompactUAST']:
+        children = []
+        pos = self._offset + 1
+        end = self._offset + self._sizes[self._offset]
+        while pos < end:
+            children.append(CompactUAST(self._keys, self._sizes, pos))
+            pos += self._sizes[pos]
+        children.reverse()
+        return tuple(children)
+
+    def key_ids(self) -> array.array:
+        """
+        Return the interned key ids of all nodes, in iteration order.
+        """
+        return self._slice(self._keys)
+
+    def with_children(self, children: Iterable['CompactUAST']) -> 'CompactUAST':
+        return CompactUAST.from_keys(self.key, children)
+
+    def replace_key(self, pos: int, key: Key) -> 'CompactUAST':
+        """
+        Return a copy with the key of the node at the given iteration
+        position replaced.
+        """
+        copy = self.__copy__()
+        copy._keys[pos] = KEYS.intern(key)
+        return copy
+
+    def match(self, other) -> bool:
+        if len(self) != len(other):
+            return False
+        if not isinstance(other, CompactUAST):
+            for a, b in zip(self._slice(self._keys), other):
+                if not key_eq_wildcards(KEYS.key(a), b.key):
+                    return False
+            return True
+        for a, b in zip(self._slice(self._keys), other._slice(other._keys)):
+            if a == b:
+                continue
+            if not key_eq_wildcards(KEYS.key(a), KEYS.key(b)):
+                return False
+        return True
+
+    def _slice(self, arr: array.array) -> array.array:
+        return arr[self._offset:self._offset + self._sizes[self._offset]]
+
+    def __eq__(self, other):
+        if not isinstance(other, CompactUAST):
+            return False
+        if len(self) != len(other):
+            return False
+        return (self._slice(self._keys) == other._slice(other._keys) and
+            self._slice(self._sizes) == other._slice(other._sizes))
+
+    @property
+    def fingerprint(self) -> int:
+        """
+        Fingerprint of the tree, the same as for the equal UAST.
+        """
+        if self._fingerprint is None:
+            start = self._offset
+            end = start + self._sizes[start]
+            fingerprints: Dict[int,int] = {}
+            # children come after their parent, so a reverse pass sees
+            # every subtree before its parent
+            for pos in range(end - 1, start - 1, -1):
+                children = []
+                child = pos + 1
+                while child < pos + self._sizes[pos]:
+                    children.append(fingerprints.pop(child))
+                    child += self._sizes[child]
+                children.reverse()
+                fingerprints[pos] = node_fingerprint(KEYS.key(self._keys[pos]), children)
+            self._fingerprint = fingerprints[start]
+        return self._fingerprint
+
+    def __hash__(self) -> int:
+        if self._hash is None:
+            self._hash = hash((
+                self._slice(self._keys).tobytes(),
+                self._slice(self._sizes).tobytes()))
+        return self._hash
+
+    def __len__(self) -> int:
+        return self._sizes[self._offset]
+
+    def __iter__(self) -> Generator['CompactUAST',None,None]:
+        for pos in range(self._offset, self._offset + len(self)):
+            yield CompactUAST(self._keys, self._sizes, pos)
+
+    def __repr__(self) -> str:
+        children = self.children
+        if len(children) == 0:
+            return '%s(key=%s)' % (self.__class__.__name__, self.key)
+        return '%s(key=%s, children=%s)' % (self.__class__.__name__, self.key, children)
+
+    def __str__(self) -> str:
+        return uast_pretty_format(self)
+
+    def __getstate__(self):
+        return {
+            'keys': [KEYS.key(k) for k in self._slice(self._keys)],
+            'sizes': self._slice(self._sizes).tobytes(),
+            'fingerprint': self.fingerprint}
+
+    def __setstate__(self, state):
+        self._keys = array.array('I', [KEYS.intern(k) for k in state['keys']])
+        self._sizes = array.array('I')
+        self._sizes.frombytes(state['sizes'])
+        self._offset = 0
+        self._hash = None
+        self._fingerprint = state.get('fingerprint')
+
+    def __copy__(self) -> 'CompactUAST':
+        return CompactUAST(
+            self._slice(self._keys),
+            self._slice(self._sizes))
+
+
+# number of nodes and length of the key table
+_FILE_HEADER = struct.Struct('<II')
+
+
+class FileUAST:
+    """
+    UAST of a whole file stored as flat arrays, in the layout of
+    CompactUAST, with the start and end line of every node as given by
+    bblfsh (0 if unknown), for extraction.
+
+    Keys are interned in a table of the file, not in KEYS, so that the
+    identifiers and literals of every file seen by a long-running process
+    are freed with the file. Unlike CompactUAST.from_bblfsh, Position nodes
+    are kept, so that nodes are laid out exactly as bblfsh children are
+    visited; they are expected to be removed with filter_node before.
+    """
+
+    __slots__ = ('table', 'keys', 'sizes', 'starts', 'ends')
+
+    def __init__(self,
+            table: List[Key],
+            keys: array.array,
+            sizes: array.array,
+            starts: array.array,
+            ends: array.array) -> None:
+        self.table = table
+        self.keys = keys
+        self.sizes = sizes
+        self.starts = starts
+        self.ends = ends
+
+    @staticmethod
+    def from_bblfsh(node: bblfsh.Node) -> 'FileUAST':
+        ids: Dict[Key,int] = {}
+        keys = array.array('I')
+        starts = array.array('I')
+        ends = array.array('I')
+        parents: List[int] = []
+        stack = [(node, -1)]
+        while stack:
+            n, parent = stack.pop()
+            pos = len(keys)
+            keys.append(ids.setdefault((n.internal_type, n.token), len(ids)))
+            starts.append(n.start_position.line)
+            ends.append(n.end_position.line)
+            parents.append(parent)
+            stack.extend((c, pos) for c in n.children)
+        sizes = array.array('I', [1]) * len(keys)
+        for pos in range(len(keys) - 1, 0, -1):
+            sizes[parents[pos]] += sizes[pos]
+        return FileUAST(list(ids), keys, sizes, starts, ends)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def key(self, pos: int) -> Key:
+        return self.table[self.keys[pos]]
+
+    def internal_type(self, pos: int) -> str:
+        return self.table[self.keys[pos]][0]
+
+    def children(self, pos: int) -> List[int]:
+        """
+        Return the positions of the children of the node at pos, in order.
+        """
+        children = []
+        child = pos + 1
+        end = pos + self.sizes[pos]
+        while child < end:
+            children.append(child)
+            child += self.sizes[child]
+        children.reverse()
+        return children
+
+    def to_uast(self, pos: int, converted: Dict[int,UAST]) -> UAST:
+        """
+        Return the subtree at pos as a UAST, as UAST.from_bblfsh does:
+        Position nodes are removed, except for children of the root.
+        converted holds the nodes converted so far by position, and is
+        updated, so that a node in several subtrees is converted once and
+        shared by all of them.
+        """
+        table = self.table
+        keys = self.keys
+        sizes = self.sizes
+        for node in range(pos + sizes[pos] - 1, pos - 1, -1):
+            if node in converted:
+                continue
+            children = [converted[c] for c in self.children(node)
+                if table[keys[c]][0] != 'Position']
+            converted[node] = UAST(table[keys[node]], children)
+        children = self.children(pos)
+        if any(table[keys[c]][0] == 'Position' for c in children):
+            return UAST(table[keys[pos]], [converted[c] for c in children])
+        return converted[pos]
+
+    def to_bytes(self) -> bytes:
+        table = json.dumps(self.table).encode('utf-8')
+        arrays = [self.keys, self.sizes, self.starts, self.ends]
+        if sys.byteorder != 'little':
+            arrays = [array.array('I', a) for a in arrays]
+            for a in arrays:
+                a.byteswap()
+        return (_FILE_HEADER.pack(len(self.keys), len(table)) + table +
+            b''.join(a.tobytes() for a in arrays))
+
+    @staticmethod
+    def from_bytes(data: bytes) -> 'FileUAST':
+        n_nodes, table_len = _FILE_HEADER.unpack_from(data, 0)
+        pos = _FILE_HEADER.size
+        table = [tuple(k) for k in json.loads(data[pos:pos + table_len].decode('utf-8'))]
+        pos += table_len
+        arrays = []
+        for _ in range(4):
+            a = array.array('I')
+            a.frombytes(data[pos:pos + 4 * n_nodes])
+            if sys.byteorder != 'little':
+                a.byteswap()
+            arrays.append(a)
+            pos += 4 * n_nodes
+        return FileUAST(table, *arrays)
+
+    def __reduce__(self):
+        return (FileUAST.from_bytes, (self.to_bytes(),))
@@ -3,16 +3,20 @@ import typing
 
 import bblfsh
 
+from .compact import FileUAST
+
 class File:
     def __init__(self,
             path: str,
             hash: str,
             content: str,
-            uast: bblfsh.Node) -> None:
+            uast: typing.Union[bblfsh.Node,FileUAST],
+            language: typing.Optional[str]=None) -> None:
         self._path = path
         self._hash = hash,
         self._content = content
         self._uast = uast
+        self._language = language
 
     @property
     def path(self) -> str:
@@ -27,9 +31,13 @@ class File:
         return self._content
     
     @property
-    def uast(self) -> bblfsh.Node:
+    def uast(self) -> typing.Union[bblfsh.Node,FileUAST]:
         return self._uast
 
+    @property
+    def language(self) -> typing.Optional[str]:
+        return self._language
+
     def __repr__(self) -> str:
         return 'File(hash=%s, path=%s)' % (self.hash, self.path)
 
@@ -1,98 +1,233 @@
 
+import bisect
 import logging
 import typing
-from typing import Generator, Iterable, List, Set, Tuple
+from typing import Dict, Generator, Iterable, Iterator, List, Optional, Set, Tuple, Union
 
 import bblfsh
 import pygit2
 
+from . import metrics
 from .core import File
 from .bblfshutil import UAST
+from .compact import FileUAST
 
 
-class Path:
-    def __init__(self,
-            path: List['Path'],
-            node: bblfsh.Node,
-            lines: Set[int]) -> None:
-        self.path = path
-        self.node = node
-        self.is_relevant = is_relevant_node(node, lines=lines)
-        self._is_relevant_tree = None
-        self._children = None
-        self._lines = lines
-        self._depth = None
-        self._size = None
-
-    @property
-    def children(self):
-        if self._children is None:
-            self._children = [Path(
-                path=self.path + [self],
-                node=c,
-                lines=self._lines) for c in self.node.children]
-        return self._children
-
-    @property
-    def depth(self):
-        if self._depth is None:
-            if len(self.children) == 0:
-                self._depth = 1
+MAX_LINE = 9223372036854775807
+
+
+class LineIntervals:
+    """
+    Set of lines stored as sorted, disjoint intervals of consecutive lines,
+    to test membership and overlap with a line range by bisection.
+    """
+
+    def __init__(self, lines: Iterable[int]) -> None:
+        self.starts: List[int] = []
+        self.ends: List[int] = []
+        for line in sorted(set(lines)):
+            if self.ends and line == self.ends[-1] + 1:
+                self.ends[-1] = line
             else:
-                self._depth = max([c.depth for c in self.children])+1
-        return self._depth
-
-    @property
-    def size(self):
-        if self._size is None:
-            if len(self.children) == 0:
-                self._size = 1
+                self.starts.append(line)
+                self.ends.append(line)
+
+    @classmethod
+    def from_ranges(cls, ranges: Iterable[Tuple[int,int]]) -> 'LineIntervals':
+        """
+        Build the set from (start, end) ranges of lines, both included.
+        """
+        intervals = cls([])
+        for start, end in sorted(ranges):
+            if start > end:
+                continue
+            if intervals.ends and start <= intervals.ends[-1] + 1:
+                if end > intervals.ends[-1]:
+                    intervals.ends[-1] = end
             else:
-                self._size = sum([c.size for c in self.children])+1
-        return self._size
+                intervals.starts.append(start)
+                intervals.ends.append(end)
+        return intervals
 
-    @property
-    def is_relevant_tree(self):
-        if self._is_relevant_tree is None:
-            self._is_relevant_tree = self.__is_relevant_tree()
-        return self._is_relevant_tree
+    def __len__(self) -> int:
+        return sum(e - s + 1 for s, e in zip(self.starts, self.ends))
 
-    def __is_relevant_tree(self):
-        if self.is_relevant:
-            return True
-        for c in self.children:
-            if c.is_relevant_tree:
-                return True
-        return False
+    def __iter__(self) -> Iterator[int]:
+        for start, end in zip(self.starts, self.ends):
+            yield from range(start, end + 1)
 
+    def __contains__(self, line: int) -> bool:
+        idx = bisect.bisect_right(self.starts, line) - 1
+        return idx >= 0 and line <= self.ends[idx]
 
-def is_relevant_tree(uast: bblfsh.Node, lines: Set[int]) -> bool:
-    if is_relevant_node(uast, lines):
-        return True
-    for child in uast.children:
-        if is_relevant_tree(child, lines):
+    def overlaps(self, start: int, end: int) -> bool:
+        """
+        Whether any line in [start, end] is in the set.
+        """
+        if start > end:
+            return False
+        idx = bisect.bisect_left(self.ends, start)
+        return idx < len(self.starts) and self.starts[idx] <= end
+
+def added_lines(
+        base: Optional[Union[bytes,str]],
+        head: Optional[Union[bytes,str]]) -> LineIntervals:
+    """
+    Return the lines of head that are inserted or replaced with respect to
+    base, computed with the diff of libgit2 (Myers) without context lines.
+    """
+    if isinstance(base, str):
+        base = base.encode()
+    if isinstance(head, str):
+        head = head.encode()
+    patch = pygit2.Patch.create_from(base, head,
+        context_lines=0, flag=pygit2.GIT_DIFF_FORCE_TEXT)
+    return LineIntervals.from_ranges(
+        (hunk.new_start, hunk.new_start + hunk.new_lines - 1)
+        for hunk in patch.hunks)
+
+def _intervals(lines: Union[Iterable[int],LineIntervals]) -> LineIntervals:
+    if isinstance(lines, LineIntervals):
+        return lines
+    return LineIntervals(lines)
+
+
+class _Nodes:
+    """
+    Flattened tree, in the layout of FileUAST (each node followed by its
+    children, last child first), with the parent, depth (height), size,
+    relevance and line span of every subtree. A node is relevant if it is
+    relevant to the lines by itself (relevant), or any node in its subtree
+    is (relevant_tree).
+
+    Spans follow the same rules as _get_start_end_lines and first_line.
+    """
+
+    def __init__(self,
+            root: Union[bblfsh.Node,FileUAST],
+            lines: LineIntervals) -> None:
+        if not isinstance(root, FileUAST):
+            root = FileUAST.from_bblfsh(root)
+        lines = _intervals(lines)
+        self.tree = root
+        self.sizes = list(root.sizes)
+        n_nodes = len(self.sizes)
+        self.parents = [-1] * n_nodes
+        self.leaves: List[int] = []
+        for idx, size in enumerate(self.sizes):
+            if size == 1:
+                self.leaves.append(idx)
+                continue
+            child = idx + 1
+            while child < idx + size:
+                self.parents[child] = idx
+                child += self.sizes[child]
+        self.starts = list(root.starts)
+        self.ends = list(root.ends)
+        self.relevant = [_is_relevant(start, end, lines)
+            for start, end in zip(self.starts, self.ends)]
+
+        # parents come before their children, so a reverse pass sees every
+        # subtree complete before its parent, and siblings in their order
+        self.depths = [1] * n_nodes
+        self.first_lines = [line or MAX_LINE for line in self.starts]
+        self.relevant_tree = list(self.relevant)
+        for idx in range(n_nodes - 1, 0, -1):
+            parent = self.parents[idx]
+            if self.relevant_tree[idx]:
+                self.relevant_tree[parent] = True
+            if self.depths[idx] >= self.depths[parent]:
+                self.depths[parent] = self.depths[idx] + 1
+            start = self.starts[parent]
+            if start == 0 or self.starts[idx] < start:
+                self.starts[parent] = self.starts[idx]
+            end = self.ends[parent]
+            if end == 0 or self.ends[idx] > end:
+                self.ends[parent] = self.ends[idx]
+            first = self.first_lines[idx]
+            if first == MAX_LINE:
+                first = 0
+            if first < self.first_lines[parent]:
+                self.first_lines[parent] = first
+        self.first_lines = [0 if line == MAX_LINE else line for line in self.first_lines]
+
+def _flatten(root: bblfsh.Node) -> List[bblfsh.Node]:
+    """
+    Return the nodes of the tree in the layout of FileUAST and _Nodes.
+    """
+    nodes = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        stack.extend(node.children)
+    return nodes
+
+
+class _LineIndex:
+    """
+    Decoded file content with the offset of every line, to get line ranges
+    in time proportional to their length.
+    """
+
+    def __init__(self, content: bytes) -> None:
+        self.text = content.decode()
+        self.offsets = [0]
+        pos = self.text.find('\n')
+        while pos >= 0:
+            self.offsets.append(pos + 1)
+            pos = self.text.find('\n', pos + 1)
+        self.n_lines = len(self.offsets)
+        self.offsets.append(len(self.text) + 1)
+
+    def lines(self, start: int, end: int) -> str:
+        """
+        Return the text of lines start to end, both included and 1-based,
+        like uast_blob_to_snippet.
+        """
+        start = max(start, 1)
+        end = min(end, self.n_lines)
+        if start > end:
+            return ''
+        return self.text[self.offsets[start - 1]:self.offsets[end] - 1]
+
+
+def is_relevant_tree(
+        uast: bblfsh.Node,
+        lines: Union[Iterable[int],LineIntervals]) -> bool:
+    lines = _intervals(lines)
+    stack = [uast]
+    while stack:
+        node = stack.pop()
+        if is_relevant_node(node, lines):
             return True
+        stack.extend(node.children)
     return False
 
-def is_relevant_node(uast: bblfsh.Node, lines: Set[int]) -> bool:
-    if uast.start_position.line in lines:
+def is_relevant_node(
+        uast: bblfsh.Node,
+        lines: Union[Iterable[int],LineIntervals]) -> bool:
+    return _is_relevant(uast.start_position.line, uast.end_position.line, _intervals(lines))
+
+def _is_relevant(start: int, end: int, lines: LineIntervals) -> bool:
+    if start in lines:
         return True
-    if uast.end_position.line in lines:
+    if end in lines:
         return True
-    if uast.start_position.line >= 1 and uast.end_position.line >= 1:
-        for line in lines:
-            if line >= uast.start_position.line and line <= uast.end_position.line:
-                return True
+    if start >= 1 and end >= 1:
+        return lines.overlaps(start, end)
     return False
 
-def extract_paths(root: bblfsh.Node, lines: Set[int]) -> Generator[Path,None,None]:
-    queue = [Path(path=[], node=root, lines=lines)]
-    while len(queue) > 0:
-        path = queue.pop()
-        if len(path.children) == 0:
-            yield path
-            continue
-        queue.extend(path.children)
+def extract_paths(
+        root: bblfsh.Node,
+        lines: Union[Iterable[int],LineIntervals]) -> Generator[bblfsh.Node,None,None]:
+    """
+    Yield the leaves of the tree, in the order used by extract_subtrees.
+    """
+    flat = _flatten(root)
+    nodes = _Nodes(root, _intervals(lines))
+    for idx in nodes.leaves:
+        yield flat[idx]
 
 def extract_subtrees(
         uast: bblfsh.Node,
@@ -100,40 +235,57 @@ def extract_subtrees(
         max_depth: int,
         min_size: int,
         max_size: int,
-        lines: Iterable[int]) -> Generator[bblfsh.Node,None,None]:
-    if not isinstance(lines, set):
-        lines = set(lines)
+        lines: Union[Iterable[int],LineIntervals]) -> Generator[bblfsh.Node,None,None]:
+    """
+    Yield the subtrees within the given depth and size bounds that are
+    relevant to the given lines.
+
+    Subtrees are found from each leaf, going up at most max_depth - 1
+    levels. A subtree is relevant if the leaf or any of the ancestors
+    visited before it within bounds is relevant.
+    """
+    flat = _flatten(uast)
+    nodes = _Nodes(uast, _intervals(lines))
+    for idx in _extract_subtrees(nodes, min_depth, max_depth, min_size, max_size):
+        yield flat[idx]
 
+def _extract_subtrees(
+        nodes: _Nodes,
+        min_depth: int,
+        max_depth: int,
+        min_size: int,
+        max_size: int) -> Generator[int,None,None]:
+    parents = nodes.parents
+    depths = nodes.depths
+    sizes = nodes.sizes
+    relevant = nodes.relevant
     already_extracted: typing.Set[int] = set([])
 
-    paths = extract_paths(uast, lines=lines)
-    for path in paths:
-        if path.size > max_size:
-            continue
-        is_relevant = path.is_relevant
-        if is_relevant and path.size >= min_size and path.depth >= min_depth:
-            yield path.node
-        if max_depth == 1:
+    for leaf in nodes.leaves:
+        if sizes[leaf] > max_size:
             continue
-        for depth in range(2, max_depth+1):
-            if len(path.path) < depth-1:
+        is_relevant = relevant[leaf]
+        if is_relevant and sizes[leaf] >= min_size and depths[leaf] >= min_depth:
+            yield leaf
+        parent = leaf
+        for _ in range(2, max_depth+1):
+            parent = parents[parent]
+            if parent < 0:
                 break
-            parent = path.path[-1*(depth - 1)]
-            if parent.depth > max_depth:
+            if depths[parent] > max_depth:
                 break
-            if parent.size > max_size:
+            if sizes[parent] > max_size:
                 break
-            if parent.size < min_size:
+            if sizes[parent] < min_size:
                 continue
-            if parent.depth < min_depth:
+            if depths[parent] < min_depth:
                 continue
-            is_relevant |= parent.is_relevant
+            is_relevant |= relevant[parent]
             if is_relevant:
-                i = id(parent.node)
-                if i in already_extracted:
+                if parent in already_extracted:
                     continue
-                already_extracted.add(i)
-                yield parent.node
+                already_extracted.add(parent)
+                yield parent
 
 def uast_blob_to_snippet(
             uast: bblfsh.Node,
@@ -156,7 +308,7 @@ def _get_start_end_lines(uast: bblfsh.Node) -> typing.Tuple[int, int]:
     return start, end
 
 def first_line(uast: bblfsh.Node) -> int:
-    max_line = 9223372036854775807
+    max_line = MAX_LINE
     line = max_line
     if uast.start_position.line != 0:
         line = uast.start_position.line
@@ -183,22 +335,34 @@ class TreeExtractor:
 
     def get_snippets(self,
             file: File,
-            lines: Set[int]) -> Generator[Tuple[int,UAST,str],None,None]:
-        subtrees = [(first_line(u), u) for u in extract_subtrees(
-            uast=file.uast,
+            lines: Union[Iterable[int],LineIntervals]) -> Generator[Tuple[int,UAST,str],None,None]:
+        """
+        Yield (first line, subtree, snippet) for every subtree relevant to
+        the lines. The file UAST is converted to a FileUAST if it is not one
+        already, and the nodes of overlapping subtrees are shared.
+        """
+        tree = file.uast
+        if not isinstance(tree, FileUAST):
+            tree = FileUAST.from_bblfsh(tree)
+        nodes = _Nodes(tree, _intervals(lines))
+        subtrees = list(_extract_subtrees(
+            nodes=nodes,
             min_depth=self.min_depth,
             max_depth=self.max_depth,
             min_size=self.min_size,
-            max_size=self.max_size,
-            lines=lines)]
+            max_size=self.max_size))
+        text = None
+        converted: Dict[int,UAST] = {}
         n = 0
-        for line, subtree in subtrees:
-            if not is_relevant_tree(subtree, lines):
-                return
-            if subtree.internal_type == 'Position':
-                return
+        for idx in subtrees:
+            if not nodes.relevant_tree[idx]:
+                break
+            if tree.internal_type(idx) == 'Position':
+                break
             n += 1
-            snippet = uast_blob_to_snippet(subtree, file.content.decode())
-            subtree = UAST.from_bblfsh(subtree)
-            yield line, subtree, snippet
+            if text is None:
+                text = _LineIndex(file.content)
+            snippet = text.lines(nodes.starts[idx], nodes.ends[idx])
+            yield nodes.first_lines[idx], tree.to_uast(idx, converted), snippet
         logging.debug('got relevant subtrees: %d', n)
+        metrics.SUBTREES.observe(n)
@@ -1,5 +1,9 @@
 
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+import collections
 import logging
+import time
 import types
 import typing
 
@@ -7,10 +11,14 @@ from cachetools import LRUCache
 import bblfsh
 import pygit2
 
+from . import metrics
 from .bblfshutil import filter_node
+from .cache import UASTCache
+from .compact import FileUAST
 from .core import Change
 from .core import File
 from .extract import TreeExtractor
+from .languages import get_language
 from .settings import *
 from .stats import Stats
 
@@ -24,6 +32,9 @@ def _git_apply_settings():
 
 _git_apply_settings()
 
+# Number of changes to prefetch per concurrent parse request.
+PREFETCH_FACTOR = 2
+
 class FileFilter:
     def match(self, path: str, size: int ) -> bool:
         return True
@@ -59,15 +70,18 @@ def is_vendor(path):
         return True
     return False
 
-def get_language(path: str) -> str:
-    if path.endswith('.go'):
-        return 'Go'
-    return 'Other'
-
-def get_repository(repo_name: str) -> pygit2.Repository:
+def get_repository(repo_name: str, update: bool=False) -> pygit2.Repository:
+    """
+    Open the local clone of a repository, cloning it if needed. If update
+    is True, an existing clone is fetched and its master is moved to the
+    fetched one.
+    """
     repo_dir = DEFAULT_REPO_DIR / repo_name
     if repo_dir.exists():
-        return pygit2.Repository(str(repo_dir))
+        repo = pygit2.Repository(str(repo_dir))
+        if update:
+            _update_repository(repo_name, repo)
+        return repo
     logger.info('cloning repository: %s' % repo_name)
     url = 'git://github.com/%s.git' % repo_name
     repo = pygit2.clone_repository(
@@ -76,11 +90,37 @@ def get_repository(repo_name: str) -> pygit2.Repository:
         bare=True)
     return repo
 
+def _update_repository(repo_name: str, repo: pygit2.Repository) -> None:
+    logger.info('fetching repository: %s' % repo_name)
+    try:
+        repo.remotes['origin'].fetch()
+    except (KeyError, pygit2.GitError) as exc:
+        logger.error('cannot fetch repository %s: %s' % (repo_name, exc))
+        return
+    try:
+        remote_ref = repo.lookup_reference('refs/remotes/origin/master')
+    except KeyError:
+        return
+    repo.references.create('refs/heads/master', remote_ref.target, force=True)
+
+class _PendingChange(typing.NamedTuple):
+    commit_id: str
+    base_path: str
+    base_hash: str
+    base: Future
+    head_path: str
+    head_hash: str
+    head: Future
+    added_lines: typing.List[int]
+    deleted_lines: typing.List[int]
+
 class GitRepository:
     def __init__(self,
             repo: typing.Union[str,pygit2.Repository],
-            client: bblfsh.BblfshClient,
-            filters: typing.Iterable[FileFilter]) -> None:
+            client: typing.Optional[bblfsh.BblfshClient],
+            filters: typing.Iterable[FileFilter],
+            uast_cache: typing.Optional[UASTCache]=None,
+            parse_concurrency: int=DEFAULT_PARSE_CONCURRENCY) -> None:
         if isinstance(repo, str):
             repo = pygit2.Repository(repo)
         self.repo = repo
@@ -88,6 +128,10 @@ class GitRepository:
         self.filters = filters
         #TODO(smola): parameterize cache size
         self.cache = LRUCache(maxsize=2000)
+        self.uast_cache = uast_cache
+        self.parse_concurrency = parse_concurrency
+        self.parse_wait_time = 0.0
+        self._inflight: typing.Dict[str,Future] = {}
 
     def reference(self, ref: str) -> pygit2.Commit:
         refobj = self.repo.lookup_reference(ref)
@@ -98,30 +142,88 @@ class GitRepository:
         return self.repo.get(id)
 
     def walk_history(self,
-            commit: typing.Union[pygit2.Oid,pygit2.Commit]) -> typing.Generator[pygit2.Commit,None,None]:
+            commit: typing.Union[pygit2.Oid,pygit2.Commit],
+            since: typing.Optional[pygit2.Oid]=None) -> typing.Generator[pygit2.Commit,None,None]:
+        """
+        Walk the history of commit, oldest first. If since is given, only
+        commits not reachable from it are walked (since..commit).
+        """
         if isinstance(commit, pygit2.Commit):
             commit_id = commit.id
         else:
             commit_id = commit
-        for c in self.repo.walk(commit_id, pygit2.GIT_SORT_TOPOLOGICAL|pygit2.GIT_SORT_REVERSE):
+        walker = self.repo.walk(commit_id, pygit2.GIT_SORT_TOPOLOGICAL|pygit2.GIT_SORT_REVERSE)
+        if since is not None:
+            walker.hide(since)
+        for c in walker:
             yield c
 
-    def extract_changes_from_history(self,
-            commit: typing.Union[pygit2.Oid,pygit2.Commit]) -> typing.Generator[pygit2.Commit,None,None]:
-        for c in self.extract_changes(self.walk_history(commit)):
-            yield c
+    def history(self, since: typing.Optional[str]=None) -> typing.Optional[typing.Tuple[str,typing.List[str]]]:
+        """
+        Return the id of master and the ids of the commits of its history,
+        oldest first. If since is given, only commits after it are
+        returned.
+
+        Returns None if there is no master, or since is not an ancestor of
+        master, e.g. after a force push.
+        """
+        head = self.reference('refs/heads/master')
+        if head is None:
+            logger.warning('no master')
+            return None
+        since_id = None
+        if since is not None:
+            since_id = pygit2.Oid(hex=since)
+            if not self.is_ancestor(since_id, head.id):
+                logger.warning('%s: last commit %s is not an ancestor of master' % (
+                    self.repo.path, since))
+                return None
+        return str(head.id), [str(c.id) for c in self.walk_history(head, since_id)]
+
+    def is_ancestor(self, ancestor: pygit2.Oid, commit: pygit2.Oid) -> bool:
+        if ancestor == commit:
+            return True
+        try:
+            base = self.repo.merge_base(ancestor, commit)
+        except (KeyError, ValueError, pygit2.GitError):
+            return False
+        return base == ancestor
 
     def extract_changes(self,
             commits: typing.Union[pygit2.Commit,typing.Generator[pygit2.Commit,None,None]],
-            ) -> typing.Generator[pygit2.Commit,None,None]:
-        if isinstance(commits, types.GeneratorType):
+            ) -> typing.Generator[Change,None,None]:
+        """
+        Extract changes from the given commits, in order.
+
+        Blobs of upcoming changes are parsed ahead, with up to
+        parse_concurrency parse requests in flight.
+        """
+        if not isinstance(commits, types.GeneratorType):
+            commits = iter([commits])
+
+        executor = None
+        if self.parse_concurrency > 1:
+            executor = ThreadPoolExecutor(max_workers=self.parse_concurrency)
+        try:
+            pending: typing.Deque[_PendingChange] = collections.deque()
             for commit in commits:
-                for change in self.extract_changes(commit):
+                for patch in self._get_patches(commit):
+                    pending.append(self._prefetch_change(executor, commit.id, patch))
+                    if len(pending) > self.parse_concurrency * PREFETCH_FACTOR:
+                        change = self._resolve_change(pending.popleft())
+                        if change is not None:
+                            yield change
+            while pending:
+                change = self._resolve_change(pending.popleft())
+                if change is not None:
                     yield change
-            return
-        
-        commit = commits
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+    def _get_patches(self, commit: pygit2.Commit) -> typing.Generator[pygit2.Patch,None,None]:
         logger.debug('extracting changes from commit: %s' % commit.id)
+        metrics.COMMITS.inc()
         if len(commit.parents) == 0:
             logging.debug('skip commit with no parents: %s' % {'commit': commit.id})
             return
@@ -135,36 +237,54 @@ class GitRepository:
             interhunk_lines=1)
         #PERF: diff.find_similar()
         for patch in diff:
-            change = self._extract_change_from_patch(commit.id, patch)
-            if change is None:
+            if patch.delta.status_char() != 'M':
                 continue
-            yield change
+            if not self._match_patch(patch):
+                continue
+            metrics.PATCHES.inc()
+            yield patch
 
-    def _extract_change_from_patch(self,
+    def _prefetch_change(self,
+            executor: typing.Optional[ThreadPoolExecutor],
             commit_id: pygit2.Oid,
-            patch: pygit2.Patch) -> typing.Optional[Change]:
-        if patch.delta.status_char() != 'M':
-            return None
-        if not self._match_patch(patch):
-            return None
-
+            patch: pygit2.Patch) -> '_PendingChange':
         logger.debug('extracting changes from file: %s -> %s' % (
             patch.delta.old_file.path, patch.delta.new_file.path))
-
         added_lines, deleted_lines = self._get_added_deleted_lines(patch)
-        base_file = self._extract_file_from_difffile(patch.delta.old_file)
-        if not base_file:
-            return None
-        head_file = self._extract_file_from_difffile(patch.delta.new_file)
-        if not head_file:
+        old_file = patch.delta.old_file
+        new_file = patch.delta.new_file
+        return _PendingChange(
+            commit_id=str(commit_id),
+            base_path=old_file.path,
+            base_hash=str(old_file.id),
+            base=self._get_blob_uast_future(executor, str(old_file.id), old_file.path),
+            head_path=new_file.path,
+            head_hash=str(new_file.id),
+            head=self._get_blob_uast_future(executor, str(new_file.id), new_file.path),
+            added_lines=added_lines,
+            deleted_lines=deleted_lines)
+
+    def _resolve_change(self, pending: '_PendingChange') -> typing.Optional[Change]:
+        base_content, base_uast = self._resolve_blob_uast(pending.base_hash, pending.base)
+        head_content, head_uast = self._resolve_blob_uast(pending.head_hash, pending.head)
+        if base_uast is None or head_uast is None:
             return None
-
         return Change(
-            commit_id=str(commit_id),
-            base=base_file,
-            head=head_file,
-            deleted_lines=deleted_lines,
-            added_lines=added_lines)
+            commit_id=pending.commit_id,
+            base=File(
+                hash=pending.base_hash,
+                path=pending.base_path,
+                content=base_content,
+                uast=base_uast,
+                language=get_language(pending.base_path)),
+            head=File(
+                hash=pending.head_hash,
+                path=pending.head_path,
+                content=head_content,
+                uast=head_uast,
+                language=get_language(pending.head_path)),
+            deleted_lines=pending.deleted_lines,
+            added_lines=pending.added_lines)
 
     def _match_patch(self, patch: pygit2.Patch) -> bool:
         for filter in self.filters:
@@ -188,37 +308,70 @@ class GitRepository:
             added_lines += [line.new_lineno for line in hunk.lines if line.old_lineno == -1]
         return added_lines, deleted_lines
 
-    def _extract_file_from_difffile(self, file: pygit2.DiffFile) -> File:
-        blob_hash = str(file.id)
-        content, uast = self._get_blob_uast(blob_hash, file.path)
-        if not uast:
-            return None
-        return File(
-            hash=blob_hash,
-            path=file.path,
-            content=content,
-            uast=uast
-        )
-
     def _get_blob_uast(self, blob_hash, path):
+        future = self._get_blob_uast_future(None, blob_hash, path)
+        return self._resolve_blob_uast(blob_hash, future)
+
+    def _get_blob_uast_future(self,
+            executor: typing.Optional[ThreadPoolExecutor],
+            blob_hash: str,
+            path: str) -> Future:
         if blob_hash in self.cache:
-            content, uast = self.cache[blob_hash]
-            return content, uast
+            metrics.CACHE_HITS.inc(cache='memory')
+            future: Future = Future()
+            future.set_result(self.cache[blob_hash])
+            return future
+        if blob_hash in self._inflight:
+            metrics.CACHE_HITS.inc(cache='memory')
+            return self._inflight[blob_hash]
+        metrics.CACHE_MISSES.inc(cache='memory')
         content = self.repo.get(blob_hash).data
-        uast = self._get_uast(path, blob_hash, content)
-        self.cache[blob_hash] = (content, uast)
+        if executor is None:
+            future = Future()
+            start = time.monotonic()
+            future.set_result(self._parse_blob(blob_hash, path, content))
+            self.parse_wait_time += time.monotonic() - start
+        else:
+            future = executor.submit(self._parse_blob, blob_hash, path, content)
+        self._inflight[blob_hash] = future
+        return future
+
+    def _resolve_blob_uast(self, blob_hash: str, future: Future):
+        start = time.monotonic()
+        result = future.result()
+        self.parse_wait_time += time.monotonic() - start
+        if self._inflight.get(blob_hash) is future:
+            del self._inflight[blob_hash]
+            self.cache[blob_hash] = result
+        return result
+
+    def _parse_blob(self, blob_hash, path, content):
+        uast = None
+        if self.uast_cache is not None:
+            uast = self.uast_cache.get(blob_hash)
+            if uast is None:
+                metrics.CACHE_MISSES.inc(cache='disk')
+            else:
+                metrics.CACHE_HITS.inc(cache='disk')
+        if uast is None:
+            uast = self._get_uast(path, blob_hash, content)
+            if uast is not None and self.uast_cache is not None:
+                self.uast_cache.put(blob_hash, uast)
         return content, uast
 
     def _get_uast(self, path, blob_hash, content):
         try:
-            response = self.client.parse(filename=path, contents=content)
+            with metrics.PARSE_SECONDS.time():
+                response = self.client.parse(filename=path, contents=content)
         except Exception as exc:
+            metrics.PARSE_FAILURES.inc()
             logging.error('bblfsh parsing error raised: %s' % {
                 'file': path,
                 'hash': blob_hash,
                 'exception': exc})
             return None
         if response.status != 0:
+                metrics.PARSE_FAILURES.inc()
                 logging.error('bblfsh parsing error: %s' % {
                     'file': path,
                     'hash': blob_hash,
@@ -226,17 +379,25 @@ class GitRepository:
                 return None
         uast = response.uast
         filter_node(uast)
-        return uast
+        return FileUAST.from_bblfsh(uast)
 
 class GitRepositoryTrainer(GitRepository):
+    """
+    Trains the stats of each language with the history of a repository.
+    Changes are routed by the language of their head file, and changes in
+    other languages are ignored, so a single walk trains every language.
+    """
 
     def __init__(self,
             repo_name: str,
             repo: typing.Union[str,pygit2.Repository],
             client: bblfsh.BblfshClient,
-            stats: Stats,
-            filters: typing.Iterable[FileFilter]) -> None:
-        super(GitRepositoryTrainer, self).__init__(repo, client, filters)
+            stats: typing.Dict[str,Stats],
+            filters: typing.Iterable[FileFilter],
+            uast_cache: typing.Optional[UASTCache]=None,
+            parse_concurrency: int=DEFAULT_PARSE_CONCURRENCY) -> None:
+        super(GitRepositoryTrainer, self).__init__(
+            repo, client, filters, uast_cache, parse_concurrency)
         self.repo_name = repo_name
         self.stats = stats
         self.tree_extractor = TreeExtractor(
@@ -246,21 +407,36 @@ class GitRepositoryTrainer(GitRepository):
             max_size=DEFAULT_MAX_SUBTREE_SIZE
         )
 
-    def train_all(self) -> None:
-        head = self.reference('refs/heads/master')
-        if head is None:
-            logger.warning('no master')
-            return
-        for change in self.extract_changes_from_history(head):
+    def train_commits(self, head: str, commits: typing.List[str]) -> None:
+        """
+        Train with the given commits, in order, and record head as the last
+        commit of the repository. Commits are trained independently of
+        each other, so the history can be split in chunks trained
+        separately, and their stats added up.
+        """
+        start = time.monotonic()
+        for change in self.extract_changes(self.get(pygit2.Oid(hex=c)) for c in commits):
             self.train(change)
+        for stats in self.stats.values():
+            stats.last_commit[self.repo_name] = head
+        elapsed = time.monotonic() - start
+        logger.info('%s: waited for parser %.1fs of %.1fs (%.0f%%, concurrency: %d)' % (
+            self.repo_name, self.parse_wait_time, elapsed,
+            100.0 * self.parse_wait_time / max(elapsed, 1e-9),
+            self.parse_concurrency))
+        if self.uast_cache is not None:
+            logger.info('%s: %s' % (self.repo_name, self.uast_cache))
 
     def train(self, change: Change) -> None:
         logger.debug('processing change: %s' % change)
+        stats = self.stats.get(change.head.language)
+        if stats is None:
+            return
         for line, uast, snippet in self.tree_extractor.get_snippets(
                 file=change.base,
                 lines=change.deleted_lines):
-            self.stats.deleted(self.repo_name, uast, snippet)
+            stats.deleted(self.repo_name, uast, snippet)
         for line, uast, snippet in self.tree_extractor.get_snippets(
                 file=change.head,
                 lines=change.added_lines):
-            self.stats.added(self.repo_name, uast, snippet)
+            stats.added(self.repo_name, uast, snippet)
@@ -0,0 +1,114 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .bblfshutil import UAST
+from .bblfshutil import WILDCARD
+from .bblfshutil import key_eq_wildcards
+
+
+class _TrieNode:
+    __slots__ = ('children', 'patterns')
+
+    def __init__(self) -> None:
+        self.children: Dict[Tuple[str,str],'_TrieNode'] = {}
+        self.patterns: List[Tuple[int,UAST]] = []
+
+
+class PatternIndex:
+    """
+    Index of UAST patterns for wildcard-aware matching.
+
+    Patterns are stored in a trie over the keys of their nodes, in the same
+    order that uast_eq_wildcards compares them. A lookup only follows the
+    branches for the key of each node and its wildcard variants, so it
+    touches candidate patterns only. Results are the same as matching every
+    pattern in insertion order.
+    """
+
+    def __init__(self, patterns: Iterable[UAST]=tuple()) -> None:
+        self._root = _TrieNode()
+        self._size = 0
+        for pattern in patterns:
+            self.add(pattern)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, pattern: UAST) -> None:
+        node = self._root
+        for n in pattern:
+            child = node.children.get(n.key)
+            if child is None:
+                child = _TrieNode()
+                node.children[n.key] = child
+            node = child
+        node.patterns.append((self._size, pattern))
+        self._size += 1
+
+    def match_all(self, uast: UAST) -> List[UAST]:
+        """
+        Return all patterns matching the given UAST, in insertion order.
+        """
+        keys = [n.key for n in uast]
+        found: List[Tuple[int,UAST]] = []
+        stack = [(self._root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            if depth == len(keys):
+                found.extend(node.patterns)
+                continue
+            for child in self._candidates(node, keys[depth]):
+                stack.append((child, depth + 1))
+        found.sort(key=lambda x: x[0])
+        return [p for _, p in found]
+
+    def match_many(self, uasts: List[UAST]) -> List[List[UAST]]:
+        """
+        Return all patterns matching each of the given UASTs, as match_all
+        does, in one walk of the trie: UASTs sharing a prefix of keys
+        follow its branches once.
+        """
+        keys = [[n.key for n in uast] for uast in uasts]
+        found: List[List[Tuple[int,UAST]]] = [[] for _ in uasts]
+        stack = [(self._root, 0, list(range(len(uasts))))]
+        while stack:
+            node, depth, queries = stack.pop()
+            children: Dict[int,Tuple[_TrieNode,List[int]]] = {}
+            for q in queries:
+                if depth == len(keys[q]):
+                    found[q].extend(node.patterns)
+                    continue
+                for child in self._candidates(node, keys[q][depth]):
+                    children.setdefault(id(child), (child, []))[1].append(q)
+            for child, child_queries in children.values():
+                stack.append((child, depth + 1, child_queries))
+        for matches in found:
+            matches.sort(key=lambda x: x[0])
+        return [[p for _, p in matches] for matches in found]
+
+    def match(self, uast: UAST) -> Optional[UAST]:
+        """
+        Return the first pattern, in insertion order, matching the given UAST.
+        """
+        matches = self.match_all(uast)
+        if len(matches) == 0:
+            return None
+        return matches[0]
+
+    def _candidates(self,
+            node: _TrieNode,
+            key: Tuple[str,str]) -> Iterable[_TrieNode]:
+        if not node.children:
+            return []
+        internal_type, token = key
+        if internal_type == WILDCARD or token == WILDCARD:
+            return [c for k, c in node.children.items() if key_eq_wildcards(k, key)]
+        candidates = []
+        for k in (
+                key,
+                (WILDCARD, token),
+                (internal_type, WILDCARD),
+                (WILDCARD, WILDCARD)):
+            child = node.children.get(k)
+            if child is not None:
+                candidates.append(child)
+        return candidates
@@ -1,6 +1,7 @@
 
 import math
 
+from .languages import language_path
 from .stats import Stats
 from .settings import *
 from .postprocess import per_repo_score1
@@ -25,7 +26,7 @@ def print_top(stats: Stats, k: int) -> None:
         print()
 
 def inspect(args):
-    path = args.stats
+    path = str(language_path(args.stats, args.language))
 
     merged_path = path + '_merged'
     ranked_path = merged_path + '_ranked'
@@ -0,0 +1,82 @@
+"""
+Languages of source files, and the per-language layout of stats and models.
+
+Languages are named as lookout reports them in File.language (enry names),
+and stored in directories named after the bblfsh driver.
+"""
+
+import pathlib
+import re
+import typing
+
+# File extensions of the languages with a bblfsh driver.
+EXTENSIONS = {
+    'Go': ['.go'],
+    'Python': ['.py'],
+    'Java': ['.java'],
+    'JavaScript': ['.js', '.jsx', '.mjs'],
+    'TypeScript': ['.ts', '.tsx'],
+    'Ruby': ['.rb'],
+    'PHP': ['.php'],
+    'Shell': ['.sh', '.bash'],
+    'C++': ['.cpp', '.cc', '.cxx', '.hpp', '.hh'],
+    'C#': ['.cs'],
+}
+
+_LANGUAGE_BY_EXTENSION = dict(
+    (ext, language)
+    for language, exts in EXTENSIONS.items()
+    for ext in exts)
+
+_DIRECTORIES = {
+    'Shell': 'bash',
+    'C++': 'cpp',
+    'C#': 'csharp',
+}
+
+def get_language(path: str) -> str:
+    """
+    Return the language of a file by its extension, or 'Other'.
+    """
+    dot = path.rfind('.')
+    if dot < 0 or '/' in path[dot:]:
+        return 'Other'
+    return _LANGUAGE_BY_EXTENSION.get(path[dot:].lower(), 'Other')
+
+def language_dir(language: str) -> str:
+    """
+    Return the directory name of a language, e.g. 'go' or 'cpp'.
+    """
+    return _DIRECTORIES.get(language, language.lower())
+
+def language_path(path: typing.Union[str,pathlib.Path], language: str) -> pathlib.Path:
+    """
+    Return the per-language path of a file, with the language directory
+    inserted before the file name, e.g. data/stats.db -> data/go/stats.db.
+    """
+    path = pathlib.Path(path)
+    return path.parent / language_dir(language) / path.name
+
+def parse_languages(value: str) -> typing.List[str]:
+    """
+    Parse a comma-separated list of languages, given by name or directory
+    name, in any case.
+    """
+    names = dict((k.lower(), k) for k in EXTENSIONS)
+    names.update((language_dir(k), k) for k in EXTENSIONS)
+    languages = []
+    for name in value.split(','):
+        name = name.strip()
+        if name.lower() not in names:
+            raise ValueError('unknown language: %s' % name)
+        if names[name.lower()] not in languages:
+            languages.append(names[name.lower()])
+    return languages
+
+def include_pattern(languages: typing.Iterable[str]) -> str:
+    """
+    Return a regular expression matching the paths of files in the given
+    languages.
+    """
+    exts = sorted(set(e for l in languages for e in EXTENSIONS.get(l, [])))
+    return '.*(%s)$' % '|'.join(re.escape(e) for e in exts)
@@ -0,0 +1,312 @@
+"""
+Counters and latency histograms, exported in the Prometheus text format.
+
+Metrics are process-local. Worker processes can send their increments to
+the parent with Registry.drain and Registry.merge.
+"""
+
+import bisect
+import http.server
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+Labels = Tuple[Tuple[str,str],...]
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str,str]]=None) -> str:
+    if extra is not None:
+        labels = labels + (extra,)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in labels)
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return '%d' % value
+    return repr(float(value))
+
+
+class Counter:
+    """
+    Monotonic counter, optionally split by labels.
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, lock: threading.Lock) -> None:
+        self.name = name
+        self.help = help
+        self._lock = lock
+        self._values: Dict[Labels,float] = {}
+
+    def inc(self, amount: float=1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels: str) -> float:
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def _samples(self) -> Iterable[str]:
+        for labels, value in sorted(self._values.items()):
+            yield '%s%s %s' % (self.name, _format_labels(labels), _format_value(value))
+
+    def _drain(self) -> Dict[Labels,float]:
+        values, self._values = self._values, {}
+        return values
+
+    def _merge(self, values: Dict[Labels,float]) -> None:
+        for key, value in values.items():
+            self._values[key] = self._values.get(key, 0) + value
+
+
+class Histogram:
+    """
+    Histogram of observed values with cumulative buckets, optionally split
+    by labels.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self,
+            name: str,
+            help: str,
+            lock: threading.Lock,
+            buckets: Iterable[float]=DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self._lock = lock
+        self.buckets = sorted(buckets)
+        # per labels: bucket counts (last one is +Inf), sum
+        self._values: Dict[Labels,Tuple[List[int],float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key, (None, 0.0))
+            if counts is None:
+                counts = [0] * (len(self.buckets) + 1)
+            counts[idx] += 1
+            self._values[key] = (counts, total + value)
+
+    def time(self, **labels: str) -> '_Timer':
+        """
+        Return a context manager observing the time spent in it.
+        """
+        return _Timer(self, labels)
+
+    def count(self, **labels: str) -> int:
+        counts, _ = self._values.get(tuple(sorted(labels.items())), ([], 0.0))
+        return sum(counts)
+
+    def sum(self, **labels: str) -> float:
+        return self._values.get(tuple(sorted(labels.items())), ([], 0.0))[1]
+
+    def _samples(self) -> Iterable[str]:
+        for labels, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + [float('inf')], counts):
+                cumulative += count
+                yield '%s_bucket%s %d' % (
+                    self.name,
+                    _format_labels(labels, ('le', _format_value(bound))),
+                    cumulative)
+            yield '%s_sum%s %s' % (self.name, _format_labels(labels), repr(total))
+            yield '%s_count%s %d' % (self.name, _format_labels(labels), cumulative)
+
+    def _drain(self) -> Dict[Labels,Tuple[List[int],float]]:
+        values, self._values = self._values, {}
+        return values
+
+    def _merge(self, values: Dict[Labels,Tuple[List[int],float]]) -> None:
+        for key, (counts, total) in values.items():
+            prev_counts, prev_total = self._values.get(key, ([0] * len(counts), 0.0))
+            self._values[key] = (
+                [a + b for a, b in zip(prev_counts, counts)],
+                prev_total + total)
+
+
+class _Timer:
+
+    def __init__(self, histogram: Histogram, labels: Dict[str,str]) -> None:
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self) -> '_Timer':
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._histogram.observe(time.monotonic() - self._start, **self._labels)
+
+
+class Registry:
+    """
+    Set of metrics of a process.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._metrics: Dict[str,object] = {}
+        # a forked child could inherit the lock held by another thread
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset_lock)
+
+    def _reset_lock(self) -> None:
+        self._lock = threading.Lock()
+        for metric in self._metrics.values():
+            metric._lock = self._lock
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._register(Counter(name, help, self._lock))
+
+    def histogram(self,
+            name: str,
+            help: str,
+            buckets: Iterable[float]=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, self._lock, buckets))
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError('duplicate metric: %s' % metric.name)
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """
+        Return all metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            for name, metric in sorted(self._metrics.items()):
+                lines.append('# HELP %s %s' % (name, metric.help))
+                lines.append('# TYPE %s %s' % (name, metric.kind))
+                lines.extend(metric._samples())
+        return '\n'.join(lines) + '\n'
+
+    def drain(self) -> Dict[str,dict]:
+        """
+        Return the values of all metrics and reset them, to be merged into
+        the registry of another process.
+        """
+        with self._lock:
+            return dict((name, metric._drain())
+                for name, metric in self._metrics.items())
+
+    def merge(self, values: Dict[str,dict]) -> None:
+        with self._lock:
+            for name, metric_values in values.items():
+                self._metrics[name]._merge(metric_values)
+
+    def write(self, filename: str) -> None:
+        """
+        Write all metrics to a file atomically, e.g. for the node exporter
+        textfile collector.
+        """
+        tmp_filename = '%s.tmp' % filename
+        with open(tmp_filename, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp_filename, filename)
+
+REGISTRY = Registry()
+
+
+class PeriodicWriter:
+    """
+    Writes the metrics of a registry to a file every interval seconds, in
+    a daemon thread.
+    """
+
+    def __init__(self,
+            filename: str,
+            interval: float,
+            registry: Registry=REGISTRY) -> None:
+        self.filename = filename
+        self.interval = interval
+        self.registry = registry
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> 'PeriodicWriter':
+        self._thread.start()
+        return self
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def flush(self) -> None:
+        self.registry.write(self.filename)
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+
+
+def start_http_server(
+        host: str,
+        port: int,
+        registry: Registry=REGISTRY) -> http.server.HTTPServer:
+    """
+    Serve the metrics of the registry at /metrics, in a daemon thread.
+    """
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+# Training
+COMMITS = REGISTRY.counter(
+    'badcode_commits_total', 'Commits walked.')
+PATCHES = REGISTRY.counter(
+    'badcode_patches_total', 'Patches of modified files walked, after filters.')
+PARSE_SECONDS = REGISTRY.histogram(
+    'badcode_bblfsh_parse_seconds', 'Latency of bblfsh parse calls.')
+PARSE_FAILURES = REGISTRY.counter(
+    'badcode_bblfsh_parse_failures_total', 'Failed bblfsh parse calls.')
+CACHE_HITS = REGISTRY.counter(
+    'badcode_uast_cache_hits_total', 'UAST cache hits, by cache.')
+CACHE_MISSES = REGISTRY.counter(
+    'badcode_uast_cache_misses_total', 'UAST cache misses, by cache.')
+SUBTREES = REGISTRY.histogram(
+    'badcode_subtrees_per_file', 'Relevant subtrees extracted per file.',
+    buckets=COUNT_BUCKETS)
+POSTPROCESS_SECONDS = REGISTRY.histogram(
+    'badcode_postprocess_stage_seconds', 'Duration of postprocess stages, by stage.')
+
+# Analyzer
+REVIEWS_SECONDS = REGISTRY.histogram(
+    'badcode_review_seconds', 'Latency of review events.')
+MATCH_SECONDS = REGISTRY.histogram(
+    'badcode_match_seconds', 'Latency of matching the subtrees of a change.')
+MATCHES = REGISTRY.counter(
+    'badcode_matches_total', 'Lines of a change matching a pattern.')
@@ -0,0 +1,404 @@
+import array
+import mmap
+import os
+import struct
+import sys
+import threading
+from typing import Dict, List, Optional, Tuple, Union
+
+from cachetools import LRUCache
+
+from .bblfshutil import UAST
+from .bblfshutil import WILDCARD
+from .bblfshutil import key_eq_wildcards
+from .compact import CompactUAST
+from .compact import KEYS
+from .languages import language_dir
+from .settings import *
+from .stats import Match
+from .stats import Stats
+from .stats import dedup
+from .stats import ranked
+
+MAGIC = b'BADCODEM'
+VERSION = 1
+
+# magic, version, number of keys, number of patterns, offsets of the
+# key offsets, key data, pattern records, nodes, text offsets and text
+# data sections.
+_HEADER = struct.Struct('<8sIII6Q')
+# node offset, size, ordinal, added, deleted, score
+_RECORD = struct.Struct('<QIIIId')
+_KEY_PREFIX = struct.Struct('<I')
+
+KEY_CACHE_SIZE = 100000
+
+
+def is_mapped_model(filename: str) -> bool:
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def load_model(filename: str) -> Union[Stats,'MappedModel']:
+    """
+    Load a model for matching, either a mapped model or pickled Stats.
+    """
+    if is_mapped_model(filename):
+        return MappedModel(filename)
+    stats = Stats.load(filename)
+    stats.build_index()
+    return stats
+
+class LanguageModels:
+    """
+    Models per language, each loaded on first use. The model of a language
+    is at path_template with {language} replaced by its directory name,
+    e.g. data/{language}/model -> data/go/model. A template without
+    {language} is a single model for all languages.
+    """
+
+    def __init__(self, path_template: str, languages: List[str]) -> None:
+        self.path_template = path_template
+        self.languages = list(languages)
+        self._models: Dict[str,Union[Stats,'MappedModel']] = {}
+        self._lock = threading.Lock()
+
+    def path(self, language: str) -> str:
+        return self.path_template.replace('{language}', language_dir(language))
+
+    def available(self) -> List[str]:
+        """
+        Return the languages with a model, loaded or not.
+        """
+        return [l for l in self.languages
+            if l in self._models or os.path.exists(self.path(l))]
+
+    def loaded(self) -> List[str]:
+        return list(self._models)
+
+    def get(self, language: Optional[str]) -> Optional[Union[Stats,'MappedModel']]:
+        """
+        Return the model of a language, loading it if needed, or None if
+        the language is not analyzed or has no model yet.
+        """
+        model = self._models.get(language)
+        if model is not None or language not in self.languages:
+            return model
+        with self._lock:
+            if language not in self._models:
+                path = self.path(language)
+                if not os.path.exists(path):
+                    logger.debug('No model for %s: %s' % (language, path))
+                    return None
+                logger.info('Loading model for %s: %s' % (language, path))
+                self._models[language] = load_model(path)
+                logger.info('Loaded model for %s: %s' % (language, path))
+            return self._models[language]
+
+def _encode_key(key: Tuple[str,str]) -> Tuple[bytes,bytes]:
+    return (key[0].encode('utf-8'), key[1].encode('utf-8'))
+
+def write_mapped_model(stats: Stats, filename: str) -> None:
+    """
+    Write the patterns in stats to a mapped model file.
+
+    All sections are flat arrays. Patterns are sorted by size and key ids
+    so that they can be matched by binary search, and key ids are sorted
+    by key, so that they can be looked up by binary search too.
+    """
+    patterns = []
+    keys = set([])
+    for ordinal, (uast, totals) in enumerate(stats.totals.items()):
+        nodes = [(n.key, len(n)) for n in uast]
+        keys.update(k for k, _ in nodes)
+        patterns.append((ordinal, uast, totals, nodes))
+
+    sorted_keys = sorted(keys, key=_encode_key)
+    key_ids = dict((k, n) for n, k in enumerate(sorted_keys))
+    key_offsets = array.array('Q', [0])
+    key_data = bytearray()
+    for key in sorted_keys:
+        internal_type, token = _encode_key(key)
+        key_data += _KEY_PREFIX.pack(len(internal_type))
+        key_data += internal_type
+        key_data += token
+        key_offsets.append(len(key_data))
+
+    def sort_key(p):
+        return (len(p[3]), [key_ids[k] for k, _ in p[3]])
+    patterns.sort(key=sort_key)
+
+    records = bytearray()
+    nodes = array.array('I')
+    text_offsets = array.array('Q', [0])
+    text_data = bytearray()
+    for ordinal, uast, totals, uast_nodes in patterns:
+        records += _RECORD.pack(
+            len(nodes),
+            len(uast_nodes),
+            ordinal,
+            totals.get('added', 0),
+            totals.get('deleted', 0),
+            totals.get('score', 0.0))
+        nodes.extend(key_ids[k] for k, _ in uast_nodes)
+        nodes.extend(size for _, size in uast_nodes)
+        text_data += stats.text[uast].encode('utf-8')
+        text_offsets.append(len(text_data))
+
+    sections = [key_offsets, key_data, records, nodes, text_offsets, text_data]
+    if sys.byteorder != 'little':
+        for section in sections:
+            if isinstance(section, array.array):
+                section.byteswap()
+    offsets = []
+    pos = _HEADER.size
+    for section in sections:
+        pos += (-pos) % 8
+        offsets.append(pos)
+        pos += len(section) * getattr(section, 'itemsize', 1)
+
+    tmp_filename = '%s.tmp' % filename
+    with open(tmp_filename, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, len(sorted_keys), len(patterns), *offsets))
+        for offset, section in zip(offsets, sections):
+            f.write(b'\0' * (offset - f.tell()))
+            f.write(section)
+    os.replace(tmp_filename, filename)
+
+
+class MappedModel:
+    """
+    Read-only model backed by a memory-mapped file written by
+    write_mapped_model.
+
+    Opening it only reads the header. Patterns, scores and snippets are
+    decoded lazily, and the pages are shared with every other process
+    mapping the same file.
+    """
+
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self._n_keys, self._n_patterns,
+            key_offsets, key_data, records, nodes,
+            text_offsets, text_data) = _HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError('not a mapped model: %s' % filename)
+        if version != VERSION:
+            raise ValueError('unsupported mapped model version %d: %s' % (version, filename))
+        if sys.byteorder != 'little':
+            raise ValueError('mapped models are only supported on little-endian hosts')
+        self._view = memoryview(self._mmap)
+        self._key_offsets = self._view[key_offsets:key_offsets + 8 * (self._n_keys + 1)].cast('Q')
+        self._key_data = key_data
+        self._records = records
+        self._nodes = self._view[nodes:text_offsets].cast('I')
+        self._text_offsets = self._view[text_offsets:text_offsets + 8 * (self._n_patterns + 1)].cast('Q')
+        self._text_data = text_data
+        self._keys = LRUCache(maxsize=KEY_CACHE_SIZE)
+        self._key_ids = LRUCache(maxsize=KEY_CACHE_SIZE)
+
+    def __len__(self) -> int:
+        return self._n_patterns
+
+    def build_index(self) -> None:
+        pass
+
+    def _record(self, idx: int) -> Tuple[int,int,int,int,int,float]:
+        return _RECORD.unpack_from(self._mmap, self._records + idx * _RECORD.size)
+
+    def _raw_key(self, key_id: int) -> Tuple[bytes,bytes]:
+        start = self._key_data + self._key_offsets[key_id]
+        end = self._key_data + self._key_offsets[key_id + 1]
+        type_len, = _KEY_PREFIX.unpack_from(self._mmap, start)
+        start += _KEY_PREFIX.size
+        return (self._mmap[start:start + type_len], self._mmap[start + type_len:end])
+
+    def key(self, key_id: int) -> Tuple[str,str]:
+        key = self._keys.get(key_id)
+        if key is None:
+            internal_type, token = self._raw_key(key_id)
+            key = (internal_type.decode('utf-8'), token.decode('utf-8'))
+            self._keys[key_id] = key
+        return key
+
+    def key_id(self, key: Tuple[str,str]) -> Optional[int]:
+        if key in self._key_ids:
+            return self._key_ids[key]
+        encoded = _encode_key(key)
+        lo, hi = 0, self._n_keys
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._raw_key(mid) < encoded:
+                lo = mid + 1
+            else:
+                hi = mid
+        key_id = None
+        if lo < self._n_keys and self._raw_key(lo) == encoded:
+            key_id = lo
+        self._key_ids[key] = key_id
+        return key_id
+
+    def pattern(self, idx: int) -> CompactUAST:
+        node_offset, size, _, _, _, _ = self._record(idx)
+        keys = array.array('I', (KEYS.intern(self.key(k))
+            for k in self._nodes[node_offset:node_offset + size]))
+        sizes = array.array('I', self._nodes[node_offset + size:node_offset + 2 * size])
+        return CompactUAST(keys, sizes)
+
+    def totals(self, idx: int) -> Dict[str,Union[int,float]]:
+        _, _, _, added, deleted, score = self._record(idx)
+        return {'added': added, 'deleted': deleted, 'score': score}
+
+    def text(self, idx: int) -> str:
+        start = self._text_data + self._text_offsets[idx]
+        end = self._text_data + self._text_offsets[idx + 1]
+        return self._mmap[start:end].decode('utf-8')
+
+    def _size(self, idx: int) -> int:
+        return self._record(idx)[1]
+
+    def _node_key(self, idx: int, pos: int) -> int:
+        return self._nodes[self._record(idx)[0] + pos]
+
+    def _bisect(self, lo: int, hi: int, value: int, get, right: bool) -> int:
+        while lo < hi:
+            mid = (lo + hi) // 2
+            v = get(mid)
+            if v < value or (right and v == value):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def match_all(self, uast: UAST) -> List[int]:
+        """
+        Return the indexes of all patterns matching the given UAST, in the
+        order they had in the original stats.
+        """
+        keys = [n.key for n in uast]
+        lo = self._bisect(0, self._n_patterns, len(keys), self._size, right=False)
+        hi = self._bisect(lo, self._n_patterns, len(keys), self._size, right=True)
+        if lo == hi:
+            return []
+        if any(WILDCARD in key for key in keys):
+            found = [idx for idx in range(lo, hi) if self._match_scan(idx, keys)]
+        else:
+            found = []
+            candidates = [self._candidates(key) for key in keys]
+            stack = [(lo, hi, 0)]
+            while stack:
+                lo, hi, pos = stack.pop()
+                if pos == len(keys):
+                    found.extend(range(lo, hi))
+                    continue
+                get = lambda idx, pos=pos: self._node_key(idx, pos)
+                for key_id in candidates[pos]:
+                    start = self._bisect(lo, hi, key_id, get, right=False)
+                    end = self._bisect(start, hi, key_id, get, right=True)
+                    if start < end:
+                        stack.append((start, end, pos + 1))
+        found.sort(key=lambda idx: self._record(idx)[2])
+        return found
+
+    def _candidates(self, key: Tuple[str,str]) -> List[int]:
+        internal_type, token = key
+        candidates = []
+        for k in (
+                key,
+                (WILDCARD, token),
+                (internal_type, WILDCARD),
+                (WILDCARD, WILDCARD)):
+            key_id = self.key_id(k)
+            if key_id is not None:
+                candidates.append(key_id)
+        return candidates
+
+    def _match_scan(self, idx: int, keys: List[Tuple[str,str]]) -> bool:
+        node_offset = self._record(idx)[0]
+        for pos, key in enumerate(keys):
+            if not key_eq_wildcards(self.key(self._nodes[node_offset + pos]), key):
+                return False
+        return True
+
+    def match(self, uast: UAST) -> Optional[Tuple[CompactUAST,str]]:
+        found = self.match_all(uast)
+        if len(found) == 0:
+            return None
+        return (self.pattern(found[0]), self.text(found[0]))
+
+    def match_many(self, uasts: List[UAST]) -> List[List[Match]]:
+        """
+        Return every pattern matching each of the given UASTs, best score
+        first. Identical UASTs are matched once, and a pattern matching
+        several of them is decoded once.
+        """
+        distinct, positions = dedup(uasts)
+        decoded: Dict[int,Match] = {}
+        found = []
+        for indexes in self._match_distinct(distinct):
+            matches = []
+            for idx in indexes:
+                match = decoded.get(idx)
+                if match is None:
+                    match = Match(self.pattern(idx), self.text(idx), self._record(idx)[5])
+                    decoded[idx] = match
+                matches.append(match)
+            found.append(ranked(matches))
+        return [found[pos] for pos in positions]
+
+    def _match_distinct(self, uasts: List[UAST]) -> List[List[int]]:
+        """
+        Return the indexes of the patterns matching each of the given
+        UASTs, as match_all does, in one pass over the pattern table.
+
+        UASTs are grouped by size, and each group is narrowed down one
+        node position at a time: UASTs with the same candidate key at a
+        position share the bisection of the range of patterns left.
+        """
+        keys = [[n.key for n in uast] for uast in uasts]
+        found: List[List[int]] = [[] for _ in uasts]
+        by_size: Dict[int,List[int]] = {}
+        for q, query_keys in enumerate(keys):
+            if any(WILDCARD in key for key in query_keys):
+                found[q] = self.match_all(uasts[q])
+            else:
+                by_size.setdefault(len(query_keys), []).append(q)
+        candidates: Dict[Tuple[str,str],List[int]] = {}
+        for size, size_queries in by_size.items():
+            lo = self._bisect(0, self._n_patterns, size, self._size, right=False)
+            hi = self._bisect(lo, self._n_patterns, size, self._size, right=True)
+            stack = [(lo, hi, 0, size_queries)]
+            while stack:
+                lo, hi, pos, queries = stack.pop()
+                if lo == hi:
+                    continue
+                if pos == size:
+                    for q in queries:
+                        found[q].extend(range(lo, hi))
+                    continue
+                groups: Dict[int,List[int]] = {}
+                for q in queries:
+                    key = keys[q][pos]
+                    key_ids = candidates.get(key)
+                    if key_ids is None:
+                        key_ids = self._candidates(key)
+                        candidates[key] = key_ids
+                    for key_id in key_ids:
+                        groups.setdefault(key_id, []).append(q)
+                get = lambda idx, pos=pos: self._node_key(idx, pos)
+                for key_id, group in groups.items():
+                    start = self._bisect(lo, hi, key_id, get, right=False)
+                    end = self._bisect(start, hi, key_id, get, right=True)
+                    if start < end:
+                        stack.append((start, end, pos + 1, group))
+            for q in size_queries:
+                found[q].sort(key=lambda idx: self._record(idx)[2])
+        return found
+
+    def close(self) -> None:
+        self._key_offsets.release()
+        self._nodes.release()
+        self._text_offsets.release()
+        self._view.release()
+        self._mmap.close()
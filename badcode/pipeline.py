@@ -0,0 +1,252 @@
+"""
+Pipelines of stages run as a DAG, with artifacts keyed by their inputs.
+
+The key of an artifact is a hash of the keys of its inputs, the name and
+parameters of its stage and the source code of the modules the stage
+depends on. Sources are keyed by their content. The key is written next
+to the artifact (<path>.key) once the artifact is saved, so a re-run only
+runs the stages whose key changed, or whose artifact is missing.
+
+Stages are grouped in tasks, chains of stages where each stage gets the
+value of its first input in memory from the previous one. Tasks that do
+not depend on each other run in parallel, in worker processes.
+"""
+
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+import functools
+import hashlib
+import json
+import os
+import time
+import types
+import typing
+from typing import Any, Callable, Dict, Iterable, List, Optional, Union
+
+from . import metrics
+from .settings import *
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+class Stage:
+    """
+    A stage producing the artifact at path from the artifacts of its
+    inputs, given by stage name.
+
+    run(paths, value, params) gets the paths of the inputs and, if it was
+    produced in the same task, the value of the first input, which it may
+    modify. Otherwise value is None and run loads what it needs. It
+    returns the value of the stage, which is written with save(value,
+    path).
+
+    A stage without run is a source: an existing file, keyed by its
+    content.
+
+    modules are the modules the stage depends on, or the paths of their
+    sources (see package_sources).
+    """
+
+    def __init__(self,
+            name: str,
+            path: str,
+            inputs: Iterable[str]=(),
+            run: Optional[Callable[[List[str],Any,Dict[str,Any]],Any]]=None,
+            save: Optional[Callable[[Any,str],None]]=None,
+            params: Optional[Dict[str,Any]]=None,
+            modules: Iterable[Union[types.ModuleType,str]]=()) -> None:
+        self.name = name
+        self.path = path
+        self.inputs = list(inputs)
+        self.run = run
+        self.save = save
+        self.params = params or {}
+        self.modules = [m if isinstance(m, str) else m.__file__ for m in modules]
+
+    @property
+    def is_source(self) -> bool:
+        return self.run is None
+
+    def __repr__(self) -> str:
+        return 'Stage(%s)' % self.name
+
+def package_sources(package: types.ModuleType) -> List[str]:
+    """
+    Return the paths of the sources of every module of a package, without
+    importing them.
+    """
+    directory = os.path.dirname(package.__file__)
+    return [os.path.join(directory, name)
+        for name in sorted(os.listdir(directory)) if name.endswith('.py')]
+
+def file_key(path: str) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+@functools.lru_cache(maxsize=None)
+def _module_key(filename: str) -> str:
+    return file_key(filename)
+
+def read_key(path: str) -> Optional[str]:
+    try:
+        with open(path + '.key', 'r') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+def _write_key(path: str, key: str) -> None:
+    tmp_path = path + '.key.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(key)
+    os.replace(tmp_path, path + '.key')
+
+def _remove_key(path: str) -> None:
+    if os.path.exists(path + '.key'):
+        os.unlink(path + '.key')
+
+
+class Pipeline:
+    """
+    Stages, given in dependency order: every input of a stage comes
+    before it. release(value) is called on the values left once a task
+    is done, e.g. to close files.
+    """
+
+    def __init__(self,
+            stages: Iterable[Stage],
+            release: Optional[Callable[[Any],None]]=None) -> None:
+        self.stages: Dict[str,Stage] = {}
+        for stage in stages:
+            for name in stage.inputs:
+                if name not in self.stages:
+                    raise ValueError('input %s of %s is not a previous stage' % (name, stage.name))
+            if stage.name in self.stages:
+                raise ValueError('duplicate stage: %s' % stage.name)
+            if stage.is_source and stage.inputs:
+                raise ValueError('source with inputs: %s' % stage.name)
+            self.stages[stage.name] = stage
+        self.release = release
+
+    def keys(self) -> Dict[str,str]:
+        keys: Dict[str,str] = {}
+        for stage in self.stages.values():
+            if stage.is_source:
+                keys[stage.name] = file_key(stage.path)
+                continue
+            data = json.dumps([
+                stage.name,
+                stage.params,
+                [_module_key(m) for m in stage.modules],
+                [keys[i] for i in stage.inputs],
+            ], sort_keys=True)
+            keys[stage.name] = hashlib.blake2b(data.encode(), digest_size=16).hexdigest()
+        return keys
+
+    def stale(self, keys: Optional[Dict[str,str]]=None) -> List[Stage]:
+        """
+        Return the stages to run, in dependency order.
+        """
+        if keys is None:
+            keys = self.keys()
+        return [s for s in self.stages.values()
+            if not s.is_source and (not os.path.exists(s.path) or read_key(s.path) != keys[s.name])]
+
+    def tasks(self, stale: List[Stage], parallel: bool) -> List[List[Stage]]:
+        """
+        Group stale stages in tasks, chains where each stage takes the
+        value of the previous one as its first input. Its other stale
+        inputs must come from tasks run before, or from other processes
+        if parallel is True, in which case the chain is split before the
+        stage so that it does not wait for another task in the middle.
+        """
+        stale_names = set(s.name for s in stale)
+        tasks: List[List[Stage]] = []
+        task_of: Dict[str,int] = {}
+        for stage in stale:
+            idx = task_of.get(stage.inputs[0]) if stage.inputs else None
+            joins = idx is not None and tasks[idx][-1].name == stage.inputs[0]
+            for name in stage.inputs[1:]:
+                if not joins or name not in stale_names:
+                    continue
+                if parallel or task_of[name] > idx:
+                    joins = False
+            if joins:
+                tasks[idx].append(stage)
+            else:
+                idx = len(tasks)
+                tasks.append([stage])
+            task_of[stage.name] = idx
+        return tasks
+
+    def run(self, workers: int=1) -> List[str]:
+        """
+        Run the stale stages, with tasks in up to workers processes, and
+        return their names.
+        """
+        keys = self.keys()
+        stale = self.stale(keys)
+        for stage in self.stages.values():
+            if not stage.is_source and stage not in stale:
+                logger.info('Up to date: %s (%s)' % (stage.name, stage.path))
+        if not stale:
+            return []
+        tasks = self.tasks(stale, parallel=workers > 1)
+        if workers <= 1:
+            for task in tasks:
+                self._run_task(task, keys)
+            return [s.name for s in stale]
+
+        stale_names = set(s.name for s in stale)
+        done: typing.Set[str] = set([])
+        running: Dict[Future,List[Stage]] = {}
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            while tasks or running:
+                for task in [t for t in tasks if self._is_ready(t, stale_names, done)]:
+                    tasks.remove(task)
+                    running[executor.submit(_run_task_in_worker, self, task, keys)] = task
+                if not running:
+                    raise ValueError('tasks with unmet dependencies: %s' % tasks)
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    task = running.pop(future)
+                    metrics.REGISTRY.merge(future.result())
+                    done.update(s.name for s in task)
+        return [s.name for s in stale]
+
+    def _is_ready(self,
+            task: List[Stage],
+            stale_names: typing.Set[str],
+            done: typing.Set[str]) -> bool:
+        names = set(s.name for s in task)
+        for stage in task:
+            for name in stage.inputs:
+                if name in stale_names and name not in names and name not in done:
+                    return False
+        return True
+
+    def _run_task(self, task: List[Stage], keys: Dict[str,str]) -> None:
+        value = None
+        for stage in task:
+            logger.info('Running stage: %s' % stage.name)
+            start = time.monotonic()
+            _remove_key(stage.path)
+            paths = [self.stages[name].path for name in stage.inputs]
+            value = stage.run(paths, value, stage.params)
+            logger.info('Saving %s: %s' % (stage.name, stage.path))
+            stage.save(value, stage.path)
+            _write_key(stage.path, keys[stage.name])
+            logger.info('Finished stage: %s (%.1fs)' % (stage.name, time.monotonic() - start))
+        if value is not None and self.release is not None:
+            self.release(value)
+
+def _run_task_in_worker(
+        pipeline: Pipeline,
+        task: List[Stage],
+        keys: Dict[str,str]) -> Dict[str,dict]:
+    pipeline._run_task(task, keys)
+    return metrics.REGISTRY.drain()
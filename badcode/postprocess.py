@@ -1,7 +1,9 @@
 
 import collections
+import functools
 import math
 import os.path
+import pickle
 import sys
 import typing
 
@@ -9,7 +11,18 @@ from .stats import *
 from .settings import *
 from .bblfshutil import *
 from .bblfshutil import UAST
+from .languages import language_dir
+from .languages import language_path
+from . import metrics
+from .model import write_mapped_model
+from .pipeline import Pipeline
+from .pipeline import Stage
+from .pipeline import package_sources
 from .ranker import Ranker
+from .ranker import StreamingRanker
+from .runs import is_run
+from .runs import read_repos
+from .runs import read_run
 from .treedist import single_node_merge_precalc
 from .treedist import TreeToSeq
 
@@ -25,25 +38,69 @@ def per_repo_score1(stats: Stats, key: UAST, repo: str) -> float:
     diff = s['deleted'] - s['added']
     return float(diff) / total
 
-def score1(stats: Stats, key: UAST) -> float:
-    s = stats.totals[key]
-    total_repos = len(stats.per_repo)
+def repos_score1(
+        repos: typing.List[str],
+        uast_repos: typing.Dict[str,typing.Dict[str,int]]) -> float:
+    """
+    Return score_1 of a pattern from its counts in each repository where
+    it was seen, summed in the order of repos.
+    """
     score = 0.0
-    for repo in stats.per_repo.keys():
-        score += per_repo_score1(stats, key, repo)
-    return score / total_repos
+    for repo in repos:
+        if repo not in uast_repos:
+            continue
+        s = uast_repos[repo]
+        deleted = s.get('deleted', 0)
+        added = s.get('added', 0)
+        score += float(deleted - added) / (deleted + added)
+    return score / len(repos)
+
+def score1(stats: Stats, key: UAST) -> float:
+    return repos_score1(list(stats.per_repo), stats.per_repo_many([key])[0])
+
+# Patterns whose score_1 is computed in one per_repo_many call.
+SCORE_BATCH_SIZE = 1000
 
 def score_avg(stats: Stats, key: UAST) -> float:
     s = stats.totals[key]
     scores = [v for k, v in s.items() if k.startswith('score_')]
     return float(sum(scores)) / len(scores)
 
-def compute_ranking(stats: Stats) -> None:
+def compute_ranking(
+        stats: Stats,
+        approximate: bool=False,
+        scores: typing.Optional[typing.Dict[int,float]]=None) -> None:
+    """
+    Compute the score of every pattern as its percentile by average score.
+    If approximate is True, percentiles are estimated in constant memory
+    with a t-digest instead of sorting all scores.
+
+    scores are precomputed score_1 by fingerprint (see compute_scores),
+    used for the patterns that no other pattern was merged into.
+    """
+    repos = list(stats.per_repo)
+    def set_scores(batch):
+        for uast, uast_repos in zip(batch, stats.per_repo_many(batch)):
+            stats.totals[uast]['score_1'] = repos_score1(repos, uast_repos)
+        batch.clear()
+    batch = []
     for uast in stats.totals:
         s = stats.totals[uast]
-        s['score_1'] = score1(stats, uast)
+        score = None
+        if scores is not None and s.get('merged', 0) == 0:
+            score = scores.get(uast.fingerprint)
+        if score is None:
+            batch.append(uast)
+            if len(batch) >= SCORE_BATCH_SIZE:
+                set_scores(batch)
+            continue
+        s['score_1'] = score
+    set_scores(batch)
 
-    r = Ranker(lambda x: score_avg(stats, x))
+    if approximate:
+        r = StreamingRanker(lambda x: score_avg(stats, x))
+    else:
+        r = Ranker(lambda x: score_avg(stats, x))
     for s in stats.totals:
         r.add(s)
     r.finalize()
@@ -52,23 +109,76 @@ def compute_ranking(stats: Stats) -> None:
         s['score'] = r.get(uast)
 
 def prune(stats: Stats, min_score: float) -> None:
-    stats.totals = dict([(k, v) for k, v in stats.totals.items() if v['score'] >= min_score])
-    for d in stats.per_repo.values():
-        for snpt in list(d.keys()):
-            if snpt not in stats.totals:
-                del d[snpt]
+    stats.prune(min_score)
 
 def merge_same_text(stats: Stats) -> None:
     #FIXME: does not merge per_repo
     per_text = {}
-    for uast, st in stats.totals.items():
+    for uast in stats.totals:
         text = stats.text[uast]
         if text not in per_text:
-            per_text[text] = (uast, st)
+            per_text[text] = uast
         else:
-            if len(uast) > len(per_text[text][0]):
-                per_text[text] = (uast, st)
-    stats.totals = dict(per_text.values())
+            if len(uast) > len(per_text[text]):
+                per_text[text] = uast
+    kept = set(per_text.values())
+    for uast in [u for u in stats.totals if u not in kept]:
+        del stats.totals[uast]
+
+# Polynomial hashes of sequence prefixes and suffixes in similar_pairs.
+_HASH_BASE = 1000003
+_HASH_MOD = (1 << 61) - 1
+
+def _prefix_hashes(seq: typing.Sequence[int]) -> typing.List[int]:
+    """
+    Return the hashes of seq[:n] for n from 0 to len(seq).
+    """
+    h = 0
+    hashes = [h]
+    for value in seq:
+        h = (h * _HASH_BASE + value + 1) % _HASH_MOD
+        hashes.append(h)
+    return hashes
+
+def similar_pairs(seqs: typing.List[typing.List[int]]) -> typing.List[typing.Tuple[int,int]]:
+    """
+    Return the sorted pairs (i, j), with i < j, of sequences with the same
+    length that differ in exactly one position.
+
+    For each position, sequences are bucketed by the hashes of their
+    prefix and suffix around it, so only sequences sharing a bucket are
+    compared. Hashes are computed once per sequence, which takes O(n*L)
+    for n sequences of length L. Candidate pairs are then compared in
+    O(L) each, so hash collisions are not reported.
+    """
+    max_len = max((len(seq) for seq in seqs), default=0)
+    prefixes = [_prefix_hashes(seq) for seq in seqs]
+    # hashes of the reversed suffixes, by their length
+    suffixes = [_prefix_hashes(seq[::-1]) for seq in seqs]
+    pairs: typing.List[typing.Tuple[int,int]] = []
+    for pos in range(max_len):
+        buckets: typing.Dict[tuple,typing.Dict[int,typing.List[int]]] = {}
+        for i, seq in enumerate(seqs):
+            if len(seq) <= pos:
+                continue
+            masked = (len(seq), prefixes[i][pos], suffixes[i][len(seq) - pos - 1])
+            bucket = buckets.setdefault(masked, {})
+            bucket.setdefault(seq[pos], []).append(i)
+        for bucket in buckets.values():
+            if len(bucket) < 2:
+                continue
+            groups = list(bucket.values())
+            for n, group in enumerate(groups):
+                for other_group in groups[n+1:]:
+                    for i in group:
+                        for j in other_group:
+                            a, b = seqs[i], seqs[j]
+                            if a[:pos] != b[:pos] or a[pos+1:] != b[pos+1:]:
+                                continue
+                            pairs.append((i, j) if i < j else (j, i))
+        logger.info('Processed position: %d/%d' % (pos + 1, max_len))
+    pairs.sort()
+    return pairs
 
 def merge_similar(stats: Stats) -> None:
     uasts = []
@@ -79,76 +189,194 @@ def merge_similar(stats: Stats) -> None:
         tree_seq = tts.tree_to_seq(uast)
         uasts.append((uast, tree_seq, sstats))
     tts = None
-    total = len(uasts)
-    proc = 0
+    pairs = similar_pairs([tree_seq for _, tree_seq, _ in uasts])
+    logger.info('Candidate pairs: %d (trees: %d)' % (len(pairs), len(uasts)))
     positive_uasts = {}
     negative_uasts = {}
-    for i, (uast, tree_seq, sstats) in enumerate(uasts):
-        if proc % 1000 == 0:
-            logger.info('Processed: %d/%d)' % (proc, total))
-        proc += 1
-        for ouast, otree_seq, osstats in uasts[i+1:]:
-            merged_uast = single_node_merge_precalc(uast, ouast, tree_seq, otree_seq)
-            if merged_uast is None:
-                continue
-            if sstats['added'] >= sstats['deleted']:
-                s = positive_uasts.get(merged_uast, set([]))
-                s.add(uast)
-                positive_uasts[merged_uast] = s
-            else:
-                s = negative_uasts.get(merged_uast, set([]))
-                s.add(uast)
-                negative_uasts[merged_uast] = s
-            if osstats['added'] >= osstats['deleted']:
-                s = positive_uasts.get(merged_uast, set([]))
-                s.add(ouast)
-                positive_uasts[merged_uast] = s
-            else:
-                s = negative_uasts.get(merged_uast, set([]))
-                s.add(ouast)
-                negative_uasts[merged_uast] = s
+    for i, j in pairs:
+        uast, tree_seq, sstats = uasts[i]
+        ouast, otree_seq, osstats = uasts[j]
+        merged_uast = single_node_merge_precalc(uast, ouast, tree_seq, otree_seq)
+        if merged_uast is None:
+            continue
+        if sstats['added'] >= sstats['deleted']:
+            s = positive_uasts.get(merged_uast, set([]))
+            s.add(uast)
+            positive_uasts[merged_uast] = s
+        else:
+            s = negative_uasts.get(merged_uast, set([]))
+            s.add(uast)
+            negative_uasts[merged_uast] = s
+        if osstats['added'] >= osstats['deleted']:
+            s = positive_uasts.get(merged_uast, set([]))
+            s.add(ouast)
+            positive_uasts[merged_uast] = s
+        else:
+            s = negative_uasts.get(merged_uast, set([]))
+            s.add(ouast)
+            negative_uasts[merged_uast] = s
     for merged_uast, uast_set in negative_uasts.items():
         uast_set = uast_set & negative_uasts.get(merged_uast, set([]))
         for uast in uast_set:
             stats.merge_uast(dst=merged_uast, src=uast)
 
-def postprocess(args):
-    path = args.stats
+def compute_scores(path: str) -> typing.Dict[int,float]:
+    """
+    Return score_1 of every pattern of the stats at path, by fingerprint.
+    Runs are read as a stream, without loading the stats in memory.
+    """
+    if not is_run(path):
+        stats = Stats.load(filename=path)
+        return dict((uast.fingerprint, score1(stats, uast)) for uast in stats.totals)
+    repos = read_repos(path)
+    scores = {}
+    for _, _, uast, _, totals, uast_repos in read_run(path):
+        if totals is None:
+            continue
+        scores[uast.fingerprint] = repos_score1(
+            repos, dict((repo, counts) for repo, (_, counts) in uast_repos.items()))
+    return scores
 
-    merged_path = path + '_merged'
-    ranked_path = merged_path + '_ranked'
-    pruned_path = ranked_path + '_pruned'
+def _load_stats(path: str, store_path: str, store: str) -> Stats:
+    """
+    Load stats in memory, or into a working SQLite database at store_path
+    if the sqlite store was chosen.
+    """
+    if store == 'sqlite':
+        return SqliteStats.create(store_path, path)
+    return Stats.load(filename=path)
+
+def _release_stats(stats) -> None:
+    if isinstance(stats, SqliteStats):
+        stats.close()
+        os.remove(stats.filename)
+
+def _save_stats(stats: Stats, path: str) -> None:
+    stats.save(filename=path)
 
-    stats = None
+def _save_scores(scores: typing.Dict[int,float], path: str) -> None:
+    with open(path, 'wb') as f:
+        pickle.dump(scores, f, protocol=pickle.HIGHEST_PROTOCOL)
 
-    if not os.path.exists(merged_path):
-        if stats is None:
-            logger.info('Loading stats: %s' % path)
-            stats = Stats.load(filename=path)
-        logger.info('Merging same text')
+def _load_scores(path: str) -> typing.Dict[int,float]:
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+def _merge_stage(paths, stats, params, store) -> Stats:
+    if stats is None:
+        logger.info('Loading stats: %s' % paths[0])
+        stats = _load_stats(paths[0], paths[0] + '.merged.sqlite', store)
+    logger.info('Merging same text')
+    with metrics.POSTPROCESS_SECONDS.time(stage='merge_same_text'):
         merge_same_text(stats)
-        logger.info('Merging similar trees with wildcards')
+    logger.info('Merging similar trees with wildcards')
+    with metrics.POSTPROCESS_SECONDS.time(stage='merge_similar'):
         merge_similar(stats)
-        logger.info('Saving stats (merged): %s' % merged_path)
-        stats.save(filename=merged_path)
-    
-    if not os.path.exists(ranked_path):
-        if stats is None:
-            logger.info('Loading stats (merged): %s' % merged_path)
-            stats = Stats.load(filename=merged_path)
-        logger.info('Ranking')
-        compute_ranking(stats)
-        logger.info('Saving stats (ranked): %s' % ranked_path)
-        stats.save(filename=ranked_path)
-
-    if not os.path.exists(pruned_path):
-        if stats is None:
-            logger.info('Loading stats (ranked): %s' % ranked_path)
-            stats = Stats.load(filename=ranked_path)
-        min_score = 0.8
-        logger.info('Pruning (min_score=%f)' % min_score)
-        logger.info('Before pruning: %d' % len(stats.totals))
-        prune(stats, min_score=min_score)
-        logger.info('After pruning: %d' % len(stats.totals))
-        logger.info('Saving stats (pruned): %s' % pruned_path)
-        stats.save(filename=pruned_path)
+    return stats
+
+def _scores_stage(paths, value, params) -> typing.Dict[int,float]:
+    logger.info('Computing scores: %s' % paths[0])
+    with metrics.POSTPROCESS_SECONDS.time(stage='scores'):
+        return compute_scores(paths[0])
+
+def _rank_stage(paths, stats, params, store) -> Stats:
+    if stats is None:
+        logger.info('Loading stats (merged): %s' % paths[0])
+        stats = _load_stats(paths[0], paths[0] + '.sqlite', store)
+    scores = _load_scores(paths[1])
+    logger.info('Ranking (approximate=%s)' % params['approximate'])
+    with metrics.POSTPROCESS_SECONDS.time(stage='ranking'):
+        compute_ranking(stats, approximate=params['approximate'], scores=scores)
+    return stats
+
+def _prune_stage(paths, stats, params, store) -> Stats:
+    if stats is None:
+        logger.info('Loading stats (ranked): %s' % paths[0])
+        stats = _load_stats(paths[0], paths[0] + '.sqlite', store)
+    logger.info('Pruning (min_score=%f)' % params['min_score'])
+    logger.info('Before pruning: %d' % len(stats.totals))
+    with metrics.POSTPROCESS_SECONDS.time(stage='prune'):
+        prune(stats, min_score=params['min_score'])
+    logger.info('After pruning: %d' % len(stats.totals))
+    return stats
+
+def _map_stage(paths, stats, params, store) -> Stats:
+    if stats is None:
+        logger.info('Loading stats (pruned): %s' % paths[0])
+        stats = _load_stats(paths[0], paths[0] + '.sqlite', store)
+    return stats
+
+def _save_mapped_model(stats: Stats, path: str) -> None:
+    with metrics.POSTPROCESS_SECONDS.time(stage='mapped_model'):
+        write_mapped_model(stats, path)
+
+def postprocess_stages(path: str, args, prefix: str='') -> typing.List[Stage]:
+    """
+    Return the stages turning the stats at path into a model:
+
+        stats -> merged -> ranked -> pruned -> mapped
+              -> scores -/
+
+    Stage names start with prefix.
+    """
+    merged_path = path + '_merged'
+    ranked_path = merged_path + '_ranked'
+    pruned_path = ranked_path + '_pruned'
+    mapped_path = pruned_path + '_mapped'
+    scores_path = path + '_scores'
+    store = getattr(args, 'stats_store', 'memory')
+    # stages depend on the whole package, as it is cheaper to run them
+    # again than to miss a module they use
+    code = package_sources(sys.modules[__package__])
+    return [
+        Stage(prefix + 'stats', path),
+        Stage(prefix + 'scores', scores_path,
+            inputs=[prefix + 'stats'],
+            run=_scores_stage,
+            save=_save_scores,
+            modules=code),
+        Stage(prefix + 'merged', merged_path,
+            inputs=[prefix + 'stats'],
+            run=functools.partial(_merge_stage, store=store),
+            save=_save_stats,
+            modules=code),
+        Stage(prefix + 'ranked', ranked_path,
+            inputs=[prefix + 'merged', prefix + 'scores'],
+            run=functools.partial(_rank_stage, store=store),
+            save=_save_stats,
+            params={'approximate': bool(getattr(args, 'approximate_ranking', False))},
+            modules=code),
+        Stage(prefix + 'pruned', pruned_path,
+            inputs=[prefix + 'ranked'],
+            run=functools.partial(_prune_stage, store=store),
+            save=_save_stats,
+            params={'min_score': getattr(args, 'min_score', DEFAULT_MIN_SCORE)},
+            modules=code),
+        Stage(prefix + 'mapped', mapped_path,
+            inputs=[prefix + 'pruned'],
+            run=functools.partial(_map_stage, store=store),
+            save=_save_mapped_model,
+            modules=code),
+    ]
+
+def postprocess(args):
+    """
+    Postprocess the stats of every language into its model. Only stages
+    whose inputs, parameters or code changed are run, and the stages of
+    different languages, or that do not depend on each other, run in
+    parallel.
+    """
+    if (getattr(args, 'stats_store', 'memory') == 'sqlite'
+            and not getattr(args, 'approximate_ranking', False)):
+        logger.warning('Exact ranking holds the score of every pattern in memory, '
+            'even with the sqlite store; use --approximate-ranking for models '
+            'larger than memory')
+    stages = []
+    for language in getattr(args, 'languages', None) or DEFAULT_LANGUAGES:
+        path = str(language_path(args.stats, language))
+        if not os.path.exists(path):
+            logger.info('No stats for %s: %s' % (language, path))
+            continue
+        stages += postprocess_stages(path, args, prefix='%s:' % language_dir(language))
+    workers = getattr(args, 'postprocess_workers', 1)
+    Pipeline(stages, release=_release_stats).run(workers=workers)
@@ -1,66 +1,431 @@
 
-import multiprocessing
+import os
+import pathlib
 import sys
+import typing
 
 import bblfsh
 from cachetools import LRUCache
 
+from . import metrics
+from .cache import DiskCache
+from .cache import UASTCache
+from .cache import get_parser_version
 from .extract import TreeExtractor
 from .git import *
+from .languages import language_path
+from .runs import is_run
+from .runs import merge_runs
+from .runs import read_last_commit
+from .scheduler import Job
+from .scheduler import Scheduler
 from .settings import *
 from .stats import *
 
 
+# Metrics writer of the current process, with the pid it was started in,
+# since forked workers inherit it without its thread.
+_metrics_writer: typing.Optional[typing.Tuple[int,metrics.PeriodicWriter]] = None
+
+def start_metrics_writer(name: str) -> metrics.PeriodicWriter:
+    """
+    Start writing the metrics of this process periodically to a file in
+    DEFAULT_METRICS_DIR, if not started yet.
+    """
+    global _metrics_writer
+    if _metrics_writer is None or _metrics_writer[0] != os.getpid():
+        DEFAULT_METRICS_DIR.mkdir(parents=True, exist_ok=True)
+        path = DEFAULT_METRICS_DIR / ('%s.prom' % name)
+        writer = metrics.PeriodicWriter(str(path), DEFAULT_METRICS_INTERVAL).start()
+        _metrics_writer = (os.getpid(), writer)
+    return _metrics_writer[1]
+
+# UAST cache of the current process, with the pid, directory and size it
+# was created with, so that it is created once per worker process.
+_uast_cache: typing.Optional[typing.Tuple[tuple,typing.Optional[UASTCache]]] = None
+
 class Preprocessor:
 
-    def __init__(self, bblfshd: str) -> None:
+    def __init__(self,
+            bblfshd: str,
+            languages: typing.List[str]=DEFAULT_LANGUAGES,
+            uast_cache_dir: typing.Optional[str]=None,
+            uast_cache_size: int=DEFAULT_UAST_CACHE_SIZE,
+            parse_concurrency: int=DEFAULT_PARSE_CONCURRENCY,
+            approximate_counting: typing.Optional[typing.Dict[str,float]]=None,
+            history_chunk_size: int=0) -> None:
+        """
+        Stats are kept per language, for the given languages. If
+        approximate_counting is given, repositories are counted with
+        ApproximateStats, with these arguments.
+
+        If history_chunk_size is positive, longer histories are split in
+        chunks of that many commits, which can be trained by different
+        workers.
+        """
         self._bblfshd = bblfshd
+        self._languages = languages
+        self._uast_cache_dir = uast_cache_dir
+        self._uast_cache_size = uast_cache_size
+        self._parse_concurrency = parse_concurrency
+        self._approximate_counting = approximate_counting
+        self._history_chunk_size = history_chunk_size
+
+    def _get_uast_cache(self, client: bblfsh.BblfshClient) -> typing.Optional[UASTCache]:
+        """
+        Return the UAST cache of this process, creating it on first use:
+        opening it scans the whole cache directory.
+        """
+        global _uast_cache
+        if self._uast_cache_dir is None:
+            return None
+        key = (os.getpid(), self._uast_cache_dir, self._uast_cache_size)
+        if _uast_cache is None or _uast_cache[0] != key:
+            cache = None
+            parser_version = get_parser_version(client)
+            if parser_version is None:
+                logger.warning('UAST cache disabled: unknown parser version')
+            else:
+                cache = UASTCache(
+                    DiskCache(self._uast_cache_dir, self._uast_cache_size),
+                    parser_version)
+            _uast_cache = (key, cache)
+        return _uast_cache[1]
+
+    def plan(self, repo_name: str) -> typing.List['Walk']:
+        """
+        Clone or update a repository and return the walks of its history
+        to train. Languages trained up to the same commit share a walk.
+        """
+        languages_per_since: typing.Dict[typing.Optional[str],typing.List[str]] = {}
+        for language in self._languages:
+            stats_path = _repo_path(repo_name, language, 'stats.db')
+            stats_path.parent.mkdir(parents=True, exist_ok=True)
+            since = None
+            if stats_path.exists():
+                since = _last_commit(stats_path, repo_name)
+                if since is None:
+                    logger.info('Stats without last commit for %s (%s), skipping' % (
+                        repo_name, language))
+                    continue
+            languages_per_since.setdefault(since, []).append(language)
+        if not languages_per_since:
+            return []
+
+        update = any(since is not None for since in languages_per_since)
+        repo = GitRepository(
+            repo=get_repository(repo_name, update=update),
+            client=None,
+            filters=[])
+        walks = []
+        for since, languages in languages_per_since.items():
+            history = repo.history(since)
+            if history is None:
+                continue
+            head, commits = history
+            if not commits:
+                logger.info('No new commits for %s (%s)' % (repo_name, ', '.join(languages)))
+                continue
+            walks.append(Walk(repo_name, languages, since, head, commits))
+        return walks
+
+    def chunks(self, walk: 'Walk') -> typing.List['Chunk']:
+        """
+        Split a walk in chunks of at most history_chunk_size commits.
+        """
+        size = self._history_chunk_size
+        if size <= 0 or len(walk.commits) <= size:
+            size = len(walk.commits)
+        elif self._approximate_counting is not None:
+            logger.warning('%s: approximate counts cannot be split, training %d commits in one chunk' % (
+                walk.repo_name, len(walk.commits)))
+            size = len(walk.commits)
+        return [Chunk(walk.repo_name, walk.languages, walk.head, n, walk.commits[i:i + size])
+            for n, i in enumerate(range(0, len(walk.commits), size))]
 
-    def main_per_repository(self, repo_name: str) -> None:
-        STATS_PATH = DEFAULT_STATS_DIR / repo_name / 'stats.db'
-        STATS_PATH.parent.mkdir(parents=True, exist_ok=True)
-        if STATS_PATH.exists():
-            logger.info('Stats already exist for %s' % repo_name)
-            return
+    def train_chunk(self, chunk: 'Chunk') -> None:
+        writer = start_metrics_writer('train-worker-%d' % os.getpid())
+        try:
+            self._train_chunk(chunk)
+        finally:
+            writer.flush()
 
-        stats = Stats()
+    def _train_chunk(self, chunk: 'Chunk') -> None:
+        repo_name = chunk.repo_name
+        stats_per_language: typing.Dict[str,Stats] = {}
+        for language in chunk.languages:
+            if self._approximate_counting is None:
+                stats_per_language[language] = Stats()
+            else:
+                stats_per_language[language] = ApproximateStats(**self._approximate_counting)
         client = bblfsh.BblfshClient(self._bblfshd)
-        repo = get_repository(repo_name)
         trainer = GitRepositoryTrainer(
-            repo=repo,
+            repo=get_repository(repo_name),
             repo_name=repo_name,
             client=client,
-            stats=stats,
+            stats=stats_per_language,
             filters=[
                 VendorFilter(),
-                LanguageFilter(['Go']),
-                MaxSizeFilter(max_size=10*1024)]
+                LanguageFilter(chunk.languages),
+                MaxSizeFilter(max_size=10*1024)],
+            uast_cache=self._get_uast_cache(client),
+            parse_concurrency=self._parse_concurrency
         )
-        trainer.train_all()
-        logger.info('saving stats: %s' % STATS_PATH)
-        stats.save(filename=STATS_PATH)
-        logger.info('saved stats: %s' % STATS_PATH)
+        logger.info('%s: training chunk %d (%d commits)' % (
+            repo_name, chunk.index, len(chunk.commits)))
+        trainer.train_commits(chunk.head, chunk.commits)
+        for language, stats in stats_per_language.items():
+            if isinstance(stats, ApproximateStats):
+                logger.info('%s (%s): promoted %d patterns, %d candidates left' % (
+                    repo_name, language, stats.promoted, len(stats.candidates)))
+            stats.save_run(filename=_chunk_path(repo_name, language, chunk.index))
+
+    def finish(self, walk: 'Walk', n_chunks: int) -> None:
+        """
+        Merge the stats of the chunks of a walk, in order, and save them.
+        """
+        for language in walk.languages:
+            chunk_paths = [_chunk_path(walk.repo_name, language, n) for n in range(n_chunks)]
+            new_path = _repo_path(walk.repo_name, language, 'new.db')
+            if n_chunks == 1:
+                os.replace(str(chunk_paths[0]), str(new_path))
+            else:
+                logger.info('%s (%s): merging %d chunks' % (walk.repo_name, language, n_chunks))
+                merge_runs([str(p) for p in chunk_paths], str(new_path))
+                for path in chunk_paths:
+                    path.unlink()
+            _save_repo_stats(walk.repo_name, language, walk.since)
+
+    def discard(self, walk: 'Walk', n_chunks: int) -> None:
+        """
+        Remove the stats of the chunks of a walk that is not saved.
+        """
+        for language in walk.languages:
+            for n in range(n_chunks):
+                path = _chunk_path(walk.repo_name, language, n)
+                if path.exists():
+                    path.unlink()
+
+
+class Walk(typing.NamedTuple):
+    """
+    Commits of the history of a repository to train the given languages
+    with, from since (excluded) to head.
+    """
+    repo_name: str
+    languages: typing.List[str]
+    since: typing.Optional[str]
+    head: str
+    commits: typing.List[str]
+
+class Chunk(typing.NamedTuple):
+    """
+    Consecutive commits of a walk, trained by one worker.
+    """
+    repo_name: str
+    languages: typing.List[str]
+    head: str
+    index: int
+    commits: typing.List[str]
+
+def _save_repo_stats(
+        repo_name: str,
+        language: str,
+        since: typing.Optional[str]) -> None:
+    """
+    Save the new stats of a repository (new.db), trained since the given
+    commit.
+    """
+    STATS_PATH = _repo_path(repo_name, language, 'stats.db')
+    DELTA_PATH = _repo_path(repo_name, language, 'delta.db')
+    NEW_PATH = _repo_path(repo_name, language, 'new.db')
+
+    # The delta holds the changes not merged into the global stats yet.
+    # The per-repository stats are updated last, they are the commit
+    # point of this run.
+    logger.info('saving stats (delta since %s): %s' % (since, NEW_PATH))
+    if DELTA_PATH.exists() and not _is_merged(DELTA_PATH, repo_name, language):
+        merge_runs([str(DELTA_PATH), str(NEW_PATH)], str(DELTA_PATH))
+    else:
+        merge_runs([str(NEW_PATH)], str(DELTA_PATH))
+    if since is None:
+        os.replace(str(NEW_PATH), str(STATS_PATH))
+    else:
+        merge_runs([str(STATS_PATH), str(NEW_PATH)], str(STATS_PATH))
+        NEW_PATH.unlink()
+    logger.info('saved stats: %s' % STATS_PATH)
+
+def _chunk_path(repo_name: str, language: str, index: int) -> pathlib.Path:
+    return _repo_path(repo_name, language, 'chunk-%d.db' % index)
+
+def _repo_path(repo_name: str, language: str, name: str) -> pathlib.Path:
+    return language_path(DEFAULT_STATS_DIR / repo_name / name, language)
+
+def _global_path(language: str) -> pathlib.Path:
+    return language_path(DEFAULT_STATS_PATH, language)
+
+def _migrate_legacy_layout(repo_list: typing.List[str]) -> None:
+    """
+    Move stats from before per-language models, which were Go only, to
+    the Go directories.
+    """
+    paths = [(DEFAULT_STATS_PATH, _global_path('Go'))]
+    for repo_name in repo_list:
+        for name in ('stats.db', 'delta.db'):
+            paths.append((DEFAULT_STATS_DIR / repo_name / name, _repo_path(repo_name, 'Go', name)))
+    for old_path, new_path in paths:
+        if old_path.exists() and not new_path.exists():
+            logger.info('Moving stats to per-language layout: %s -> %s' % (old_path, new_path))
+            new_path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(str(old_path), str(new_path))
+
+def _last_commit(path: pathlib.Path, repo_name: str) -> typing.Optional[str]:
+    if not path.exists() or not is_run(str(path)):
+        return None
+    return read_last_commit(str(path)).get(repo_name)
+
+def _is_merged(delta_path: pathlib.Path, repo_name: str, language: str) -> bool:
+    """
+    Whether the delta was already merged into the global stats.
+    """
+    global_commit = _last_commit(_global_path(language), repo_name)
+    return global_commit is not None and global_commit == _last_commit(delta_path, repo_name)
+
+def _pending_deltas(
+        repo_list: typing.List[str],
+        language: str) -> typing.Optional[typing.List[str]]:
+    """
+    Return the deltas to merge into the global stats of a language to
+    bring them up to date with the per-repository stats, or None if the
+    global stats must be merged again from scratch.
+    """
+    global_path = _global_path(language)
+    if not global_path.exists() or not is_run(str(global_path)):
+        return None
+    global_commits = read_last_commit(str(global_path))
+    deltas = []
+    for repo_name in repo_list:
+        stats_path = _repo_path(repo_name, language, 'stats.db')
+        delta_path = _repo_path(repo_name, language, 'delta.db')
+        commit = _last_commit(stats_path, repo_name)
+        if commit == global_commits.get(repo_name):
+            continue
+        if _last_commit(delta_path, repo_name) != commit:
+            logger.info('Delta of %s (%s) is missing or inconsistent' % (repo_name, language))
+            return None
+        deltas.append(str(delta_path))
+    return deltas
+
+def _repository_size(repo_name: str) -> int:
+    """
+    Return the size of the objects of the local clone of a repository, or
+    0 if it is not cloned yet.
+    """
+    size = 0
+    for root, _, files in os.walk(str(DEFAULT_REPO_DIR / repo_name / 'objects')):
+        for name in files:
+            size += os.path.getsize(os.path.join(root, name))
+    return size
+
+def _approximate_counting(args) -> typing.Optional[typing.Dict[str,float]]:
+    if not getattr(args, 'approximate_counting', False):
+        return None
+    return {
+        'epsilon': args.count_epsilon,
+        'delta': args.count_delta,
+        'capacity': args.count_capacity,
+        'min_count': args.count_min,
+    }
+
+def _languages(args) -> typing.List[str]:
+    return getattr(args, 'languages', None) or DEFAULT_LANGUAGES
 
 def preprocess(args):
     bblfshd = args.bblfshd
     repo_list_path = args.repositories
+    languages = _languages(args)
     DEFAULT_REPO_DIR.mkdir(parents=True, exist_ok=True)
     DEFAULT_STATS_DIR.mkdir(parents=True, exist_ok=True)
     logger.info('Reading repository list from %s' % repo_list_path)
     with open(repo_list_path, 'r') as f:
         repo_list = f.read().splitlines()
-    logger.info('Start repository analysis with %d workers' % DEFAULT_WORKERS)
-    with multiprocessing.Pool(processes=DEFAULT_WORKERS) as pool:
-        preprocessor = Preprocessor(bblfshd=bblfshd)
-        pool.map(preprocessor.main_per_repository, repo_list)
+    _migrate_legacy_layout(repo_list)
+    logger.info('Start repository analysis with %d workers (languages: %s)' % (
+        DEFAULT_WORKERS, ', '.join(languages)))
+    preprocessor = Preprocessor(
+        bblfshd=bblfshd,
+        languages=languages,
+        uast_cache_dir=args.uast_cache,
+        uast_cache_size=args.uast_cache_size,
+        parse_concurrency=args.parse_concurrency,
+        approximate_counting=_approximate_counting(args),
+        history_chunk_size=getattr(args, 'history_chunk_size', 0))
+    retries = getattr(args, 'retries', DEFAULT_JOB_RETRIES)
+
+    # clone or update repositories, the largest clones first
+    scheduler = Scheduler(preprocessor.plan, DEFAULT_WORKERS, retries, unit='bytes')
+    plans = scheduler.run(Job('plan %s' % r, r, _repository_size(r), (r,)) for r in repo_list)
+    walks = [w for r in repo_list for w in plans.get('plan %s' % r, [])]
+
+    # train chunks, the longest first
+    walk_chunks = [preprocessor.chunks(w) for w in walks]
+    jobs = []
+    for walk, chunks in zip(walks, walk_chunks):
+        for chunk in chunks:
+            jobs.append(Job(
+                '%s [%s] chunk %d/%d' % (walk.repo_name, ', '.join(walk.languages),
+                    chunk.index + 1, len(chunks)),
+                walk.repo_name, len(chunk.commits), (chunk,)))
+    logger.info('Training %d walks in %d chunks' % (len(walks), len(jobs)))
+    scheduler = Scheduler(preprocessor.train_chunk, DEFAULT_WORKERS, retries)
+    scheduler.run(jobs)
+    scheduler.report()
+    failed = set(job.args[0].repo_name for job in scheduler.failed)
+    if failed:
+        logger.error('Failed repositories: %s' % ', '.join(sorted(failed)))
+
+    # walks with a failed chunk are left as they were, to be trained again
+    for walk, chunks in zip(walks, walk_chunks):
+        if walk.repo_name in failed:
+            preprocessor.discard(walk, len(chunks))
+    scheduler = Scheduler(preprocessor.finish, DEFAULT_WORKERS, retries)
+    scheduler.run(Job('save %s [%s]' % (w.repo_name, ', '.join(w.languages)),
+        w.repo_name, len(w.commits), (w, len(cs)))
+        for w, cs in zip(walks, walk_chunks) if w.repo_name not in failed)
     logger.info('Finished repository analysis')
 
-    logger.info('Merge stats')
-    global_stats = Stats()
-    for repo_name in repo_list:
-        local_stats = Stats.load(DEFAULT_STATS_DIR / repo_name / 'stats.db')
-        global_stats += local_stats
-    logger.info('Saving merged stats')
-    global_stats.save(DEFAULT_STATS_PATH)
-    logger.info('Saved merged stats')
+    for language in languages:
+        merge_language(repo_list, language)
 
+def merge_language(repo_list: typing.List[str], language: str) -> None:
+    """
+    Merge the per-repository stats of a language into its global stats.
+    """
+    global_path = _global_path(language)
+    global_path.parent.mkdir(parents=True, exist_ok=True)
+    deltas = _pending_deltas(repo_list, language)
+    if deltas is None:
+        logger.info('Merge stats (%s)' % language)
+        run_paths = []
+        for repo_name in repo_list:
+            path = str(_repo_path(repo_name, language, 'stats.db'))
+            if not os.path.exists(path):
+                logger.info('No stats for %s (%s)' % (repo_name, language))
+                continue
+            if not is_run(path):
+                logger.info('Converting stats to run: %s' % path)
+                Stats.load(path).save_run(path)
+            run_paths.append(path)
+        merge_runs(run_paths, str(global_path), workers=DEFAULT_WORKERS)
+    elif len(deltas) == 0:
+        logger.info('Merged stats are up to date (%s)' % language)
+        return
+    else:
+        logger.info('Merge stats (%s, deltas: %d)' % (language, len(deltas)))
+        merge_runs([str(global_path)] + deltas,
+            str(global_path), workers=DEFAULT_WORKERS)
+    for repo_name in repo_list:
+        delta_path = _repo_path(repo_name, language, 'delta.db')
+        if delta_path.exists():
+            delta_path.unlink()
+    logger.info('Saved merged stats: %s' % global_path)
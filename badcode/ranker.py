@@ -1,26 +1,145 @@
+import bisect
+from typing import List, Tuple
 
 
 class Ranker:
+    """
+    Computes the percentile of each element by its score, that is, the
+    fraction of elements with a strictly lower score.
+
+    Only scores are kept, elements are scored again on get.
+    """
+
     def __init__(self, scoring):
         self.scoring = scoring
-        self.scores = {}
+        self.scores = []
         self.percentiles = {}
 
     def add(self, element):
         score = self.scoring(element)
-        self.scores[id(element)] = score
-    
+        self.scores.append(score)
+
     def finalize(self):
-        sorted_scores = sorted(self.scores.values())
+        sorted_scores = sorted(self.scores)
         total = len(sorted_scores)
         for idx, score in enumerate(sorted_scores):
             if score in self.percentiles:
                 continue
-            below = len([1 for s in sorted_scores[:idx] if s < score])
-            percentile = float(below) / total
+            percentile = float(idx) / total
             self.percentiles[score] = percentile
+        self.scores = []
 
     def get(self, element):
-        score = self.scores[id(element)]
+        score = self.scoring(element)
         percentile = self.percentiles[score]
         return percentile
+
+
+class StreamingRanker:
+    """
+    Approximate Ranker using a TDigest, with memory bounded by the
+    compression parameter instead of the number of elements.
+    """
+
+    def __init__(self, scoring, compression: int=100):
+        self.scoring = scoring
+        self.digest = TDigest(compression=compression)
+
+    def add(self, element):
+        self.digest.add(self.scoring(element))
+
+    def finalize(self):
+        self.digest.compress()
+
+    def get(self, element):
+        return self.digest.rank(self.scoring(element)) / self.digest.count
+
+
+class TDigest:
+    """
+    Merging t-digest, a streaming sketch to approximate ranks.
+
+    Values are summarized as centroids (mean, weight). Centroids are small
+    near the extremes and bigger around the median, with at most about
+    2 * compression centroids. The rank error is lower near the extremes,
+    which is where percentiles are used for pruning.
+
+    See: Dunning & Ertl, Computing Extremely Accurate Quantiles Using
+    t-Digests (2019).
+    """
+
+    def __init__(self, compression: int=100) -> None:
+        self.compression = compression
+        self.count = 0
+        self._centroids: List[Tuple[float,int]] = []
+        self._buffer: List[float] = []
+        self._means: List[float] = []
+        self._cumulative: List[int] = []
+        self._min = float('inf')
+        self._max = float('-inf')
+
+    def add(self, value: float) -> None:
+        self._buffer.append(value)
+        self.count += 1
+        if value < self._min:
+            self._min = value
+        if value > self._max:
+            self._max = value
+        if len(self._buffer) >= 10 * self.compression:
+            self.compress()
+
+    def compress(self) -> None:
+        if not self._buffer:
+            return
+        points = sorted(self._centroids + [(v, 1) for v in self._buffer])
+        self._buffer = []
+        centroids: List[Tuple[float,int]] = []
+        before = 0
+        for mean, weight in points:
+            if centroids:
+                last_mean, last_weight = centroids[-1]
+                new_weight = last_weight + weight
+                q = (before + new_weight / 2.0) / self.count
+                if new_weight <= 4.0 * self.count * q * (1.0 - q) / self.compression:
+                    centroids[-1] = (
+                        last_mean + (mean - last_mean) * weight / new_weight,
+                        new_weight)
+                    continue
+                before += last_weight
+            centroids.append((mean, weight))
+        self._centroids = centroids
+        self._means = [mean for mean, _ in centroids]
+        self._cumulative = [0]
+        for _, weight in centroids:
+            self._cumulative.append(self._cumulative[-1] + weight)
+
+    def rank(self, value: float) -> float:
+        """
+        Return the approximate number of values strictly lower than the
+        given one. Centroids with more than one value are assumed to spread
+        their values uniformly up to the midpoints with their neighbours.
+        """
+        self.compress()
+        if self.count == 0 or value <= self._min:
+            return 0.0
+        if value > self._max:
+            return float(self.count)
+        idx = bisect.bisect_left(self._means, value)
+        rank = float(self._cumulative[idx])
+        if idx > 0:
+            lo, hi = self._spread(idx - 1)
+            weight = self._centroids[idx - 1][1]
+            if weight > 1 and value < hi:
+                rank -= weight * (hi - value) / (hi - lo)
+        if idx < len(self._centroids):
+            lo, hi = self._spread(idx)
+            weight = self._centroids[idx][1]
+            if weight > 1 and value > lo:
+                rank += weight * (value - lo) / (hi - lo)
+        return rank
+
+    def _spread(self, idx: int) -> Tuple[float,float]:
+        mean = self._means[idx]
+        lo = self._min if idx == 0 else (self._means[idx - 1] + mean) / 2.0
+        hi = self._max if idx == len(self._means) - 1 else (mean + self._means[idx + 1]) / 2.0
+        return lo, hi
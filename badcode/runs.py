@@ -0,0 +1,287 @@
+"""
+Sorted runs of pattern records, used to merge stats from many repositories
+with a streaming k-way merge instead of loading them all in memory.
+
+A run is a file with a header followed by records sorted by the
+fingerprint of their pattern (see Tree.fingerprint). The header holds the list of repositories and the
+last commit processed for each of them. Each record is a tuple:
+
+    (hash, order, uast, text, totals, per_repo)
+
+where totals maps stat names to counts and per_repo maps repository names
+to (order, counts) tuples. text and totals are None if the pattern has
+none. order is a (totals order, text order) tuple. Orders are the
+position where the pattern was first seen, so that stats rebuilt from a
+merged run keep the same order as if they were merged in memory.
+
+Records are bucketed by the top bits of their hash, and an index of
+bucket offsets at the end of the file allows merging disjoint bucket
+ranges in parallel.
+"""
+
+import collections
+import heapq
+import itertools
+import multiprocessing
+import os
+import pickle
+import struct
+from typing import Any, Dict, Generator, Iterable, List, Optional, Tuple
+
+from .bblfshutil import UAST
+
+MAGIC = b'BADCODER'
+VERSION = 3
+BUCKET_BITS = 8
+N_BUCKETS = 1 << BUCKET_BITS
+
+_HEADER = struct.Struct('<8sI')
+_LENGTH = struct.Struct('<I')
+_OFFSET = struct.Struct('<Q')
+
+Record = Tuple[int,Tuple[Any,Any],UAST,Optional[str],Optional[Dict[str,int]],Dict[str,Tuple[Any,Dict[str,int]]]]
+
+
+def stable_hash(uast: UAST) -> int:
+    """
+    Return a 64-bit hash of the tree that is the same across processes.
+    """
+    return uast.fingerprint
+
+def bucket(h: int) -> int:
+    return h >> (64 - BUCKET_BITS)
+
+def is_run(filename: str) -> bool:
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class RunWriter:
+    """
+    Writes records, which must be added sorted by hash.
+    """
+
+    def __init__(self,
+            filename: str,
+            repos: Iterable[str],
+            last_commit: Optional[Dict[str,str]]=None) -> None:
+        self.filename = filename
+        self._tmp_filename = '%s.tmp' % filename
+        self._f = open(self._tmp_filename, 'wb')
+        self._f.write(_HEADER.pack(MAGIC, VERSION))
+        header = {'repos': list(repos), 'last_commit': dict(last_commit or {})}
+        self._write_blob(pickle.dumps(header, protocol=pickle.HIGHEST_PROTOCOL))
+        self._offsets: List[int] = []
+
+    def _write_blob(self, data: bytes) -> None:
+        self._f.write(_LENGTH.pack(len(data)))
+        self._f.write(data)
+
+    def _start_buckets(self, until: int) -> None:
+        while len(self._offsets) < until:
+            self._offsets.append(self._f.tell())
+
+    def write(self, record: Record) -> None:
+        self._start_buckets(bucket(record[0]) + 1)
+        self._write_blob(pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def write_raw(self, first_bucket: int, offsets: List[int], data: bytes) -> None:
+        """
+        Append already encoded records, starting at first_bucket, with
+        their bucket offsets relative to the start of data.
+        """
+        self._start_buckets(first_bucket)
+        base = self._f.tell()
+        self._offsets.extend(base + offset for offset in offsets)
+        self._f.write(data)
+
+    def close(self) -> None:
+        self._start_buckets(N_BUCKETS)
+        index_offset = self._f.tell()
+        self._offsets.append(index_offset)
+        for offset in self._offsets:
+            self._f.write(_OFFSET.pack(offset))
+        self._f.write(_OFFSET.pack(index_offset))
+        self._f.close()
+        os.replace(self._tmp_filename, self.filename)
+
+
+def read_version(filename: str) -> int:
+    with open(filename, 'rb') as f:
+        _, version = _HEADER.unpack(f.read(_HEADER.size))
+    return version
+
+def upgrade_run(filename: str) -> None:
+    """
+    Rewrite a run written before version 3, whose records are keyed by an
+    older hash, in place. It loads the whole run in memory.
+    """
+    if read_version(filename) >= 3:
+        return
+    header = read_header(filename)
+    records = [(stable_hash(r[2]),) + tuple(r[1:]) for r in read_run(filename)]
+    records.sort(key=lambda r: r[0])
+    writer = RunWriter(filename, header['repos'], header['last_commit'])
+    for record in records:
+        writer.write(record)
+    writer.close()
+
+def read_header(filename: str) -> Dict[str,Any]:
+    with open(filename, 'rb') as f:
+        _, version = _HEADER.unpack(f.read(_HEADER.size))
+        length, = _LENGTH.unpack(f.read(_LENGTH.size))
+        header = pickle.loads(f.read(length))
+    if version == 1:
+        header = {'repos': header, 'last_commit': {}}
+    return header
+
+def read_repos(filename: str) -> List[str]:
+    return read_header(filename)['repos']
+
+def read_last_commit(filename: str) -> Dict[str,str]:
+    """
+    Return the last commit processed for each repository in the run.
+    """
+    return read_header(filename)['last_commit']
+
+def _read_index(f) -> List[int]:
+    f.seek(-_OFFSET.size, os.SEEK_END)
+    index_offset, = _OFFSET.unpack(f.read(_OFFSET.size))
+    f.seek(index_offset)
+    data = f.read((N_BUCKETS + 1) * _OFFSET.size)
+    return [o for o, in _OFFSET.iter_unpack(data)]
+
+def read_raw(
+        filename: str,
+        first_bucket: int=0,
+        last_bucket: int=N_BUCKETS) -> Generator[bytes,None,None]:
+    """
+    Read encoded records in the bucket range [first_bucket, last_bucket).
+    """
+    with open(filename, 'rb') as f:
+        header = f.read(_HEADER.size)
+        magic, version = _HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError('not a run: %s' % filename)
+        if version < 1 or version > VERSION:
+            raise ValueError('unsupported run version %d: %s' % (version, filename))
+        index = _read_index(f)
+        start = index[first_bucket]
+        end = index[last_bucket]
+        f.seek(start)
+        while f.tell() < end:
+            length, = _LENGTH.unpack(f.read(_LENGTH.size))
+            yield f.read(length)
+
+def read_run(
+        filename: str,
+        first_bucket: int=0,
+        last_bucket: int=N_BUCKETS) -> Generator[Record,None,None]:
+    for data in read_raw(filename, first_bucket, last_bucket):
+        yield pickle.loads(data)
+
+def _min_order(run_idx: int, order: Any, other: Any) -> Any:
+    if order is None:
+        return other
+    order = (run_idx, order)
+    if other is None or order < other:
+        return order
+    return other
+
+def merge_records(records: Iterable[Tuple[int,Record]]) -> List[Record]:
+    """
+    Merge records with the same hash, given with the index of the run they
+    come from, in run order. Returns one record per distinct pattern.
+    """
+    merged: List[Record] = []
+    for run_idx, (h, order, uast, text, totals, per_repo) in records:
+        for n, other in enumerate(merged):
+            if other[2] == uast:
+                break
+        else:
+            merged.append((h, (None, None), uast, None, None, {}))
+            n = len(merged) - 1
+        _, m_order, m_uast, m_text, m_totals, m_per_repo = merged[n]
+        m_order = (
+            _min_order(run_idx, order[0], m_order[0]),
+            _min_order(run_idx, order[1], m_order[1]))
+        if m_text is None:
+            m_text = text
+        if totals is not None:
+            if m_totals is None:
+                m_totals = collections.defaultdict(int)
+            for k, v in totals.items():
+                m_totals[k] += v
+        for repo, (repo_order, counts) in per_repo.items():
+            m_repo_order, m_counts = m_per_repo.get(repo, (None, None))
+            if m_counts is None:
+                m_counts = collections.defaultdict(int)
+            for k, v in counts.items():
+                m_counts[k] += v
+            m_per_repo[repo] = (_min_order(run_idx, repo_order, m_repo_order), m_counts)
+        merged[n] = (h, m_order, m_uast, m_text, m_totals, m_per_repo)
+    return merged
+
+def _merge_range(
+        filenames: List[str],
+        first_bucket: int,
+        last_bucket: int) -> Generator[Record,None,None]:
+    def keyed(idx, filename):
+        for record in read_run(filename, first_bucket, last_bucket):
+            yield (record[0], idx, record)
+    streams = [keyed(idx, filename) for idx, filename in enumerate(filenames)]
+    merged = heapq.merge(*streams, key=lambda x: (x[0], x[1]))
+    for _, group in itertools.groupby(merged, key=lambda x: x[0]):
+        for record in merge_records((idx, record) for _, idx, record in group):
+            yield record
+
+def _merge_range_raw(args: Tuple[List[str],int,int]) -> Tuple[int,List[int],bytes]:
+    filenames, first_bucket, last_bucket = args
+    offsets: List[int] = []
+    data = bytearray()
+    for record in _merge_range(filenames, first_bucket, last_bucket):
+        while len(offsets) <= bucket(record[0]) - first_bucket:
+            offsets.append(len(data))
+        encoded = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        data += _LENGTH.pack(len(encoded))
+        data += encoded
+    while len(offsets) < last_bucket - first_bucket:
+        offsets.append(len(data))
+    return first_bucket, offsets, bytes(data)
+
+def merge_runs(filenames: List[str], output: str, workers: int=1) -> None:
+    """
+    Merge runs into a single run with a streaming k-way merge. If several
+    runs have a last commit for the same repository, the last one wins.
+
+    With one worker, memory is bounded by one record per input run. With
+    more workers, disjoint bucket ranges are merged in parallel and each
+    worker keeps its merged range in memory until it is written.
+
+    Runs of older versions are upgraded in place first.
+    """
+    for filename in filenames:
+        upgrade_run(filename)
+    repos: List[str] = []
+    last_commit: Dict[str,str] = {}
+    seen = set([])
+    for filename in filenames:
+        header = read_header(filename)
+        for repo in header['repos']:
+            if repo not in seen:
+                seen.add(repo)
+                repos.append(repo)
+        last_commit.update(header['last_commit'])
+
+    writer = RunWriter(output, repos, last_commit)
+    if workers <= 1:
+        for record in _merge_range(filenames, 0, N_BUCKETS):
+            writer.write(record)
+    else:
+        n_ranges = min(N_BUCKETS, workers * 4)
+        bounds = [N_BUCKETS * i // n_ranges for i in range(n_ranges + 1)]
+        ranges = [(filenames, bounds[i], bounds[i + 1]) for i in range(n_ranges)]
+        with multiprocessing.Pool(processes=workers) as pool:
+            for first_bucket, offsets, data in pool.imap(_merge_range_raw, ranges):
+                writer.write_raw(first_bucket, offsets, data)
+    writer.close()
@@ -0,0 +1,152 @@
+"""
+Scheduler of jobs with an estimated cost over worker processes.
+"""
+
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from concurrent.futures import wait
+import collections
+import time
+import typing
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .settings import *
+
+
+class Job(typing.NamedTuple):
+    """
+    A call of the scheduled function with args. cost is the estimated
+    amount of work, in the unit of the scheduler, and group the name its
+    throughput is reported under, e.g. a repository.
+    """
+    key: str
+    group: str
+    cost: float
+    args: tuple
+
+
+class Scheduler:
+    """
+    Runs jobs in up to workers processes, largest first. A worker takes
+    the next job as soon as it is idle, so the largest jobs start early
+    and the smaller ones fill in the gaps at the end.
+
+    A job that fails, or whose process dies, is retried up to retries
+    times, each time alone in a new process, so that a job crashing its
+    process does not fail the jobs running next to it again. Jobs whose
+    shared process pool broke are retried alone first, without counting
+    it as an attempt, since any job in the pool may have broken it.
+    """
+
+    def __init__(self,
+            func: Callable[...,Any],
+            workers: int,
+            retries: int=DEFAULT_JOB_RETRIES,
+            unit: str='commits') -> None:
+        self.func = func
+        self.workers = workers
+        self.retries = retries
+        self.unit = unit
+        self.failed: List[Job] = []
+        # per group: cost and seconds of the jobs done
+        self.throughput: Dict[str,List[float]] = collections.OrderedDict()
+
+    def run(self, jobs: typing.Iterable[Job]) -> Dict[str,Any]:
+        """
+        Run the jobs and return their results by key. Jobs that failed
+        every attempt are left in failed.
+        """
+        queue = collections.deque(sorted(jobs, key=lambda j: j.cost, reverse=True))
+        retry: typing.Deque[Tuple[Job,int]] = collections.deque()
+        # future -> job, attempt, executor, whether it is alone in it, start time
+        running: Dict[Future,Tuple[Job,int,ProcessPoolExecutor,bool,float]] = {}
+        shared: Optional[ProcessPoolExecutor] = None
+        results: Dict[str,Any] = {}
+        self.failed = []
+        start = time.monotonic()
+        busy = 0.0
+        try:
+            while queue or retry or running:
+                while len(running) < self.workers and (queue or retry):
+                    alone = bool(retry)
+                    if alone:
+                        job, attempt = retry.popleft()
+                        executor = ProcessPoolExecutor(max_workers=1)
+                    else:
+                        job, attempt = queue.popleft(), 0
+                        if shared is None:
+                            shared = ProcessPoolExecutor(max_workers=self.workers)
+                        executor = shared
+                    future = executor.submit(self.func, *job.args)
+                    running[future] = (job, attempt, executor, alone, time.monotonic())
+
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    job, attempt, executor, alone, job_start = running.pop(future)
+                    elapsed = time.monotonic() - job_start
+                    if alone:
+                        executor.shutdown(wait=False)
+                    try:
+                        results[job.key] = future.result()
+                    except BrokenProcessPool as exc:
+                        if alone:
+                            self._failed(job, attempt, exc, retry)
+                            continue
+                        # every job in the pool fails with it, so the
+                        # jobs are not charged until they fail alone
+                        if executor is shared:
+                            shared.shutdown(wait=False)
+                            shared = None
+                        logger.warning('%s failed (%s: %s), retrying alone' % (
+                            job.key, type(exc).__name__, exc))
+                        retry.append((job, attempt))
+                        continue
+                    except Exception as exc:
+                        self._failed(job, attempt, exc, retry)
+                        continue
+                    busy += elapsed
+                    self._done(job, elapsed)
+        finally:
+            if shared is not None:
+                shared.shutdown()
+        wall = time.monotonic() - start
+        if results:
+            logger.info('Ran %d jobs in %.1fs, %.1fs of work over %d workers (%.0f%% busy)' % (
+                len(results), wall, busy, self.workers,
+                100.0 * busy / max(wall * self.workers, 1e-9)))
+        return results
+
+    def _failed(self,
+            job: Job,
+            attempt: int,
+            exc: Exception,
+            retry: typing.Deque[Tuple[Job,int]]) -> None:
+        if attempt < self.retries:
+            logger.warning('%s failed (%s: %s), retrying alone' % (
+                job.key, type(exc).__name__, exc))
+            retry.append((job, attempt + 1))
+        else:
+            logger.error('%s failed (%s: %s), giving up' % (
+                job.key, type(exc).__name__, exc))
+            self.failed.append(job)
+
+    def _done(self, job: Job, elapsed: float) -> None:
+        totals = self.throughput.setdefault(job.group, [0.0, 0.0])
+        totals[0] += job.cost
+        totals[1] += elapsed
+        logger.info('%s: %d %s in %.1fs (%.1f %s/s, %s: %.1f %s/s)' % (
+            job.key, job.cost, self.unit, elapsed,
+            job.cost / max(elapsed, 1e-9), self.unit,
+            job.group, totals[0] / max(totals[1], 1e-9), self.unit))
+
+    def report(self) -> None:
+        """
+        Log the throughput of every group, slowest first.
+        """
+        for group, (cost, elapsed) in sorted(self.throughput.items(),
+                key=lambda x: x[1][0] / max(x[1][1], 1e-9)):
+            logger.info('%s: %d %s in %.1fs (%.1f %s/s)' % (
+                group, cost, self.unit, elapsed,
+                cost / max(elapsed, 1e-9), self.unit))
@@ -1,6 +1,7 @@
 
 import logging
 import multiprocessing
+import os
 import pathlib
 
 DEFAULT_MIN_SUBTREE_DEPTH = 2
@@ -14,10 +15,43 @@ DEFAULT_STATS_DIR = DEFAULT_DATA_DIR / 'stats'
 
 DEFAULT_STATS_PATH = DEFAULT_DATA_DIR / 'stats.db'
 
-#XXX: To avoid bblfsh downscaling, we set workers to CPUs+1
-DEFAULT_WORKERS = multiprocessing.cpu_count() + 1
+# Languages to train and analyze, with one model per language. Stats of a
+# language are kept in a directory named after it (see
+# languages.language_path), e.g. data/go/stats.db.
+DEFAULT_LANGUAGES = ['Go']
+
+# Path of the model of each language, {language} is its directory name.
+DEFAULT_MODEL_PATH = str(DEFAULT_DATA_DIR / '{language}' / 'stats.db') + '_merged_ranked_pruned_mapped'
+
+DEFAULT_UAST_CACHE_DIR = DEFAULT_DATA_DIR / 'cache' / 'uast'
+DEFAULT_UAST_CACHE_SIZE = 10 * 1024 * 1024 * 1024
+
+DEFAULT_WORKERS = multiprocessing.cpu_count()
+
+# Number of times a failed training job is retried, alone in a process.
+DEFAULT_JOB_RETRIES = 1
+
+# Maximum number of bblfsh parse requests in flight per worker.
+DEFAULT_PARSE_CONCURRENCY = 4
+
+# Number of processes analyzing changes in the analyzer.
+DEFAULT_ANALYZER_WORKERS = multiprocessing.cpu_count()
+
+# Minimum score of the patterns kept in a model.
+DEFAULT_MIN_SCORE = 0.8
+
+# Approximate counting (see stats.ApproximateStats)
+DEFAULT_COUNT_EPSILON = 1e-5
+DEFAULT_COUNT_DELTA = 0.01
+DEFAULT_COUNT_CAPACITY = 100000
+DEFAULT_COUNT_MIN = 2
 
 DEFAULT_BBLFSHD = '0.0.0.0:9432'
 
-logging.basicConfig(level=logging.DEBUG)
+DEFAULT_METRICS_DIR = DEFAULT_DATA_DIR / 'metrics'
+DEFAULT_METRICS_INTERVAL = 30
+DEFAULT_METRICS_HOST = '127.0.0.1'
+DEFAULT_METRICS_PORT = 9102
+
+logging.basicConfig(level=os.environ.get('BADCODE_LOG_LEVEL', 'INFO').upper())
 logger = logging.getLogger(__name__)
\ No newline at end of file
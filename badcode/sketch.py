@@ -0,0 +1,144 @@
+"""
+Streaming summaries to count keys in bounded memory.
+"""
+
+import array
+import heapq
+import math
+import random
+from typing import Any, Dict, Hashable, List, Tuple
+
+_PRIME = (1 << 61) - 1
+
+
+class CountMinSketch:
+    """
+    Count-min sketch: approximate counts of keys in fixed memory.
+
+    Estimates never undercount. With probability 1 - delta, a key is
+    overcounted by at most epsilon * total, where total is the sum of all
+    counts added. It takes ceil(e / epsilon) * ceil(ln(1 / delta)) counters.
+
+    Keys are hashed with the built-in hash, so sketches are only valid
+    within a process.
+    """
+
+    def __init__(self, epsilon: float, delta: float, seed: int=0) -> None:
+        self.epsilon = epsilon
+        self.delta = delta
+        self.width = int(math.ceil(math.e / epsilon))
+        self.depth = int(math.ceil(math.log(1.0 / delta)))
+        self.total = 0
+        rnd = random.Random(seed)
+        self._hashes = [(rnd.randrange(1, _PRIME), rnd.randrange(0, _PRIME))
+            for _ in range(self.depth)]
+        self._rows = [array.array('L', [0]) * self.width for _ in range(self.depth)]
+
+    def _positions(self, key: Hashable) -> List[int]:
+        # one hash function per row, from a pairwise independent family
+        h = hash(key) & 0xffffffffffffffff
+        width = self.width
+        return [(a * h + b) % _PRIME % width for a, b in self._hashes]
+
+    def add(self, key: Hashable, count: int=1) -> int:
+        """
+        Add count to the key and return its new estimate.
+        """
+        self.total += count
+        estimates = []
+        for row, pos in zip(self._rows, self._positions(key)):
+            row[pos] += count
+            estimates.append(row[pos])
+        return min(estimates)
+
+    def estimate(self, key: Hashable) -> int:
+        return min(row[pos] for row, pos in zip(self._rows, self._positions(key)))
+
+    def nbytes(self) -> int:
+        return sum(row.itemsize * len(row) for row in self._rows)
+
+
+class SpaceSaving:
+    """
+    Space-Saving heavy hitters: keeps approximate counts of at most
+    capacity keys.
+
+    When full, a new key replaces the key with the lowest count and
+    inherits that count, which is kept as its error. Counts never
+    undercount, count minus error never overcounts, and every key with a
+    true count above total / capacity is kept. Keys can also be removed; keys
+    added afterwards still inherit the highest count evicted so far, since
+    they may have been evicted before.
+
+    See: Metwally, Agrawal & El Abbadi, Efficient Computation of Frequent
+    and Top-k Elements in Data Streams (2005).
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.counts: Dict[Any,int] = {}
+        # count inherited by each key when it was added
+        self.errors: Dict[Any,int] = {}
+        # lazy min-heap of (count, seq, key): counts only grow, so an entry
+        # may be lower than the current count, and is pushed again with the
+        # current count when popped
+        self._heap: List[Tuple[int,int,Any]] = []
+        self._seq = 0
+        # highest count evicted so far
+        self.floor = 0
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.counts
+
+    def lower_bound(self, key: Hashable) -> int:
+        """
+        Return the number of times the key was added since it was last
+        inserted, a lower bound of its true count.
+        """
+        return self.counts[key] - self.errors[key]
+
+    def _push(self, key: Hashable, count: int) -> None:
+        self._seq += 1
+        heapq.heappush(self._heap, (count, self._seq, key))
+
+    def _pop_min(self) -> Tuple[Hashable,int]:
+        while True:
+            count, _, key = heapq.heappop(self._heap)
+            current = self.counts.get(key)
+            if current is None:
+                continue
+            if current == count:
+                return key, count
+            self._push(key, current)
+
+    def add(self, key: Hashable, count: int=1) -> int:
+        """
+        Add count to the key and return its new count.
+        """
+        current = self.counts.get(key)
+        if current is not None:
+            self.counts[key] = current + count
+            return current + count
+        if len(self.counts) >= self.capacity:
+            evicted, min_count = self._pop_min()
+            del self.counts[evicted]
+            del self.errors[evicted]
+            if min_count > self.floor:
+                self.floor = min_count
+        self.errors[key] = self.floor
+        count += self.floor
+        self.counts[key] = count
+        self._push(key, count)
+        return count
+
+    def remove(self, key: Hashable) -> None:
+        del self.counts[key]
+        del self.errors[key]
+        # drop entries of removed keys once they dominate the heap
+        if len(self._heap) > 2 * self.capacity:
+            self._heap = [(c, n, k) for n, (k, c) in enumerate(self.counts.items())]
+            heapq.heapify(self._heap)
+            self._seq = len(self._heap)
@@ -1,20 +1,78 @@
 
 import collections
+import json
+import os
 import os.path
 import pickle
-from typing import Optional, Tuple, Union
+import sqlite3
+import struct
+from typing import Any, Dict, Generator, Iterable, List, MutableMapping, NamedTuple, Optional, Tuple, Union
 
 import bblfsh
+from cachetools import LRUCache
 
 from .bblfshutil import UAST
+from .index import PatternIndex
+from .runs import RunWriter
+from .runs import is_run
+from .runs import read_header
+from .runs import read_run
+from .runs import stable_hash
+from .sketch import CountMinSketch
+from .sketch import SpaceSaving
 
 DEFAULT_STATS_DB = 'stats.db'
 
+# Rows of SqliteStats kept in memory, and rows written per batch.
+DEFAULT_STORE_CACHE_SIZE = 100000
+DEFAULT_STORE_BATCH_SIZE = 10000
+
+class Match(NamedTuple):
+    """
+    A pattern matching a subtree, with its snippet and its score from
+    compute_ranking (0.0 if the stats are not ranked).
+    """
+    pattern: UAST
+    text: str
+    score: float
+
+
+def dedup(uasts: Iterable[Any]) -> Tuple[List[Any],List[int]]:
+    """
+    Return the distinct UASTs, in order of first occurrence, and the index
+    of each given UAST in them.
+    """
+    ids: Dict[Any,int] = {}
+    positions = [ids.setdefault(uast, len(ids)) for uast in uasts]
+    return list(ids), positions
+
+def ranked(matches: Iterable[Match]) -> List[Match]:
+    """
+    Sort matches by score, highest first. Ties keep their order.
+    """
+    return sorted(matches, key=lambda m: -m.score)
+
 class Stats:
     def __init__(self) -> None:
         self.text = {}
         self.totals = {}
         self.per_repo = {}
+        # last processed commit per repository
+        self.last_commit: Dict[str,str] = {}
+        self._index: Optional[PatternIndex] = None
+        self._indexed_totals: Optional[dict] = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_index', None)
+        state.pop('_indexed_totals', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__.setdefault('last_commit', {})
+        self._index = None
+        self._indexed_totals = None
 
     def added(self, repo: str, uast: UAST, text: str) -> None:
         self._add(repo, uast, text, 'added')
@@ -27,6 +85,7 @@ class Stats:
             self.text[uast] = text
         if uast not in self.totals:
             self.totals[uast] = collections.defaultdict(int)
+            self._index = None
         self.totals[uast][key] += 1
         if repo not in self.per_repo:
             self.per_repo[repo] = {}
@@ -46,20 +105,18 @@ class Stats:
         for uast, text in other.text.items():
             if uast not in self.text:
                 self.text[uast] = text
+        self.last_commit.update(other.last_commit)
+        self._index = None
         return self
 
     def _merge_dict_of_dicts_of_int_values(self, a, b):
         for key, val in b.items():
-            prev = a.get(key, collections.defaultdict(int))
-            a[key] = self._merge_dict_of_int_values(prev, val)
-
-    def _merge_dict_of_int_values(self, a, b):
-        c = collections.defaultdict(int)
-        for k, v in a.items():
-            c[k] += v
-        for k, v in b.items():
-            c[k] += v
-        return c
+            prev = a.get(key)
+            if not isinstance(prev, collections.defaultdict):
+                prev = collections.defaultdict(int, prev or {})
+                a[key] = prev
+            for k, v in val.items():
+                prev[k] += v
 
     def merge_uast(self, dst: UAST, src: UAST) -> None:
         self._merge_stats(self.totals, dst, src)
@@ -67,6 +124,7 @@ class Stats:
             self._merge_stats(d, dst, src)
         if dst not in self.text:
             self.text[dst] = self.text[src]
+        self._index = None
 
     def _merge_stats(self, d, dst: UAST, src: UAST) -> None:
         if src not in d:
@@ -83,12 +141,86 @@ class Stats:
         dst_stats['merged'] += 1
         d[dst] = dst_stats
 
+    def per_repo_many(self, uasts: List[UAST]) -> List[Dict[str,Dict[str,Any]]]:
+        """
+        Return the counts of each of the given patterns in every repository
+        where it was seen, by repository.
+        """
+        return [dict((repo, d[uast]) for repo, d in self.per_repo.items() if uast in d)
+            for uast in uasts]
+
+    def prune(self, min_score: float) -> None:
+        """
+        Remove the patterns scored below min_score from totals and per_repo.
+        """
+        self.totals = dict([(k, v) for k, v in self.totals.items() if v['score'] >= min_score])
+        for d in self.per_repo.values():
+            for snpt in list(d.keys()):
+                if snpt not in self.totals:
+                    del d[snpt]
+
     def save(self, filename=DEFAULT_STATS_DB) -> None:
         with open(filename, 'wb') as f:
             pickle.dump(self, f)
 
+    def save_run(self, filename=DEFAULT_STATS_DB) -> None:
+        """
+        Save stats as a sorted run, which can be merged with merge_runs.
+        """
+        text_order = dict((uast, n) for n, uast in enumerate(self.text))
+        per_uast = {}
+        for repo, d in self.per_repo.items():
+            for n, (uast, counts) in enumerate(d.items()):
+                per_uast.setdefault(uast, {})[repo] = (n, counts)
+        uasts = list(self.totals.keys())
+        uasts += [u for u in self.text if u not in self.totals]
+        uasts += [u for u in per_uast if u not in self.totals and u not in self.text]
+        records = []
+        for n, uast in enumerate(uasts):
+            records.append((
+                stable_hash(uast),
+                (n if uast in self.totals else None, text_order.get(uast)),
+                uast,
+                self.text.get(uast),
+                self.totals.get(uast),
+                per_uast.get(uast, {})))
+        records.sort(key=lambda r: r[0])
+        writer = RunWriter(str(filename), self.per_repo.keys(), self.last_commit)
+        for record in records:
+            writer.write(record)
+        writer.close()
+
+    @staticmethod
+    def load_run(filename=DEFAULT_STATS_DB) -> 'Stats':
+        stats = Stats()
+        totals = []
+        text = []
+        header = read_header(str(filename))
+        stats.last_commit = header['last_commit']
+        per_repo = dict((repo, []) for repo in header['repos'])
+        for _, order, uast, t, s, repos in read_run(str(filename)):
+            if s is not None:
+                totals.append((order[0], uast, s))
+            if t is not None:
+                text.append((order[1], uast, t))
+            for repo, (repo_order, counts) in repos.items():
+                per_repo[repo].append((repo_order, uast, counts))
+        order = lambda x: x[0]
+        for _, uast, s in sorted(totals, key=order):
+            stats.totals[uast] = collections.defaultdict(int, s)
+        for _, uast, t in sorted(text, key=order):
+            stats.text[uast] = t
+        for repo, entries in per_repo.items():
+            stats.per_repo[repo] = dict((uast, counts)
+                for _, uast, counts in sorted(entries, key=order))
+        return stats
+
     @staticmethod
     def load(filename=DEFAULT_STATS_DB) -> 'Stats':
+        if is_run(str(filename)):
+            return Stats.load_run(filename)
+        if is_sqlite(str(filename)):
+            return SqliteStats(filename)
         with open(filename, 'rb') as f:
             return pickle.load(f)
 
@@ -98,8 +230,707 @@ class Stats:
             return Stats.load(filename)
         return Stats()
 
+    def build_index(self) -> None:
+        """
+        Build the pattern index used by match. It is rebuilt automatically
+        if the stats change after it was built.
+        """
+        self._index = PatternIndex(self.totals)
+        self._indexed_totals = self.totals
+
     def match(self, uast: UAST) -> Optional[Tuple[UAST,str]]:
-        for s in self.totals:
-            if s.match(uast):
-                return (s, self.text[s])
-        return None
+        if self._index is None or self._indexed_totals is not self.totals:
+            self.build_index()
+        s = self._index.match(uast)
+        if s is None:
+            return None
+        return (s, self.text[s])
+
+    def match_many(self, uasts: Iterable[UAST]) -> List[List[Match]]:
+        """
+        Return every pattern matching each of the given UASTs, best score
+        first. Identical UASTs are matched once.
+        """
+        if self._index is None or self._indexed_totals is not self.totals:
+            self.build_index()
+        distinct, positions = dedup(uasts)
+        found = [ranked(Match(p, self.text[p], self.totals[p].get('score', 0.0))
+            for p in patterns) for patterns in self._index.match_many(distinct)]
+        return [found[pos] for pos in positions]
+
+
+class ApproximateStats(Stats):
+    """
+    Stats that keep exact counts only for frequent patterns, in bounded
+    memory.
+
+    Patterns are first counted approximately, with a count-min sketch per
+    key type (added, deleted) and a Space-Saving summary of at most
+    capacity candidates. A pattern is promoted to exact totals and
+    per_repo entries once it was seen min_count times since it became a
+    candidate, that is, once its candidate count minus the count it
+    inherited reaches min_count. Promoted entries start from the sketch
+    estimates. Those estimates are attributed to the repository of
+    the occurrence that promoted the pattern, which is exact when the
+    stats hold a single repository, as in training.
+
+    Error bounds: counts are never lower than exact counts. With
+    probability 1 - delta, the initial count of each key type of a
+    promoted pattern is higher by at most epsilon times the number of
+    occurrences of that key type counted so far. Any pattern seen more
+    than total / capacity times is kept as a candidate until it is
+    promoted. Patterns seen fewer than min_count times are never promoted.
+    """
+
+    def __init__(self,
+            epsilon: float=1e-5,
+            delta: float=0.01,
+            capacity: int=100000,
+            min_count: int=2) -> None:
+        super(ApproximateStats, self).__init__()
+        self.min_count = min_count
+        self.sketches = {
+            'added': CountMinSketch(epsilon, delta, seed=1),
+            'deleted': CountMinSketch(epsilon, delta, seed=2),
+        }
+        self.candidates = SpaceSaving(capacity)
+        self.promoted = 0
+
+    def _add(self, repo: str, uast: UAST, text: str, key: str) -> None:
+        if uast in self.totals:
+            super(ApproximateStats, self)._add(repo, uast, text, key)
+            return
+        self.sketches[key].add(uast)
+        self.candidates.add(uast)
+        # inherited counts are not evidence: with a full summary every new
+        # candidate inherits at least min_count
+        if self.candidates.lower_bound(uast) < self.min_count:
+            return
+        estimates = dict((k, s.estimate(uast)) for k, s in self.sketches.items())
+        self.candidates.remove(uast)
+        self.promoted += 1
+        if uast not in self.text:
+            self.text[uast] = text
+        self.totals[uast] = collections.defaultdict(int,
+            ((k, v) for k, v in estimates.items() if v > 0))
+        self._index = None
+        if repo not in self.per_repo:
+            self.per_repo[repo] = {}
+        self.per_repo[repo][uast] = {'added': 0, 'deleted': 0}
+        self.per_repo[repo][uast].update(estimates)
+
+    def to_stats(self) -> Stats:
+        """
+        Return plain Stats with the promoted patterns only.
+        """
+        stats = Stats()
+        stats.text = self.text
+        stats.totals = self.totals
+        stats.per_repo = self.per_repo
+        stats.last_commit = self.last_commit
+        return stats
+
+
+_SQLITE_MAGIC = b'SQLite format 3\x00'
+
+# SQLite page cache of SqliteStats, in KiB.
+_PAGE_CACHE_KIB = 65536
+
+# Hashes per query of SqliteStats.per_repo_many, below the limit of
+# variables of old SQLite versions.
+_QUERY_HASHES = 500
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS patterns (hash INTEGER PRIMARY KEY, uast BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS text (
+    hash INTEGER PRIMARY KEY,
+    text TEXT NOT NULL,
+    seq INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS totals (
+    hash INTEGER PRIMARY KEY,
+    counts TEXT NOT NULL,
+    seq INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS per_repo (
+    repo TEXT NOT NULL,
+    hash INTEGER NOT NULL,
+    counts TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    PRIMARY KEY (repo, hash)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS text_seq ON text (seq);
+CREATE INDEX IF NOT EXISTS totals_seq ON totals (seq);
+CREATE INDEX IF NOT EXISTS per_repo_seq ON per_repo (repo, seq);
+CREATE INDEX IF NOT EXISTS per_repo_hash ON per_repo (hash);
+CREATE TABLE IF NOT EXISTS repos (repo TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS last_commit (repo TEXT PRIMARY KEY, hash TEXT NOT NULL);
+'''
+
+# Tables of a run being imported, with the order of each row.
+_IMPORT_SCHEMA = '''
+CREATE TEMP TABLE import_text (
+    hash INTEGER PRIMARY KEY,
+    text TEXT NOT NULL,
+    okey BLOB NOT NULL);
+CREATE TEMP TABLE import_totals (
+    hash INTEGER PRIMARY KEY,
+    counts TEXT NOT NULL,
+    okey BLOB NOT NULL);
+CREATE TEMP TABLE import_per_repo (
+    repo TEXT NOT NULL,
+    hash INTEGER NOT NULL,
+    counts TEXT NOT NULL,
+    okey BLOB NOT NULL,
+    PRIMARY KEY (repo, hash)) WITHOUT ROWID;
+'''
+
+def is_sqlite(filename: str) -> bool:
+    with open(filename, 'rb') as f:
+        return f.read(len(_SQLITE_MAGIC)) == _SQLITE_MAGIC
+
+def _signed_hash(uast: UAST) -> int:
+    # SQLite integers are signed 64-bit
+    h = stable_hash(uast)
+    if h >= 1 << 63:
+        h -= 1 << 64
+    return h
+
+def _flatten_order(order: Any) -> Generator[int,None,None]:
+    if isinstance(order, tuple):
+        for o in order:
+            yield from _flatten_order(o)
+    else:
+        yield order
+
+def _order_key(order: Any) -> bytes:
+    # Orders of a run are nested tuples of non-negative integers, with the
+    # same nesting for every record. Their big-endian encoding sorts as the
+    # tuples do.
+    return b''.join(struct.pack('>Q', o) for o in _flatten_order(order))
+
+
+class _Row:
+    """
+    Cached counts of a pattern, with a copy of them as read from the
+    database (None if they were never written), to write them back only if
+    they changed. seq is the position of the pattern in its table if it is
+    not there yet.
+    """
+
+    __slots__ = ('hash', 'seq', 'uast', 'counts', 'saved')
+
+    def __init__(self,
+            hash: int,
+            seq: int,
+            uast: UAST,
+            counts: Dict[str,Any],
+            saved: Optional[Dict[str,Any]]) -> None:
+        self.hash = hash
+        self.seq = seq
+        self.uast = uast
+        self.counts = counts
+        self.saved = saved
+
+    @property
+    def dirty(self) -> bool:
+        return self.saved is None or self.saved != self.counts
+
+
+class _RowCache(LRUCache):
+
+    def __init__(self, maxsize: int, evicted) -> None:
+        super(_RowCache, self).__init__(maxsize)
+        self._evicted = evicted
+
+    def popitem(self):
+        key, row = super(_RowCache, self).popitem()
+        self._evicted(key, row)
+        return key, row
+
+
+class SqliteStats(Stats):
+    """
+    Stats stored in an SQLite database, for models that do not fit in
+    memory. Patterns are keyed by their stable hash, with tables for
+    patterns, text, totals and per repository counts.
+
+    totals, per_repo and text are mappings backed by the database. Counts
+    read from them are kept in a write-back cache of at most cache_size
+    rows, and changes are written in batches of batch_size rows, so that
+    counts can be modified in place as with Stats. Rows are numbered when
+    they are added, so iteration goes in insertion order, in pages, as with
+    the dicts of Stats. Call flush (or save) to write all changes.
+
+    Patterns with colliding 64-bit hashes are not told apart.
+    """
+
+    def __init__(self,
+            filename: str,
+            cache_size: int=DEFAULT_STORE_CACHE_SIZE,
+            batch_size: int=DEFAULT_STORE_BATCH_SIZE) -> None:
+        super(SqliteStats, self).__init__()
+        self.filename = str(filename)
+        self._batch_size = batch_size
+        self._conn = sqlite3.connect(self.filename)
+        self._conn.execute('PRAGMA cache_size = -%d' % _PAGE_CACHE_KIB)
+        self._conn.executescript(_SCHEMA)
+        self._cache = _RowCache(cache_size, self._evicted)
+        # pending writes: (table, repo, uast) -> (hash, seq, value), value
+        # is None for deletes
+        self._pending: Dict[Tuple[str,str,UAST],Tuple[int,int,Any]] = {}
+        self._new_patterns: Dict[int,UAST] = {}
+        self._seq = self._max_seq() + 1
+        # repositories in the order they were added, as in Stats
+        self._repos = dict.fromkeys(
+            r for r, in self._conn.execute('SELECT repo FROM repos ORDER BY rowid'))
+        self.last_commit = dict(self._conn.execute('SELECT repo, hash FROM last_commit'))
+        self._saved_last_commit = dict(self.last_commit)
+        self.totals = _CountsTable(self, 'totals', '')
+        self.per_repo = _PerRepoTable(self)
+        self.text = _TextTable(self)
+
+    def __getstate__(self):
+        raise TypeError('SqliteStats cannot be pickled, use save instead')
+
+    def close(self) -> None:
+        self.flush()
+        self._conn.close()
+
+    def _max_seq(self) -> int:
+        return max(self._conn.execute('SELECT MAX(seq) FROM %s' % table).fetchone()[0] or 0
+            for table in ['text', 'totals', 'per_repo'])
+
+    def _next_seq(self) -> int:
+        seq = self._seq
+        self._seq += 1
+        return seq
+
+    def _evicted(self, key: Tuple[str,str,UAST], row: _Row) -> None:
+        if row.dirty:
+            self._write(key, row.hash, row.seq, row.counts)
+
+    def _write(self, key: Tuple[str,str,UAST], hash: int, seq: int, value: Any) -> None:
+        self._pending[key] = (hash, seq, value)
+        if len(self._pending) >= self._batch_size:
+            self._write_pending()
+
+    def _write_pending(self) -> None:
+        if self._new_patterns:
+            self._conn.executemany(
+                'INSERT OR IGNORE INTO patterns (hash, uast) VALUES (?, ?)',
+                ((h, pickle.dumps(u, protocol=pickle.HIGHEST_PROTOCOL))
+                    for h, u in self._new_patterns.items()))
+            self._new_patterns = {}
+        upserts: Dict[str,List[tuple]] = collections.defaultdict(list)
+        deletes: Dict[str,List[tuple]] = collections.defaultdict(list)
+        for (table, repo, _), (h, seq, value) in self._pending.items():
+            key = (repo, h) if table == 'per_repo' else (h,)
+            if value is None:
+                deletes[table].append(key)
+            elif table == 'text':
+                upserts[table].append(key + (value, seq))
+            else:
+                upserts[table].append(key + (json.dumps(value), seq))
+        for table, rows in deletes.items():
+            where = 'repo = ? AND hash = ?' if table == 'per_repo' else 'hash = ?'
+            self._conn.executemany('DELETE FROM %s WHERE %s' % (table, where), rows)
+        for table, rows in upserts.items():
+            column = 'text' if table == 'text' else 'counts'
+            keys = 'repo, hash' if table == 'per_repo' else 'hash'
+            # existing rows keep their seq, as keys of a dict keep their
+            # position when they are assigned
+            self._conn.executemany('''INSERT INTO %s (%s, %s, seq) VALUES (%s)
+                ON CONFLICT (%s) DO UPDATE SET %s = excluded.%s''' % (
+                    table, keys, column, ', '.join('?' * len(rows[0])),
+                    keys, column, column), rows)
+        self._pending = {}
+        if self._conn.in_transaction:
+            self._conn.commit()
+
+    def flush(self) -> None:
+        """
+        Write all changes to the database.
+        """
+        for key, row in self._cache.items():
+            if row.dirty:
+                self._pending[key] = (row.hash, row.seq, row.counts)
+                row.saved = dict(row.counts)
+        if self.last_commit != self._saved_last_commit:
+            self._conn.execute('DELETE FROM last_commit')
+            self._conn.executemany(
+                'INSERT INTO last_commit (repo, hash) VALUES (?, ?)',
+                self.last_commit.items())
+            self._saved_last_commit = dict(self.last_commit)
+        self._write_pending()
+
+    def _read(self, table: str, repo: str, uast: UAST) -> Tuple[int,int,Any]:
+        """
+        Return the hash, seq and value of a pattern in a table, or None as
+        value if it is not there.
+        """
+        key = (table, repo, uast)
+        pending = self._pending.get(key)
+        if pending is not None:
+            return pending
+        h = _signed_hash(uast)
+        if table == 'per_repo':
+            cursor = self._conn.execute(
+                'SELECT seq, counts FROM per_repo WHERE repo = ? AND hash = ?', (repo, h))
+        else:
+            column = 'text' if table == 'text' else 'counts'
+            cursor = self._conn.execute(
+                'SELECT seq, %s FROM %s WHERE hash = ?' % (column, table), (h,))
+        result = cursor.fetchone()
+        if result is None:
+            return h, -1, None
+        if table == 'text':
+            return h, result[0], result[1]
+        return h, result[0], json.loads(result[1])
+
+    def _get_counts(self, table: str, repo: str, uast: UAST) -> Optional[Dict[str,Any]]:
+        key = (table, repo, uast)
+        row = self._cache.get(key)
+        if row is not None:
+            return row.counts
+        h, seq, value = self._read(table, repo, uast)
+        if value is None:
+            return None
+        counts = collections.defaultdict(int, value)
+        self._cache[key] = _Row(h, seq, uast, counts, dict(value))
+        return counts
+
+    def _assigned(self, key: Tuple[str,str,UAST]) -> Tuple[int,int]:
+        """
+        Return the hash and seq of a pattern being assigned. As in a dict,
+        a pattern keeps its position if it is already there, and goes to
+        the end otherwise, including after it was deleted.
+        """
+        row = self._cache.get(key)
+        if row is not None:
+            return row.hash, row.seq
+        pending = self._pending.get(key)
+        if pending is not None:
+            if pending[2] is not None:
+                return pending[0], pending[1]
+            # write the delete, so that the pattern is added again
+            self._write_pending()
+        # rows already in the database keep their seq when written
+        return _signed_hash(key[2]), self._next_seq()
+
+    def _set_counts(self, table: str, repo: str, uast: UAST, counts: Dict[str,Any]) -> None:
+        key = (table, repo, uast)
+        h, seq = self._assigned(key)
+        if not isinstance(counts, collections.defaultdict):
+            counts = collections.defaultdict(int, counts)
+        self._new_patterns[h] = uast
+        self._cache[key] = _Row(h, seq, uast, counts, None)
+        if table == 'totals':
+            self._index = None
+
+    def _delete(self, table: str, repo: str, uast: UAST) -> None:
+        key = (table, repo, uast)
+        row = self._cache.pop(key, None)
+        h = row.hash if row is not None else _signed_hash(uast)
+        self._write(key, h, -1, None)
+        if table == 'totals':
+            self._index = None
+
+    def _set_text(self, uast: UAST, text: str) -> None:
+        key = ('text', '', uast)
+        h, seq = self._assigned(key)
+        self._new_patterns[h] = uast
+        self._write(key, h, seq, text)
+
+    def _items(self,
+            table: str,
+            repo: str,
+            page_size: int=1000) -> Generator[Tuple[UAST,Any],None,None]:
+        """
+        Iterate over a table in pages by insertion order. Counts are
+        returned through the cache, so they can be modified in place.
+        """
+        self.flush()
+        column = 'text' if table == 'text' else 'counts'
+        where = 't.repo = ? AND ' if table == 'per_repo' else ''
+        query = '''SELECT t.hash, t.seq, p.uast, t.%s
+            FROM %s t JOIN patterns p ON p.hash = t.hash
+            WHERE %st.seq > ? ORDER BY t.seq LIMIT ?''' % (column, table, where)
+        last = -1
+        while True:
+            params = (repo, last, page_size) if table == 'per_repo' else (last, page_size)
+            rows = self._conn.execute(query, params).fetchall()
+            if not rows:
+                return
+            for h, seq, data, value in rows:
+                uast = pickle.loads(data)
+                key = (table, repo, uast)
+                if key in self._pending:
+                    _, _, value = self._pending[key]
+                    if value is None:
+                        continue
+                elif table != 'text':
+                    value = json.loads(value)
+                if table == 'text':
+                    yield uast, value
+                    continue
+                row = self._cache.get(key)
+                if row is None:
+                    row = _Row(h, seq, uast, collections.defaultdict(int, value), dict(value))
+                    self._cache[key] = row
+                yield uast, row.counts
+            last = rows[-1][1]
+
+    def per_repo_many(self, uasts: List[UAST]) -> List[Dict[str,Dict[str,Any]]]:
+        """
+        As Stats.per_repo_many, with one query per _QUERY_HASHES patterns
+        instead of one per pattern and repository.
+        """
+        hashes = [_signed_hash(uast) for uast in uasts]
+        found: Dict[int,Dict[str,str]] = collections.defaultdict(dict)
+        for start in range(0, len(hashes), _QUERY_HASHES):
+            chunk = hashes[start:start + _QUERY_HASHES]
+            cursor = self._conn.execute(
+                'SELECT repo, hash, counts FROM per_repo WHERE hash IN (%s)' % (
+                    ', '.join('?' * len(chunk))), chunk)
+            for repo, h, counts in cursor:
+                found[h][repo] = counts
+        result = []
+        for uast, h in zip(uasts, hashes):
+            stored = found.get(h, {})
+            counts = {}
+            for repo in self._repos:
+                key = ('per_repo', repo, uast)
+                row = self._cache.get(key)
+                if row is not None:
+                    counts[repo] = row.counts
+                elif key in self._pending:
+                    value = self._pending[key][2]
+                    if value is not None:
+                        counts[repo] = value
+                elif repo in stored:
+                    counts[repo] = json.loads(stored[repo])
+            result.append(counts)
+        return result
+
+    def _len(self, table: str, repo: str) -> int:
+        self.flush()
+        if table == 'per_repo':
+            cursor = self._conn.execute('SELECT COUNT(*) FROM per_repo WHERE repo = ?', (repo,))
+        else:
+            cursor = self._conn.execute('SELECT COUNT(*) FROM %s' % table)
+        return cursor.fetchone()[0]
+
+    def _add_repo(self, repo: str) -> None:
+        if repo not in self._repos:
+            self._repos[repo] = None
+            self._conn.execute('INSERT OR IGNORE INTO repos (repo) VALUES (?)', (repo,))
+
+    def _clear_repo(self, repo: str) -> None:
+        self.flush()
+        for key in [k for k in self._cache.keys() if k[0] == 'per_repo' and k[1] == repo]:
+            del self._cache[key]
+        self._conn.execute('DELETE FROM per_repo WHERE repo = ?', (repo,))
+        self._conn.commit()
+
+    def _drop_cache(self) -> None:
+        self.flush()
+        self._cache = _RowCache(self._cache.maxsize, self._evicted)
+
+    def prune(self, min_score: float) -> None:
+        self._drop_cache()
+        self._conn.execute(
+            "DELETE FROM totals WHERE json_extract(counts, '$.score') < ?", (min_score,))
+        self._conn.execute(
+            'DELETE FROM per_repo WHERE hash NOT IN (SELECT hash FROM totals)')
+        self._conn.commit()
+        self._index = None
+
+    def save(self, filename=DEFAULT_STATS_DB) -> None:
+        """
+        Write a copy of the database to filename.
+        """
+        self.flush()
+        if os.path.abspath(str(filename)) == os.path.abspath(self.filename):
+            return
+        tmp_filename = '%s.tmp' % filename
+        if os.path.exists(tmp_filename):
+            os.unlink(tmp_filename)
+        dst = sqlite3.connect(tmp_filename)
+        with dst:
+            self._conn.backup(dst)
+        dst.close()
+        os.replace(tmp_filename, str(filename))
+
+    @staticmethod
+    def create(filename: str, source: str, **kwargs) -> 'SqliteStats':
+        """
+        Create the database filename with the stats in source, which can be
+        a run, a database or a pickle.
+        """
+        if os.path.exists(filename):
+            os.unlink(filename)
+        if is_sqlite(source):
+            stats = SqliteStats(source)
+            stats.save(filename)
+            stats.close()
+            return SqliteStats(filename, **kwargs)
+        stats = SqliteStats(filename, **kwargs)
+        if is_run(source):
+            stats._import_run(source)
+        else:
+            stats += Stats.load(source)
+            stats.flush()
+        return stats
+
+    def _import_run(self, filename: str) -> None:
+        header = read_header(filename)
+        for repo in header['repos']:
+            self._add_repo(repo)
+        self.last_commit.update(header['last_commit'])
+        # Rows are numbered in the order of the run, as in Stats.load_run,
+        # once they are all in temporary tables with their order.
+        self._conn.executescript(_IMPORT_SCHEMA)
+        batch: Dict[str,List[tuple]] = collections.defaultdict(list)
+        for _, order, uast, text, totals, repos in read_run(filename):
+            h = _signed_hash(uast)
+            batch['patterns'].append((h, pickle.dumps(uast, protocol=pickle.HIGHEST_PROTOCOL)))
+            if text is not None:
+                batch['import_text'].append((h, text, _order_key(order[1])))
+            if totals is not None:
+                batch['import_totals'].append((h, json.dumps(totals), _order_key(order[0])))
+            for repo, (repo_order, counts) in repos.items():
+                batch['import_per_repo'].append(
+                    (repo, h, json.dumps(counts), _order_key(repo_order)))
+            if len(batch['patterns']) >= self._batch_size:
+                self._insert_batch(batch)
+        self._insert_batch(batch)
+        for table, columns in [
+                ('text', 'hash, text'),
+                ('totals', 'hash, counts'),
+                ('per_repo', 'repo, hash, counts')]:
+            self._conn.execute('''INSERT INTO %s (%s, seq)
+                SELECT %s, ROW_NUMBER() OVER (ORDER BY okey) - 1 + ? FROM import_%s''' % (
+                    table, columns, columns, table), (self._seq,))
+            self._conn.execute('DROP TABLE import_%s' % table)
+        self._conn.commit()
+        self._seq = self._max_seq() + 1
+        self.flush()
+
+    def _insert_batch(self, batch: Dict[str,List[tuple]]) -> None:
+        for table, rows in batch.items():
+            if rows:
+                self._conn.executemany('INSERT OR REPLACE INTO %s VALUES (%s)' % (
+                    table, ', '.join('?' * len(rows[0]))), rows)
+        batch.clear()
+        self._conn.commit()
+
+
+class _CountsTable(MutableMapping[UAST,Dict[str,Any]]):
+    """
+    Mapping of patterns to counts in the totals or per_repo table.
+    """
+
+    def __init__(self, stats: SqliteStats, table: str, repo: str) -> None:
+        self._stats = stats
+        self._table = table
+        self._repo = repo
+
+    def __getitem__(self, uast: UAST) -> Dict[str,Any]:
+        counts = self._stats._get_counts(self._table, self._repo, uast)
+        if counts is None:
+            raise KeyError(uast)
+        return counts
+
+    def __setitem__(self, uast: UAST, counts: Dict[str,Any]) -> None:
+        self._stats._set_counts(self._table, self._repo, uast, counts)
+
+    def __delitem__(self, uast: UAST) -> None:
+        if uast not in self:
+            raise KeyError(uast)
+        self._stats._delete(self._table, self._repo, uast)
+
+    def __contains__(self, uast) -> bool:
+        return self._stats._get_counts(self._table, self._repo, uast) is not None
+
+    def __iter__(self):
+        for uast, _ in self.items():
+            yield uast
+
+    def __len__(self) -> int:
+        return self._stats._len(self._table, self._repo)
+
+    def items(self):
+        return self._stats._items(self._table, self._repo)
+
+
+class _PerRepoTable(MutableMapping[str,_CountsTable]):
+    """
+    Mapping of repositories to their counts in the per_repo table.
+    """
+
+    def __init__(self, stats: SqliteStats) -> None:
+        self._stats = stats
+
+    def __getitem__(self, repo: str) -> _CountsTable:
+        if repo not in self._stats._repos:
+            raise KeyError(repo)
+        return _CountsTable(self._stats, 'per_repo', repo)
+
+    def __setitem__(self, repo: str, counts: Dict[UAST,Dict[str,Any]]) -> None:
+        if isinstance(counts, _CountsTable) and counts._repo == repo:
+            return
+        self._stats._add_repo(repo)
+        self._stats._clear_repo(repo)
+        table = _CountsTable(self._stats, 'per_repo', repo)
+        for uast, c in counts.items():
+            table[uast] = c
+
+    def __delitem__(self, repo: str) -> None:
+        if repo not in self._stats._repos:
+            raise KeyError(repo)
+        self._stats._clear_repo(repo)
+        del self._stats._repos[repo]
+        self._stats._conn.execute('DELETE FROM repos WHERE repo = ?', (repo,))
+
+    def __contains__(self, repo) -> bool:
+        return repo in self._stats._repos
+
+    def __iter__(self):
+        return iter(list(self._stats._repos))
+
+    def __len__(self) -> int:
+        return len(self._stats._repos)
+
+
+class _TextTable(MutableMapping[UAST,str]):
+    """
+    Mapping of patterns to text in the text table.
+    """
+
+    def __init__(self, stats: SqliteStats) -> None:
+        self._stats = stats
+
+    def __getitem__(self, uast: UAST) -> str:
+        _, _, text = self._stats._read('text', '', uast)
+        if text is None:
+            raise KeyError(uast)
+        return text
+
+    def __setitem__(self, uast: UAST, text: str) -> None:
+        self._stats._set_text(uast, text)
+
+    def __delitem__(self, uast: UAST) -> None:
+        if uast not in self:
+            raise KeyError(uast)
+        self._stats._delete('text', '', uast)
+
+    def __contains__(self, uast) -> bool:
+        return self._stats._read('text', '', uast)[2] is not None
+
+    def __iter__(self):
+        for uast, _ in self.items():
+            yield uast
+
+    def __len__(self) -> int:
+        return self._stats._len('text', '')
+
+    def items(self):
+        return self._stats._items('text', '')
@@ -1,17 +1,48 @@
 
 import collections
+import functools
+import struct
+from hashlib import blake2b
 
-from typing import Generic, Generator, Iterable
+from typing import Any, Generic, Generator, Iterable, List
 from typing import Optional, Tuple, TypeVar, Sequence
 
 K = TypeVar('K')
 
+_LENGTH = struct.Struct('<I')
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def _encode_key(key: Any) -> bytes:
+    if isinstance(key, str):
+        data = key.encode('utf-8')
+        return _LENGTH.pack(len(data)) + data
+    if isinstance(key, tuple):
+        return b''.join(_encode_key(k) for k in key)
+    return _encode_key(repr(key))
+
+def node_fingerprint(key: Any, children: Sequence[int]) -> int:
+    """
+    Return the fingerprint of a node given its key and the fingerprints of
+    its children, in order.
+    """
+    data = _encode_key(key) + _LENGTH.pack(len(children))
+    if children:
+        data += b''.join([c.to_bytes(8, 'big') for c in children])
+    return int.from_bytes(blake2b(data, digest_size=8).digest(), 'big')
+
+
 class Tree(Generic[K]):
+    """
+    Immutable tree. Trees are hashed by their fingerprint: a 64-bit Merkle
+    hash of the key and the fingerprints of the children, which is the same
+    across processes and is kept when pickled.
+    """
 
     def __init__(self, key: K, children: Iterable['Tree[K]']=tuple()) -> None:
         self._key = key
         self._children = tuple(children)
-        self._hash: Optional[int] = None
+        self._fingerprint: Optional[int] = None
         self._len: Optional[int] = None
 
     @property
@@ -25,6 +56,18 @@ class Tree(Generic[K]):
     def with_children(self, children: Iterable['Tree[K]']) -> 'Tree[K]':
         return self.__class__(key=self.key, children=tuple(children))
 
+    def replace_key(self, pos: int, key: K) -> 'Tree[K]':
+        """
+        Return a copy with the key of the node at the given iteration
+        position replaced.
+        """
+        node = self.__copy__()
+        for n, nn in enumerate(node):
+            if n == pos:
+                nn._key = key
+                break
+        return node
+
     def __eq__(self, other):
         if other is None:
             return False
@@ -32,10 +75,29 @@ class Tree(Generic[K]):
             return False
         return self.children == other.children
 
+    @property
+    def fingerprint(self) -> int:
+        if self._fingerprint is None:
+            # bottom-up over the nodes without a fingerprint yet: a node is
+            # done once all its children are
+            stack: List['Tree[K]'] = [self]
+            while stack:
+                node = stack[-1]
+                children = node._children
+                if children:
+                    pending = [c for c in children if c._fingerprint is None]
+                    if pending:
+                        stack.extend(pending)
+                        continue
+                    fingerprints = [c._fingerprint for c in children]
+                else:
+                    fingerprints = []
+                stack.pop()
+                node._fingerprint = node_fingerprint(node._key, fingerprints)
+        return self._fingerprint
+
     def __hash__(self) -> int:
-        if self._hash is None:
-            self._hash = hash((self.key, self.children))
-        return self._hash
+        return hash(self.fingerprint)
 
     def __len__(self) -> int:
         if self._len is None:
@@ -50,12 +112,12 @@ class Tree(Generic[K]):
         return '%s(key=%s, children=%s)' % (self.__class__.__name__, self.key, self.children)
 
     def __getstate__(self):
-        return {'key': self.key, 'children': self.children}
+        return {'key': self.key, 'children': self.children, 'fingerprint': self.fingerprint}
 
     def __setstate__(self, state):
         self._key = state['key']
         self._children = state['children']
-        self._hash = None
+        self._fingerprint = state.get('fingerprint')
         self._len = None
 
     def __iter__(self) -> Generator['Tree[K]',None,None]:
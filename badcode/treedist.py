@@ -14,6 +14,7 @@ def single_node_merge(a: UAST, b: UAST) -> Optional[UAST]:
     """
 
     diff_pos = None
+    diff_key = None
     diff_token = False
     diff_internal_type = False
     n = 0
@@ -26,6 +27,7 @@ def single_node_merge(a: UAST, b: UAST) -> Optional[UAST]:
         if diff_pos is not None:
             return None
         diff_pos = n
+        diff_key = an.key
         diff_internal_type = an.key[0] != bn.key[0]
         diff_token = an.key[1] != bn.key[1]
         n += 1
@@ -33,19 +35,12 @@ def single_node_merge(a: UAST, b: UAST) -> Optional[UAST]:
     if diff_pos is None:
         return None
 
-    node = a.__copy__()
-    n = 0
-    for an in node:
-        if n != diff_pos:
-            n += 1
-            continue
-        if diff_internal_type:
-            an._key = (WILDCARD, an.key[1])
-        if diff_token:
-            an._key = (an.key[0], WILDCARD)
-        break
-
-    return node
+    key = diff_key
+    if diff_internal_type:
+        key = (WILDCARD, key[1])
+    if diff_token:
+        key = (key[0], WILDCARD)
+    return a.replace_key(diff_pos, key)
 
 def single_node_merge_precalc(
         a: UAST, b: UAST,
@@ -74,20 +69,17 @@ def single_node_merge_precalc(
     if diff_pos is None:
         return None
 
-    node = a.__copy__()
-
-    n = 0
-    for nn, an, bn in zip(node, a, b):
+    for n, (an, bn) in enumerate(zip(a, b)):
         if n != diff_pos:
-            n += 1
             continue
+        key = an.key
         if an.key[0] != bn.key[0]:
-            nn._key = (WILDCARD, nn.key[1])
+            key = (WILDCARD, key[1])
         if an.key[1] != bn.key[1]:
-            nn._key = (nn.key[0], WILDCARD)
-        break
+            key = (key[0], WILDCARD)
+        return a.replace_key(diff_pos, key)
 
-    return node
+    return a.__copy__()
 
 class TreeToSeq:
     def __init__(self):
@@ -0,0 +1,103 @@
+"""
+Memory and accuracy of stats.ApproximateStats compared with exact Stats,
+on a synthetic Zipfian stream of patterns from a single repository.
+
+Usage: python -m benchmarks.bench_approx [N_OCCURRENCES [EPSILON]]
+"""
+
+import random
+import sys
+import time
+import tracemalloc
+import typing
+
+from badcode.postprocess import compute_ranking
+from badcode.settings import *
+from badcode.stats import ApproximateStats
+from badcode.stats import Stats
+
+from .synthetic import random_uast
+
+N_PATTERNS = 100000
+
+
+def _stream(rnd: random.Random, n: int) -> typing.List[typing.Tuple[int,bool]]:
+    weights = [1.0 / (k + 1) for k in range(N_PATTERNS)]
+    patterns = rnd.choices(range(N_PATTERNS), weights=weights, k=n)
+    return [(p, rnd.random() < 0.5) for p in patterns]
+
+def _fill(stats: Stats, uasts, stream) -> Stats:
+    for pattern, is_added in stream:
+        uast = uasts[pattern]
+        if is_added:
+            stats.added('repo', uast, 'text')
+        else:
+            stats.deleted('repo', uast, 'text')
+    return stats
+
+def _count(new_stats, uasts, stream) -> typing.Tuple[Stats,float,int]:
+    # timed without tracemalloc, which slows down allocations
+    start = time.perf_counter()
+    _fill(new_stats(), uasts, stream)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    stats = _fill(new_stats(), uasts, stream)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return stats, elapsed, peak
+
+def _frequent(stats: Stats, min_count: int) -> Stats:
+    frequent = Stats()
+    frequent += stats
+    for uast, counts in list(frequent.totals.items()):
+        if counts['added'] + counts['deleted'] < min_count:
+            del frequent.totals[uast]
+            for d in frequent.per_repo.values():
+                d.pop(uast, None)
+    return frequent
+
+def run(n: int, epsilon: float) -> None:
+    rnd = random.Random(42)
+    uasts = [random_uast(rnd) for _ in range(N_PATTERNS)]
+    stream = _stream(rnd, n)
+
+    exact, exact_time, exact_peak = _count(Stats, uasts, stream)
+    print('%-12s %10s %14s %10s' % ('mode', 'time (s)', 'peak (bytes)', 'patterns'))
+    print('%-12s %10.3f %14d %10d' % ('exact', exact_time, exact_peak, len(exact.totals)))
+
+    # the approximate model can only differ from the exact one without
+    # the patterns below min_count
+    frequent = _frequent(exact, DEFAULT_COUNT_MIN)
+    compute_ranking(frequent)
+    print('%-12s %10s %14s %10d' % ('exact >= %d' % DEFAULT_COUNT_MIN, '', '',
+        len(frequent.totals)))
+
+    for capacity in [10000, 2000]:
+        approx, approx_time, approx_peak = _count(lambda: ApproximateStats(
+            epsilon=epsilon,
+            delta=DEFAULT_COUNT_DELTA,
+            capacity=capacity,
+            min_count=DEFAULT_COUNT_MIN), uasts, stream)
+        print('%-12s %10.3f %14d %10d' % (
+            'approx/%d' % capacity, approx_time, approx_peak, len(approx.totals)))
+
+        errors = []
+        for uast, counts in approx.totals.items():
+            for key in ('added', 'deleted'):
+                errors.append(counts[key] - exact.totals[uast][key])
+        print('  count error: min %d, max %d, mean %.4f' % (
+            min(errors), max(errors), float(sum(errors)) / len(errors)))
+        print('  recall of patterns seen >= %d times: %.4f' % (
+            DEFAULT_COUNT_MIN,
+            float(len(set(frequent.totals) & set(approx.totals))) / len(frequent.totals)))
+
+        approx_stats = approx.to_stats()
+        compute_ranking(approx_stats)
+        diffs = [abs(approx_stats.totals[u]['score'] - frequent.totals[u]['score'])
+            for u in approx_stats.totals if u in frequent.totals]
+        print('  score difference: max %.4f, mean %.4f' % (
+            max(diffs), sum(diffs) / len(diffs)))
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000,
+        float(sys.argv[2]) if len(sys.argv) > 2 else 1e-4)
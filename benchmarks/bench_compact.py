@@ -0,0 +1,68 @@
+"""
+Memory and speed comparison of UAST and CompactUAST.
+
+Usage: python -m benchmarks.bench_compact [N]
+"""
+
+import pickle
+import random
+import sys
+import time
+import tracemalloc
+
+from badcode.compact import CompactUAST
+
+from .synthetic import random_uast
+
+def _measure(build):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - start
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, memory, elapsed
+
+def _time(f) -> float:
+    start = time.perf_counter()
+    f()
+    return time.perf_counter() - start
+
+def run(n: int) -> None:
+    uasts, uast_mem, uast_build = _measure(
+        lambda: [random_uast(random.Random(i)) for i in range(n)])
+    compacts, compact_mem, compact_build = _measure(
+        lambda: [CompactUAST.from_tree(random_uast(random.Random(i))) for i in range(n)])
+    nodes = sum(len(u) for u in uasts)
+
+    rows = [
+        ('memory (bytes/node)',
+            uast_mem / nodes, compact_mem / nodes),
+        ('build+convert (s)', uast_build, compact_build),
+        ('hash (s)',
+            _time(lambda: [hash(u) for u in uasts]),
+            _time(lambda: [hash(c) for c in compacts])),
+        ('dict lookup (s)',
+            _time(lambda: [u in d for d in [set(uasts)] for u in uasts]),
+            _time(lambda: [c in d for d in [set(compacts)] for c in compacts])),
+        ('match (s)',
+            _time(lambda: [u.match(u) for u in uasts]),
+            _time(lambda: [c.match(c) for c in compacts])),
+        ('iterate (s)',
+            _time(lambda: [n.key for u in uasts for n in u]),
+            _time(lambda: [n.key for c in compacts for n in c])),
+        ('pickle size (bytes)',
+            len(pickle.dumps(uasts)),
+            len(pickle.dumps(compacts))),
+        ('pickle load (s)',
+            _time(lambda: pickle.loads(pickle.dumps(uasts))),
+            _time(lambda: pickle.loads(pickle.dumps(compacts)))),
+    ]
+
+    print('%d trees, %d nodes' % (n, nodes))
+    print('%-22s %14s %14s' % ('', 'UAST', 'CompactUAST'))
+    for name, a, b in rows:
+        print('%-22s %14.3f %14.3f' % (name, a, b))
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
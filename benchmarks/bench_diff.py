@@ -0,0 +1,77 @@
+"""
+Speed of extract.added_lines compared with the previous difflib-based
+computation of changed lines in the analyzer, on synthetic Go-like files
+with many repeated lines.
+
+Usage: python -m benchmarks.bench_diff [N_CHANGES]
+"""
+
+import difflib
+import random
+import sys
+import time
+import typing
+
+from badcode.extract import added_lines
+
+SIZES = [200, 1000, 5000]
+
+
+def difflib_lines(base: bytes, head: bytes) -> typing.Set[int]:
+    """
+    Previous implementation, kept as reference.
+    """
+    seqm = difflib.SequenceMatcher(
+        None,
+        base.splitlines(),
+        head.splitlines(),
+        )
+    lines = set()
+    for opcode in seqm.get_opcodes():
+        if opcode[0] in ('insert', 'replace'):
+            lines |= set(range(opcode[3]+1, opcode[4]+1))
+    return lines
+
+def _random_line(rnd: random.Random) -> str:
+    r = rnd.random()
+    if r < 0.3:
+        return '}'
+    if r < 0.4:
+        return ''
+    if r < 0.5:
+        return '\treturn err'
+    return '\tx%d := f(%d)' % (rnd.randrange(1000), rnd.randrange(1000))
+
+def _random_change(rnd: random.Random, size: int) -> typing.Tuple[bytes,bytes]:
+    base = [_random_line(rnd) for _ in range(size)]
+    head = list(base)
+    for _ in range(max(1, size // 50)):
+        pos = rnd.randrange(len(head) + 1)
+        if rnd.random() < 0.5 and pos < len(head):
+            del head[pos:pos + rnd.randint(1, 5)]
+        else:
+            head[pos:pos] = [_random_line(rnd) for _ in range(rnd.randint(1, 5))]
+    return ('\n'.join(base) + '\n').encode(), ('\n'.join(head) + '\n').encode()
+
+def _measure(func, changes) -> float:
+    start = time.perf_counter()
+    for base, head in changes:
+        func(base, head)
+    return time.perf_counter() - start
+
+def run(n_changes: int) -> None:
+    print('%6s %12s %12s %8s %8s' % ('lines', 'difflib (s)', 'libgit2 (s)', 'speedup', 'ratio'))
+    for size in SIZES:
+        rnd = random.Random(size)
+        changes = [_random_change(rnd, size) for _ in range(n_changes)]
+        before = _measure(difflib_lines, changes)
+        after = _measure(added_lines, changes)
+        # added lines relative to difflib: both are valid diffs, but not
+        # always the same one
+        ratio = (sum(len(added_lines(b, h)) for b, h in changes) /
+            max(1, sum(len(difflib_lines(b, h)) for b, h in changes)))
+        print('%6d %12.3f %12.3f %8.1f %8.2f' % (
+            size, before, after, before / after, ratio))
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
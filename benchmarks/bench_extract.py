@@ -0,0 +1,147 @@
+"""
+Speed and memory of extract.extract_subtrees on synthetic file-sized
+UASTs, compared with the previous Path-based implementation.
+
+Usage: python -m benchmarks.bench_extract [N_FILES]
+"""
+
+import random
+import sys
+import time
+import tracemalloc
+import typing
+from typing import Generator, Iterable, List, Set
+
+import bblfsh
+
+from badcode.extract import extract_subtrees
+from badcode.extract import is_relevant_node
+from badcode.settings import *
+
+from .synthetic import random_bblfsh_uast
+
+SIZES = [500, 2000, 8000]
+
+
+class Path:
+    """
+    Previous Path implementation, kept as reference.
+    """
+
+    def __init__(self,
+            path: List['Path'],
+            node: bblfsh.Node,
+            lines: Set[int]) -> None:
+        self.path = path
+        self.node = node
+        self.is_relevant = is_relevant_node(node, lines=lines)
+        self._children = None
+        self._lines = lines
+        self._depth = None
+        self._size = None
+
+    @property
+    def children(self):
+        if self._children is None:
+            self._children = [Path(
+                path=self.path + [self],
+                node=c,
+                lines=self._lines) for c in self.node.children]
+        return self._children
+
+    @property
+    def depth(self):
+        if self._depth is None:
+            if len(self.children) == 0:
+                self._depth = 1
+            else:
+                self._depth = max([c.depth for c in self.children])+1
+        return self._depth
+
+    @property
+    def size(self):
+        if self._size is None:
+            if len(self.children) == 0:
+                self._size = 1
+            else:
+                self._size = sum([c.size for c in self.children])+1
+        return self._size
+
+def extract_subtrees_paths(
+        uast: bblfsh.Node,
+        min_depth: int,
+        max_depth: int,
+        min_size: int,
+        max_size: int,
+        lines: Iterable[int]) -> Generator[bblfsh.Node,None,None]:
+    """
+    Previous implementation of extract_subtrees, kept as reference.
+    """
+    if not isinstance(lines, set):
+        lines = set(lines)
+    already_extracted: typing.Set[int] = set([])
+    queue = [Path(path=[], node=uast, lines=lines)]
+    while len(queue) > 0:
+        path = queue.pop()
+        if len(path.children) > 0:
+            queue.extend(path.children)
+            continue
+        if path.size > max_size:
+            continue
+        is_relevant = path.is_relevant
+        if is_relevant and path.size >= min_size and path.depth >= min_depth:
+            yield path.node
+        if max_depth == 1:
+            continue
+        for depth in range(2, max_depth+1):
+            if len(path.path) < depth-1:
+                break
+            parent = path.path[-1*(depth - 1)]
+            if parent.depth > max_depth:
+                break
+            if parent.size > max_size:
+                break
+            if parent.size < min_size:
+                continue
+            if parent.depth < min_depth:
+                continue
+            is_relevant |= parent.is_relevant
+            if is_relevant:
+                i = id(parent.node)
+                if i in already_extracted:
+                    continue
+                already_extracted.add(i)
+                yield parent.node
+
+def _measure(extract, uasts, lines):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = []
+    for uast, file_lines in zip(uasts, lines):
+        result.append([id(n) for n in extract(
+            uast=uast,
+            min_depth=DEFAULT_MIN_SUBTREE_DEPTH,
+            max_depth=DEFAULT_MAX_SUBTREE_DEPTH,
+            min_size=DEFAULT_MIN_SUBTREE_SIZE,
+            max_size=DEFAULT_MAX_SUBTREE_SIZE,
+            lines=file_lines)])
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+def run(n_files: int) -> None:
+    print('%6s %12s %12s %14s %14s %6s' % (
+        'nodes', 'paths (s)', 'flat (s)', 'paths (peak)', 'flat (peak)', 'same'))
+    for size in SIZES:
+        rnd = random.Random(size)
+        uasts = [random_bblfsh_uast(rnd, size=size) for _ in range(n_files)]
+        lines = [set(rnd.sample(range(1, u.end_position.line + 1),
+            max(1, u.end_position.line // 10))) for u in uasts]
+        expected, paths_time, paths_peak = _measure(extract_subtrees_paths, uasts, lines)
+        result, flat_time, flat_peak = _measure(extract_subtrees, uasts, lines)
+        print('%6d %12.3f %12.3f %14d %14d %6s' % (
+            size, paths_time, flat_time, paths_peak, flat_peak, expected == result))
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
@@ -0,0 +1,68 @@
+"""
+Matching time of the subtrees of changed files against a mapped model,
+one match_all call per subtree compared with a batched match_many.
+
+Usage: python -m benchmarks.bench_match_many [N_FILES]
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+from badcode.bblfshutil import UAST
+from badcode.extract import extract_subtrees
+from badcode.model import MappedModel
+from badcode.model import write_mapped_model
+from badcode.settings import *
+from badcode.stats import Stats
+
+from .synthetic import random_bblfsh_uast
+from .synthetic import random_lines
+
+def _subtrees(rnd: random.Random, size: int):
+    uast = random_bblfsh_uast(rnd, size=size)
+    lines = random_lines(rnd, uast.end_position.line)
+    return [UAST.from_bblfsh(s) for s in extract_subtrees(uast,
+        min_depth=DEFAULT_MIN_SUBTREE_DEPTH,
+        max_depth=DEFAULT_MAX_SUBTREE_DEPTH,
+        min_size=DEFAULT_MIN_SUBTREE_SIZE,
+        max_size=DEFAULT_MAX_SUBTREE_SIZE,
+        lines=lines)]
+
+def match_all_each(model: MappedModel, uasts):
+    """
+    One match_all per subtree, decoding every match.
+    """
+    return [[(model.pattern(idx), model.text(idx), model.totals(idx)['score'])
+        for idx in model.match_all(uast)] for uast in uasts]
+
+def _time(f) -> float:
+    start = time.perf_counter()
+    f()
+    return time.perf_counter() - start
+
+def run(n_files: int) -> None:
+    rnd = random.Random(n_files)
+    stats = Stats()
+    for n in range(200):
+        for uast in _subtrees(rnd, 2000):
+            stats.deleted('repo%d' % (n % 10), uast, 'snippet')
+    files = [_subtrees(rnd, 2000) for _ in range(n_files)]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'model')
+        write_mapped_model(stats, path)
+        model = MappedModel(path)
+        each = _time(lambda: [match_all_each(model, f) for f in files])
+        batched = _time(lambda: [model.match_many(f) for f in files])
+        matched = sum(1 for f in files for m in model.match_many(f) if m)
+        print('%d patterns, %d files, %d subtrees (%d distinct per file on average), %d matched' % (
+            len(model), len(files), sum(len(f) for f in files),
+            sum(len(set(f)) for f in files) // max(1, len(files)), matched))
+        print('%-16s %12s %12s %8s' % ('', 'match_all (s)', 'match_many (s)', 'speedup'))
+        print('%-16s %12.3f %12.3f %8.1f' % ('', each, batched, each / batched))
+        model.close()
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 50)
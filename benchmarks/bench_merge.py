@@ -0,0 +1,67 @@
+"""
+Scaling of postprocess.merge_similar on synthetic stats, compared with
+the previous pairwise implementation.
+
+Usage: python -m benchmarks.bench_merge [MAX_PAIRWISE_SIZE]
+"""
+
+import pickle
+import random
+import sys
+import time
+
+from badcode.postprocess import merge_similar
+from badcode.stats import Stats
+from badcode.treedist import single_node_merge_precalc
+from badcode.treedist import TreeToSeq
+
+from .synthetic import random_stats
+
+SIZES = [500, 1000, 2000, 4000, 8000, 16000, 32000]
+
+def merge_similar_pairwise(stats: Stats) -> None:
+    """
+    Previous O(n^2) implementation of merge_similar, kept as reference.
+    """
+    uasts = []
+    tts = TreeToSeq()
+    for uast, sstats in stats.totals.items():
+        if len(uast.children) == 0:
+            continue
+        uasts.append((uast, tts.tree_to_seq(uast), sstats))
+    positive_uasts = {}
+    negative_uasts = {}
+    for i, (uast, tree_seq, sstats) in enumerate(uasts):
+        for ouast, otree_seq, osstats in uasts[i+1:]:
+            merged_uast = single_node_merge_precalc(uast, ouast, tree_seq, otree_seq)
+            if merged_uast is None:
+                continue
+            for u, s in ((uast, sstats), (ouast, osstats)):
+                d = positive_uasts if s['added'] >= s['deleted'] else negative_uasts
+                d.setdefault(merged_uast, set([])).add(u)
+    for merged_uast, uast_set in negative_uasts.items():
+        for uast in uast_set:
+            stats.merge_uast(dst=merged_uast, src=uast)
+
+def _time(f, stats: Stats) -> float:
+    start = time.perf_counter()
+    f(stats)
+    return time.perf_counter() - start
+
+def run(max_pairwise_size: int) -> None:
+    print('%8s %14s %14s %8s' % ('patterns', 'bucketed (s)', 'pairwise (s)', 'same'))
+    for size in SIZES:
+        stats = random_stats(random.Random(size), size)
+        data = pickle.dumps(stats)
+        bucketed = pickle.loads(data)
+        bucketed_time = _time(merge_similar, bucketed)
+        if size > max_pairwise_size:
+            print('%8d %14.3f %14s %8s' % (size, bucketed_time, '-', '-'))
+            continue
+        pairwise = pickle.loads(data)
+        pairwise_time = _time(merge_similar_pairwise, pairwise)
+        same = bucketed.totals == pairwise.totals
+        print('%8d %14.3f %14.3f %8s' % (size, bucketed_time, pairwise_time, same))
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 4000)
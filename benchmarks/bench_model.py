@@ -0,0 +1,49 @@
+"""
+Startup and matching time of a pickled Stats model compared with a
+mapped model.
+
+Usage: python -m benchmarks.bench_model [N]
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+from badcode.model import MappedModel
+from badcode.model import load_model
+from badcode.model import write_mapped_model
+
+from .synthetic import random_stats
+from .synthetic import random_uast
+
+def _time(f):
+    start = time.perf_counter()
+    result = f()
+    return result, time.perf_counter() - start
+
+def run(n: int) -> None:
+    stats = random_stats(random.Random(n), n)
+    queries = [random_uast(random.Random(i)) for i in range(2000)]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pickle_path = os.path.join(tmpdir, 'stats.db')
+        mapped_path = os.path.join(tmpdir, 'stats.db_mapped')
+        stats.save(pickle_path)
+        write_mapped_model(stats, mapped_path)
+
+        pickled, pickled_load = _time(lambda: load_model(pickle_path))
+        mapped, mapped_load = _time(lambda: load_model(mapped_path))
+        _, pickled_match = _time(lambda: [pickled.match(q) for q in queries])
+        _, mapped_match = _time(lambda: [mapped.match(q) for q in queries])
+
+        print('%d patterns, %d queries' % (len(stats.totals), len(queries)))
+        print('%-16s %12s %12s' % ('', 'pickle', 'mapped'))
+        print('%-16s %12d %12d' % ('file size (B)',
+            os.path.getsize(pickle_path), os.path.getsize(mapped_path)))
+        print('%-16s %12.4f %12.4f' % ('load (s)', pickled_load, mapped_load))
+        print('%-16s %12.4f %12.4f' % ('match (s)', pickled_match, mapped_match))
+        mapped.close()
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
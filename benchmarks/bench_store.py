@@ -0,0 +1,65 @@
+"""
+Time and peak memory of counting, ranking and pruning patterns with
+in-memory Stats and with SqliteStats. Each run is done in a fresh process,
+so that peak memory includes SQLite's own allocations.
+
+Usage: python -m benchmarks.bench_store [N_PATTERNS]
+"""
+
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+from badcode.postprocess import compute_ranking
+from badcode.postprocess import prune
+from badcode.stats import SqliteStats
+from badcode.stats import Stats
+
+from .synthetic import random_uast
+
+N_REPOS = 10
+
+
+def _run(store: str, n_patterns: int, tmpdir: str, queue) -> None:
+    rnd = random.Random(42)
+    if store == 'sqlite':
+        stats = SqliteStats(os.path.join(tmpdir, 'stats.sqlite'), cache_size=10000)
+    else:
+        stats = Stats()
+    start = time.perf_counter()
+    for _ in range(n_patterns):
+        uast = random_uast(rnd)
+        repo = 'repo%d' % rnd.randrange(N_REPOS)
+        if rnd.random() < 0.5:
+            stats.added(repo, uast, 'text')
+        else:
+            stats.deleted(repo, uast, 'text')
+    count_time = time.perf_counter() - start
+    start = time.perf_counter()
+    compute_ranking(stats)
+    prune(stats, 0.8)
+    rank_time = time.perf_counter() - start
+    patterns = len(stats.totals)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((count_time, rank_time, patterns, peak))
+
+def run(n_patterns: int) -> None:
+    print('%-8s %12s %12s %10s %14s' % (
+        'store', 'count (s)', 'rank (s)', 'pruned', 'peak RSS (KiB)'))
+    for store in ['memory', 'sqlite']:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=_run, args=(store, n_patterns, tmpdir, queue))
+            process.start()
+            count_time, rank_time, patterns, peak = queue.get()
+            process.join()
+        print('%-8s %12.2f %12.2f %10d %14d' % (
+            store, count_time, rank_time, patterns, peak))
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
@@ -0,0 +1,200 @@
+"""
+Benchmark suite for the hot paths of training and analysis, on seeded
+synthetic data. It does not need bblfshd.
+
+Results are written as JSON, so that runs on two commits can be compared:
+
+    python -m benchmarks.suite --output before.json
+    python -m benchmarks.suite --output after.json
+    python -m benchmarks.suite --compare before.json after.json
+
+Use --quick for a short run with the smallest sizes only, and --filter to
+run only the benchmarks whose name contains the given string.
+"""
+
+import argparse
+import datetime
+import json
+import pickle
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import typing
+
+from badcode.extract import extract_subtrees
+from badcode.postprocess import merge_similar
+from badcode.ranker import Ranker
+from badcode.settings import *
+from badcode.stats import Stats
+
+from .synthetic import random_bblfsh_uast
+from .synthetic import random_lines
+from .synthetic import random_queries
+from .synthetic import random_stats
+
+FORMAT_VERSION = 1
+
+
+class Benchmark:
+    """
+    A benchmark function run at several sizes. setup(rnd, size) returns the
+    input, which is passed to run(input). If copy is True, run gets a fresh
+    copy of the input on every repetition, for functions that modify it.
+    """
+
+    def __init__(self,
+            name: str,
+            sizes: typing.List[int],
+            setup: typing.Callable[[random.Random,int],typing.Any],
+            run: typing.Callable[[typing.Any],typing.Any],
+            copy: bool=False) -> None:
+        self.name = name
+        self.sizes = sizes
+        self.setup = setup
+        self.run = run
+        self.copy = copy
+
+    def measure(self, size: int, repeat: int) -> typing.List[float]:
+        data = self.setup(random.Random(size), size)
+        if self.copy:
+            data = pickle.dumps(data)
+        times = []
+        for _ in range(repeat):
+            arg = pickle.loads(data) if self.copy else data
+            start = time.perf_counter()
+            self.run(arg)
+            times.append(time.perf_counter() - start)
+        return times
+
+
+def _setup_extract(rnd: random.Random, size: int):
+    uasts = [random_bblfsh_uast(rnd, size=size) for _ in range(10)]
+    lines = [random_lines(rnd, u.end_position.line) for u in uasts]
+    return list(zip(uasts, lines))
+
+def _run_extract(files) -> None:
+    for uast, lines in files:
+        for _ in extract_subtrees(
+                uast=uast,
+                min_depth=DEFAULT_MIN_SUBTREE_DEPTH,
+                max_depth=DEFAULT_MAX_SUBTREE_DEPTH,
+                min_size=DEFAULT_MIN_SUBTREE_SIZE,
+                max_size=DEFAULT_MAX_SUBTREE_SIZE,
+                lines=lines):
+            pass
+
+def _setup_match(rnd: random.Random, size: int):
+    stats = random_stats(rnd, size)
+    stats.build_index()
+    return stats, random_queries(rnd, stats, 2000)
+
+def _run_match(data) -> None:
+    stats, queries = data
+    for query in queries:
+        stats.match(query)
+
+def _identity(x):
+    return x
+
+def _setup_ranker(rnd: random.Random, size: int):
+    ranker = Ranker(_identity)
+    for _ in range(size):
+        ranker.add(round(rnd.random(), 4))
+    return ranker
+
+def _setup_iadd(rnd: random.Random, size: int):
+    return [random_stats(random.Random(rnd.random()), size // 10, n_repos=1)
+        for _ in range(10)]
+
+def _run_iadd(parts: typing.List[Stats]) -> None:
+    stats = Stats()
+    for part in parts:
+        stats += part
+
+BENCHMARKS = [
+    Benchmark('extract_subtrees', [500, 2000, 8000], _setup_extract, _run_extract),
+    Benchmark('Stats.match', [1000, 10000, 50000], _setup_match, _run_match),
+    Benchmark('merge_similar', [1000, 4000, 16000],
+        lambda rnd, size: random_stats(rnd, size), merge_similar, copy=True),
+    Benchmark('Ranker.finalize', [10000, 100000, 1000000],
+        _setup_ranker, lambda ranker: ranker.finalize(), copy=True),
+    Benchmark('Stats.__iadd__', [1000, 10000, 50000], _setup_iadd, _run_iadd),
+]
+
+
+def _git_revision() -> typing.Optional[str]:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(output: str, repeat: int, quick: bool, name_filter: str) -> None:
+    results = []
+    for benchmark in BENCHMARKS:
+        if name_filter and name_filter not in benchmark.name:
+            continue
+        sizes = benchmark.sizes[:1] if quick else benchmark.sizes
+        for size in sizes:
+            times = benchmark.measure(size, repeat)
+            result = {
+                'name': benchmark.name,
+                'size': size,
+                'times': times,
+                'min': min(times),
+                'median': statistics.median(times),
+            }
+            results.append(result)
+            print('%-18s %8d %10.4f %10.4f' % (
+                benchmark.name, size, result['min'], result['median']))
+            sys.stdout.flush()
+
+    report = {
+        'version': FORMAT_VERSION,
+        'revision': _git_revision(),
+        'date': datetime.datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': repeat,
+        'results': results,
+    }
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Results written to %s' % output)
+
+def compare(before_path: str, after_path: str) -> None:
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    before_results = dict(((r['name'], r['size']), r) for r in before['results'])
+    print('%-18s %8s %10s %10s %8s' % ('benchmark', 'size', 'before', 'after', 'ratio'))
+    for r in after['results']:
+        b = before_results.get((r['name'], r['size']))
+        if b is None:
+            continue
+        print('%-18s %8d %10.4f %10.4f %8.2f' % (
+            r['name'], r['size'], b['min'], r['min'], r['min'] / b['min']))
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='badcode benchmarks')
+    parser.add_argument('--output', type=str, default='benchmark.json')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--quick', action='store_true',
+        help='run only the smallest size of each benchmark')
+    parser.add_argument('--filter', type=str, default='',
+        help='run only benchmarks whose name contains this string')
+    parser.add_argument('--compare', type=str, nargs=2, metavar=('BEFORE', 'AFTER'),
+        help='compare two result files instead of running')
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+    run(args.output, args.repeat, args.quick, args.filter)
+
+if __name__ == '__main__':
+    main()
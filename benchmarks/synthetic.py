@@ -0,0 +1,139 @@
+"""
+Seeded generators of synthetic data for benchmarks: UASTs, stats models
+and changed line sets.
+"""
+
+import random
+import typing
+
+import bblfsh
+
+from badcode.bblfshutil import UAST
+from badcode.stats import Stats
+
+INTERNAL_TYPES = ['Ident', 'CallExpr', 'SelectorExpr', 'BasicLit',
+    'BinaryExpr', 'AssignStmt', 'IfStmt', 'BlockStmt', 'ReturnStmt',
+    'ExprStmt', 'FuncLit', 'CompositeLit', 'KeyValueExpr', 'StarExpr']
+TOKENS = [''] * 8 + ['err', 'nil', 'ctx', 'fmt', 'Errorf', 'len', 'i',
+    'x', 'ok', '0', '1', '"%s"', 'Println', 'append', 'New']
+
+def random_key(rnd: random.Random) -> tuple:
+    return (rnd.choice(INTERNAL_TYPES), rnd.choice(TOKENS))
+
+def random_uast(rnd: random.Random, max_size: int=20, max_children: int=3) -> UAST:
+    """
+    Generate a random UAST with at most max_size nodes.
+    """
+    size = rnd.randint(1, max_size)
+    return _random_uast(rnd, [size], max_children)
+
+def _random_uast(rnd: random.Random, budget: list, max_children: int) -> UAST:
+    budget[0] -= 1
+    children = []
+    for _ in range(rnd.randint(0, max_children)):
+        if budget[0] <= 0:
+            break
+        children.append(_random_uast(rnd, budget, max_children))
+    return UAST(key=random_key(rnd), children=children)
+
+def random_bblfsh_uast(rnd: random.Random,
+        size: int=5000,
+        max_children: int=6,
+        max_depth: int=40) -> bblfsh.Node:
+    """
+    Generate a random bblfsh UAST of about size nodes, shaped like a source
+    file: children span consecutive lines within their parent.
+    """
+    # (parent, key, start line, end line, depth) of each node, parents first
+    shape = [(-1, ('File', ''), 1, 1, 0)]
+    open_nodes = [0]
+    while open_nodes and len(shape) < size:
+        parent = open_nodes.pop(rnd.randrange(len(open_nodes)))
+        _, _, start, _, depth = shape[parent]
+        if depth >= max_depth:
+            continue
+        for _ in range(rnd.randint(1, max_children)):
+            end = start + rnd.randint(0, 3)
+            open_nodes.append(len(shape))
+            shape.append((parent, random_key(rnd), start, end, depth + 1))
+            start = end + rnd.randint(0, 1)
+    # nodes are built bottom-up, since protobuf copies messages added to
+    # a repeated field
+    children: typing.List[typing.List[bblfsh.Node]] = [[] for _ in shape]
+    for idx in range(len(shape) - 1, -1, -1):
+        parent, (internal_type, token), start, end, _ = shape[idx]
+        node = bblfsh.Node()
+        node.internal_type = internal_type
+        node.token = token
+        node.start_position.line = start
+        node.end_position.line = max([end] + [c.end_position.line for c in children[idx]])
+        node.children.extend(reversed(children[idx]))
+        if parent < 0:
+            return node
+        children[parent].append(node)
+    raise AssertionError('unreachable')
+
+def random_stats(rnd: random.Random,
+        n_patterns: int,
+        n_repos: int=10,
+        mutation_rate: float=0.5) -> Stats:
+    """
+    Generate stats with n_patterns distinct random trees. A fraction of
+    them (mutation_rate) are copies of a previous tree with a single node
+    changed, so that they can be merged with wildcards.
+    """
+    stats = Stats()
+    uasts: typing.List[UAST] = []
+    seen = set([])
+    while len(uasts) < n_patterns:
+        if uasts and rnd.random() < mutation_rate:
+            uast = rnd.choice(uasts)
+            uast = uast.replace_key(rnd.randrange(len(uast)), random_key(rnd))
+        else:
+            uast = random_uast(rnd)
+        if uast in seen:
+            continue
+        seen.add(uast)
+        uasts.append(uast)
+    for n, uast in enumerate(uasts):
+        text = 'snippet %d' % n
+        for _ in range(rnd.randint(1, 4)):
+            repo = 'repo%d' % rnd.randrange(n_repos)
+            if rnd.random() < 0.5:
+                stats.added(repo, uast, text)
+            else:
+                stats.deleted(repo, uast, text)
+    return stats
+
+def random_lines(rnd: random.Random,
+        n_lines: int,
+        fraction: float=0.1,
+        max_hunk: int=8) -> typing.Set[int]:
+    """
+    Generate a set of changed lines in a file of n_lines lines, as hunks of
+    consecutive lines covering about the given fraction of the file.
+    """
+    lines: typing.Set[int] = set([])
+    target = max(1, int(n_lines * fraction))
+    while len(lines) < target:
+        start = rnd.randint(1, n_lines)
+        for line in range(start, min(n_lines, start + rnd.randint(1, max_hunk)) + 1):
+            lines.add(line)
+    return lines
+
+def random_queries(rnd: random.Random,
+        stats: Stats,
+        n_queries: int,
+        hit_rate: float=0.5) -> typing.List[UAST]:
+    """
+    Generate trees to match against stats, a fraction of them (hit_rate)
+    taken from its patterns.
+    """
+    patterns = list(stats.totals.keys())
+    queries = []
+    for _ in range(n_queries):
+        if patterns and rnd.random() < hit_rate:
+            queries.append(rnd.choice(patterns))
+        else:
+            queries.append(random_uast(rnd))
+    return queries
@@ -0,0 +1,63 @@
+"""
+Seeded generators of UASTs and stats shared by the tests.
+"""
+
+import random
+from typing import Iterable, Optional
+
+from bblfsh import Node
+
+from badcode.bblfshutil import UAST, WILDCARD
+from badcode.stats import Stats
+
+def random_uast(rnd: random.Random, depth: int, wildcards: bool) -> UAST:
+    def key():
+        internal_type = rnd.choice(['A', 'B', 'C'])
+        token = rnd.choice(['a', 'b', '', 'ñ'])
+        if wildcards and rnd.random() < 0.1:
+            internal_type = WILDCARD
+        if wildcards and rnd.random() < 0.1:
+            token = WILDCARD
+        return (internal_type, token)
+    if depth == 0:
+        return UAST(key=key())
+    n_children = rnd.randint(0, 2)
+    return UAST(key=key(), children=[
+        random_uast(rnd, depth - 1, wildcards) for _ in range(n_children)])
+
+def bblfsh_node(
+        internal_type: str,
+        line: int,
+        children: Iterable[Node]=(),
+        token: str='',
+        end_line: Optional[int]=None) -> Node:
+    """
+    Return a bblfsh node spanning from line to end_line (line if None).
+    Trees must be built bottom-up, since protobuf copies added children.
+    """
+    n = Node()
+    n.internal_type = internal_type
+    n.token = token
+    n.start_position.line = line
+    n.end_position.line = line if end_line is None else end_line
+    n.children.extend(children)
+    return n
+
+def random_stats(rnd: random.Random, repo: str) -> Stats:
+    stats = Stats()
+    for _ in range(200):
+        uast = UAST(key=('A', rnd.choice('abcdefgh')), children=(
+            UAST(key=(rnd.choice('BCD'), rnd.choice('xyz'))),
+        ))
+        if rnd.random() < 0.5:
+            stats.added(repo, uast, 'text %s %s' % (repo, uast))
+        else:
+            stats.deleted(repo, uast, 'text %s %s' % (repo, uast))
+    return stats
+
+def assert_same_stats(a: Stats, b: Stats) -> None:
+    assert list(a.totals.items()) == list(b.totals.items())
+    assert list(a.text.items()) == list(b.text.items())
+    assert list(a.per_repo.keys()) == list(b.per_repo.keys())
+    for repo in a.per_repo:
+        assert list(a.per_repo[repo].items()) == list(b.per_repo[repo].items())
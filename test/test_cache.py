@@ -0,0 +1,82 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from badcode.cache import DiskCache
+from badcode.cache import STALE_TMP_SECONDS
+
+def test_disk_cache():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = DiskCache(tmpdir, max_bytes=1000)
+        assert cache.get('aaaa') is None
+        assert 1 == cache.misses
+        cache.put('aaaa', b'x' * 100)
+        assert b'x' * 100 == cache.get('aaaa')
+        assert 1 == cache.hits
+
+        cache = DiskCache(tmpdir, max_bytes=1000)
+        assert b'x' * 100 == cache.get('aaaa')
+
+def test_disk_cache_eviction():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = DiskCache(tmpdir, max_bytes=1000)
+        now = time.time()
+        for n in range(9):
+            key = '%02d' % n
+            cache.put(key, b'x' * 100)
+            path = os.path.join(tmpdir, key[:2], key)
+            os.utime(path, (now - 100 + n, now - 100 + n))
+        assert 0 == cache.evictions
+        cache.get('00')
+        cache.put('09', b'x' * 200)
+        assert 2 == cache.evictions
+        assert cache.get('01') is None
+        assert cache.get('02') is None
+        assert cache.get('00') is not None
+        assert cache.get('09') is not None
+
+def test_disk_cache_overwrite():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = DiskCache(tmpdir, max_bytes=1000)
+        for _ in range(20):
+            cache.put('aaaa', b'x' * 100)
+        assert 100 == cache._size
+        assert 0 == cache.evictions
+        cache.put('aaaa', b'x' * 50)
+        assert 50 == cache._size
+
+def test_disk_cache_stale_tmp():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = DiskCache(tmpdir, max_bytes=1000)
+        os.mkdir(os.path.join(tmpdir, 'aa'))
+        stale = os.path.join(tmpdir, 'aa', '.tmpstale')
+        fresh = os.path.join(tmpdir, 'aa', '.tmpfresh')
+        for path in [stale, fresh]:
+            with open(path, 'wb') as f:
+                f.write(b'x' * 10)
+        old = time.time() - 2 * STALE_TMP_SECONDS
+        os.utime(stale, (old, old))
+        cache.put('aaaa', b'x' * 2000)
+        assert not os.path.exists(stale)
+        assert os.path.exists(fresh)
+
+def test_disk_cache_threads():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = DiskCache(tmpdir, max_bytes=5000)
+        n_threads = 8
+        n_ops = 200
+        def work(n):
+            for i in range(n_ops):
+                key = '%02d%d' % ((n + i) % 40, i % 3)
+                if cache.get(key) is None:
+                    cache.put(key, b'x' * (50 + 10 * (i % 5)))
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(n_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert n_threads * n_ops == cache.hits + cache.misses
+        assert sum(size for _, _, size in cache._entries()) == cache._size
+        assert cache._size <= cache.max_bytes
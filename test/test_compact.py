@@ -0,0 +1,161 @@
+import copy
+import pickle
+import unittest
+
+from bblfsh import Node
+
+from badcode.bblfshutil import UAST, WILDCARD
+from badcode.compact import CompactUAST
+from badcode.compact import FileUAST
+from badcode.compact import KEYS
+from badcode.treedist import single_node_merge
+from badcode.treedist import single_node_merge_precalc
+from badcode.treedist import TreeToSeq
+
+from .factories import bblfsh_node
+
+def sample_uast() -> UAST:
+    return UAST(key=('A', 'a'), children=(
+        UAST(key=('A1', 'a1')),
+        UAST(key=('A2', 'a2'), children=(
+            UAST(key=('A21', 'a21')),
+            UAST(key=('A22', 'a22')),
+        )),
+        UAST(key=('A3', 'a3')),
+    ))
+
+def test_compact_from_tree():
+    u = sample_uast()
+    c = CompactUAST.from_tree(u)
+    assert len(u) == len(c)
+    assert u.key == c.key
+    assert [n.key for n in u] == [n.key for n in c]
+    assert [len(n) for n in u] == [len(n) for n in c]
+    assert [n.key for n in u.children] == [n.key for n in c.children]
+    assert [n.key for n in u.children[1].children] == [n.key for n in c.children[1].children]
+    assert 'CompactUAST(key=(\'A1\', \'a1\'))' == repr(c.children[0])
+    assert str(u) == str(c)
+
+def test_compact_from_bblfsh():
+    root = Node()
+    root.internal_type = 'A'
+    root.token = 'a'
+    child1 = Node()
+    child1.internal_type = 'B'
+    child1.token = 'b'
+    child2 = Node()
+    child2.internal_type = 'C'
+    position = Node()
+    position.internal_type = 'Position'
+    child2.children.extend([position])
+    root.children.extend([child1, child2])
+
+    c = CompactUAST.from_bblfsh(root)
+    u = UAST.from_bblfsh(root)
+    assert 3 == len(c)
+    assert [n.key for n in u] == [n.key for n in c]
+
+def test_file_uast():
+    def node(internal_type, line, children=()):
+        return bblfsh_node(internal_type, line, children,
+            token=internal_type.lower(), end_line=line + 1)
+
+    root = node('A', 1, [
+        node('B', 1, [node('B1', 1), node('Position', 0)]),
+        node('C', 2, [node('C1', 3, [node('C11', 3)])])])
+    f = FileUAST.from_bblfsh(root)
+    assert ['A', 'C', 'C1', 'C11', 'B', 'Position', 'B1'] == [f.internal_type(p) for p in range(len(f))]
+    assert ('C1', 'c1') == f.key(2)
+    assert [1, 2, 3, 3, 1, 0, 1] == list(f.starts)
+    assert [2, 3, 4, 4, 2, 1, 2] == list(f.ends)
+    assert [7, 3, 2, 1, 3, 1, 1] == list(f.sizes)
+    assert 7 == len(f.table)
+
+    converted = {}
+    c = f.to_uast(1, converted)
+    assert UAST.from_bblfsh(root.children[1]) == c
+    # Position nodes are only kept as children of the root
+    b = f.to_uast(4, converted)
+    assert UAST.from_bblfsh(root.children[0]) == b
+    assert [('B1', 'b1'), ('Position', 'position')] == [n.key for n in b.children]
+    a = f.to_uast(0, converted)
+    assert UAST.from_bblfsh(root) == a
+    assert c is a.children[1]
+    assert [('B', 'b'), ('B1', 'b1')] == [n.key for n in a.children[0]]
+    assert b.children[0] is a.children[0].children[0]
+
+    for g in [FileUAST.from_bytes(f.to_bytes()), pickle.loads(pickle.dumps(f))]:
+        assert isinstance(g, FileUAST)
+        assert f.table == g.table
+        assert f.keys == g.keys
+        assert f.sizes == g.sizes
+        assert f.starts == g.starts
+        assert f.ends == g.ends
+
+def test_file_uast_keys():
+    # keys of files are not interned in KEYS
+    root = Node()
+    root.internal_type = 'Ident'
+    root.token = 'file_uast_keys_token'
+    child = Node()
+    child.internal_type = 'Ident'
+    child.token = 'file_uast_keys_token'
+    root.children.extend([child])
+    n_keys = len(KEYS)
+    f = FileUAST.from_bblfsh(root)
+    f.to_uast(0, {})
+    FileUAST.from_bytes(f.to_bytes())
+    assert n_keys == len(KEYS)
+    assert [('Ident', 'file_uast_keys_token')] == f.table
+
+def test_compact_eq_hash():
+    a = CompactUAST.from_tree(sample_uast())
+    b = CompactUAST.from_tree(sample_uast())
+    assert a == b
+    assert hash(a) == hash(b)
+    assert a.children[1] == CompactUAST.from_tree(sample_uast().children[1])
+    assert hash(a.children[1]) == hash(CompactUAST.from_tree(sample_uast().children[1]))
+    assert a != a.children[1]
+    assert a != None
+
+    c = a.with_children(a.children[:2])
+    assert c != a
+    assert c == CompactUAST.from_tree(sample_uast().with_children(sample_uast().children[:2]))
+
+def test_compact_fingerprint():
+    u = sample_uast()
+    c = CompactUAST.from_tree(u)
+    assert u.fingerprint == c.fingerprint
+    assert u.children[1].fingerprint == c.children[1].fingerprint
+    assert c.fingerprint == pickle.loads(pickle.dumps(c))._fingerprint
+
+def test_compact_pickle_copy():
+    a = CompactUAST.from_tree(sample_uast())
+    assert a == pickle.loads(pickle.dumps(a))
+    assert a.children[1] == pickle.loads(pickle.dumps(a.children[1]))
+    assert a.children[1] == copy.copy(a.children[1])
+
+def test_compact_match():
+    u = sample_uast()
+    w = u.replace_key(3, ('A22', WILDCARD))
+    c = CompactUAST.from_tree(u)
+    cw = CompactUAST.from_tree(w)
+    assert cw == c.replace_key(3, ('A22', WILDCARD))
+    assert cw.match(c)
+    assert cw.match(u)
+    assert c.match(c)
+    assert not c.match(c.replace_key(1, ('X', 'x')))
+    assert not c.match(c.children[1])
+
+def test_compact_treedist():
+    a = sample_uast()
+    b = a.replace_key(2, ('B', 'b'))
+    ca = CompactUAST.from_tree(a)
+    cb = CompactUAST.from_tree(b)
+    merged = single_node_merge(a, b)
+    assert CompactUAST.from_tree(merged) == single_node_merge(ca, cb)
+
+    tts = TreeToSeq()
+    merged = single_node_merge_precalc(ca, cb,
+        tts.tree_to_seq(ca), tts.tree_to_seq(cb))
+    assert CompactUAST.from_tree(single_node_merge(a, b)) == merged
@@ -1,10 +1,26 @@
 
+import difflib
+import random
 import unittest
 
 from bblfsh import Node
+from badcode.bblfshutil import UAST
+from badcode.compact import FileUAST
+from badcode.core import File
 from badcode.extract import extract_subtrees
 from badcode.extract import extract_paths
+from badcode.extract import _get_start_end_lines
+from badcode.extract import _LineIndex
+from badcode.extract import _Nodes
+from badcode.extract import _flatten
+from badcode.extract import LineIntervals
+from badcode.extract import TreeExtractor
+from badcode.extract import added_lines
+from badcode.extract import first_line
 from badcode.extract import is_relevant_node
+from badcode.extract import uast_blob_to_snippet
+
+from .factories import bblfsh_node
 
 def test_is_relevant_node():
     node = Node()
@@ -97,3 +113,132 @@ def test_extract_subtrees_all_positions():
     assert child2 in subtrees
 
 
+def test_extract_subtrees_order():
+    node = bblfsh_node
+    root = node('root', 1, [
+        node('1', 1, [node('1a', 1), node('1b', 2)]),
+        node('2', 3, [node('2a', 3, [node('2a1', 3)])])])
+
+    paths = [n.internal_type for n in extract_paths(root, lines=set([1]))]
+    assert ['2a1', '1b', '1a'] == paths
+
+    subtrees = [s.internal_type for s in extract_subtrees(root,
+        min_depth=2, max_depth=3, min_size=1, max_size=100, lines=set([1, 3]))]
+    assert ['2a', '2', '1'] == subtrees
+
+    subtrees = [s.internal_type for s in extract_subtrees(root,
+        min_depth=1, max_depth=3, min_size=2, max_size=3, lines=set([2]))]
+    assert ['1'] == subtrees
+
+def test_get_snippets():
+    node = bblfsh_node
+    root = node('root', 1, [
+        node('1', 1, [node('1a', 1), node('1b', 2)]),
+        node('2', 3, [node('2a', 3, [node('2a1', 3)])])])
+    content = b'a\nb\nc\n'
+    extractor = TreeExtractor(min_depth=1, max_depth=3, min_size=1, max_size=100)
+    expected = [UAST.from_bblfsh(s) for s in extract_subtrees(root,
+        min_depth=1, max_depth=3, min_size=1, max_size=100, lines=set([2, 3]))]
+
+    for uast in [root, FileUAST.from_bblfsh(root)]:
+        snippets = list(extractor.get_snippets(
+            file=File(path='a.go', hash='', content=content, uast=uast),
+            lines=set([2, 3])))
+        assert expected == [s for _, s, _ in snippets]
+        assert [3, 3, 3, 2, 1] == [l for l, _, _ in snippets]
+        assert ['c', 'c', 'c', 'b', 'a\nb'] == [t for _, _, t in snippets]
+        # overlapping subtrees share their nodes
+        assert snippets[0][1] is snippets[1][1].children[0]
+        assert snippets[3][1] is snippets[4][1].children[1]
+
+def test_get_snippets_positions():
+    # unfiltered trees, as the analyzer gets them, give the same subtrees
+    # as UAST.from_bblfsh
+    def random_node(rnd, depth, line):
+        internal_type = rnd.choice(['A', 'B', 'Position'])
+        end_line = line + rnd.randint(0, 2)
+        children = []
+        if depth > 0:
+            children = [random_node(rnd, depth - 1, line + i)
+                for i in range(rnd.randint(0, 3))]
+        return bblfsh_node(internal_type, line, children, end_line=end_line)
+
+    rnd = random.Random(42)
+    extractor = TreeExtractor(min_depth=1, max_depth=3, min_size=1, max_size=20)
+    for _ in range(200):
+        root = random_node(rnd, 5, 1)
+        lines = set(rnd.sample(range(1, 10), 3))
+        expected = []
+        for subtree in extract_subtrees(root,
+                min_depth=1, max_depth=3, min_size=1, max_size=20, lines=lines):
+            if subtree.internal_type == 'Position':
+                break
+            expected.append(UAST.from_bblfsh(subtree))
+        snippets = extractor.get_snippets(
+            file=File(path='a.go', hash='', content=b'a\n' * 20, uast=root),
+            lines=lines)
+        assert expected == [s for _, s, _ in snippets]
+
+def test_line_index():
+    text = 'a\nbb\n\nccc\n'
+    index = _LineIndex(text.encode())
+    for start in range(-1, 8):
+        for end in range(-1, 8):
+            node = Node()
+            node.start_position.line = start
+            node.end_position.line = end
+            assert uast_blob_to_snippet(node, text) == index.lines(start, end)
+
+def test_node_spans():
+    node = lambda line, children=(): bblfsh_node('', line, children)
+    root = node(0, [node(3, [node(0), node(4)]), node(0, [node(2)]), node(5)])
+    nodes = _Nodes(root, set([]))
+    for idx, n in enumerate(_flatten(root)):
+        assert _get_start_end_lines(n) == (nodes.starts[idx], nodes.ends[idx])
+        assert first_line(n) == nodes.first_lines[idx]
+
+def test_line_intervals():
+    lines = LineIntervals([7, 1, 2, 3, 10, 8])
+    assert [1, 7, 10] == lines.starts
+    assert [3, 8, 10] == lines.ends
+    assert [1, 2, 3, 7, 8, 10] == [l for l in range(0, 12) if l in lines]
+    assert lines.overlaps(4, 7)
+    assert lines.overlaps(0, 1)
+    assert lines.overlaps(9, 12)
+    assert not lines.overlaps(4, 6)
+    assert not lines.overlaps(11, 20)
+    assert not lines.overlaps(8, 7)
+    assert not LineIntervals([]).overlaps(1, 10)
+
+def test_line_intervals_from_ranges():
+    lines = LineIntervals.from_ranges([(7, 8), (1, 2), (3, 3), (10, 10), (8, 9), (5, 4)])
+    assert [1, 7] == lines.starts
+    assert [3, 10] == lines.ends
+    assert [1, 2, 3, 7, 8, 9, 10] == list(lines)
+    assert 7 == len(lines)
+    assert 0 == len(LineIntervals.from_ranges([]))
+
+def test_added_lines():
+    base = b'a\nb\n}\nc\n}\n'
+    head = b'a\nx\nb\n}\n}\nc\nd\n}\n'
+    assert [2, 5, 7] == list(added_lines(base, head))
+    assert [2] == list(added_lines('a\nb\n', 'a\nc\n'))
+    assert [1, 2] == list(added_lines(b'', b'a\nb'))
+    assert [] == list(added_lines(b'a\nb\n', b'a\n'))
+    assert [] == list(added_lines(b'a\n', b'a\n'))
+
+def test_added_lines_difflib():
+    # with distinct lines, the diff is the same as difflib's
+    rnd = random.Random(42)
+    for _ in range(50):
+        base = ['line %d' % n for n in rnd.sample(range(100), 40)]
+        head = [l for l in base if rnd.random() < 0.8]
+        for _ in range(rnd.randint(0, 10)):
+            head.insert(rnd.randint(0, len(head)), 'new %d' % rnd.random())
+        expected = set()
+        opcodes = difflib.SequenceMatcher(None, base, head).get_opcodes()
+        for tag, _, _, j1, j2 in opcodes:
+            if tag in ('insert', 'replace'):
+                expected |= set(range(j1 + 1, j2 + 1))
+        lines = added_lines('\n'.join(base) + '\n', '\n'.join(head) + '\n')
+        assert sorted(expected) == list(lines)
@@ -0,0 +1,58 @@
+import random
+import unittest
+
+from badcode.bblfshutil import UAST, WILDCARD
+from badcode.index import PatternIndex
+
+from .factories import random_uast
+
+def test_pattern_index_match():
+    a = UAST(key=('A', 'a'), children=(
+        UAST(key=('B', 'b')),
+    ))
+    b = UAST(key=('A', 'a'), children=(
+        UAST(key=('B', WILDCARD)),
+    ))
+    c = UAST(key=('A', 'a'), children=(
+        UAST(key=(WILDCARD, WILDCARD)),
+    ))
+    index = PatternIndex([a, b, c])
+    assert 3 == len(index)
+
+    assert [a, b, c] == index.match_all(a)
+    assert a == index.match(a)
+
+    d = UAST(key=('A', 'a'), children=(
+        UAST(key=('B', 'x')),
+    ))
+    assert [b, c] == index.match_all(d)
+    assert b == index.match(d)
+
+    e = UAST(key=('A', 'a'), children=(
+        UAST(key=('C', 'x')),
+    ))
+    assert [c] == index.match_all(e)
+
+    assert index.match(UAST(key=('A', 'a'))) is None
+    assert index.match(UAST(key=('A', 'a'), children=(
+        UAST(key=('B', 'b')),
+        UAST(key=('B', 'b')),
+    ))) is None
+
+def test_pattern_index_same_as_scan():
+    rnd = random.Random(42)
+    patterns = list(set(random_uast(rnd, 2, wildcards=True) for _ in range(300)))
+    index = PatternIndex(patterns)
+    for _ in range(300):
+        uast = random_uast(rnd, 2, wildcards=rnd.random() < 0.2)
+        expected = [p for p in patterns if p.match(uast)]
+        assert expected == index.match_all(uast)
+
+def test_pattern_index_match_many():
+    rnd = random.Random(7)
+    patterns = list(set(random_uast(rnd, 2, wildcards=True) for _ in range(300)))
+    index = PatternIndex(patterns)
+    uasts = [random_uast(rnd, 2, wildcards=rnd.random() < 0.2) for _ in range(300)]
+    uasts += uasts[:50]
+    assert [index.match_all(u) for u in uasts] == index.match_many(uasts)
+    assert [] == index.match_many([])
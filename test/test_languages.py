@@ -0,0 +1,35 @@
+import pathlib
+import re
+
+import pytest
+
+from badcode.languages import get_language
+from badcode.languages import include_pattern
+from badcode.languages import language_path
+from badcode.languages import parse_languages
+
+def test_get_language():
+    assert 'Go' == get_language('main.go')
+    assert 'Go' == get_language('a/b/MAIN.GO')
+    assert 'Python' == get_language('setup.py')
+    assert 'C++' == get_language('src/a.cc')
+    assert 'Other' == get_language('README')
+    assert 'Other' == get_language('a.go/README')
+    assert 'Other' == get_language('a.txt')
+
+def test_language_path():
+    assert pathlib.Path('data/go/stats.db') == language_path('data/stats.db', 'Go')
+    assert pathlib.Path('data/stats/org/repo/cpp/stats.db') == language_path(
+        pathlib.Path('data/stats/org/repo/stats.db'), 'C++')
+
+def test_parse_languages():
+    assert ['Go', 'C++', 'Python'] == parse_languages('go,cpp, Python,Go')
+    with pytest.raises(ValueError):
+        parse_languages('Go,Cobol')
+
+def test_include_pattern():
+    pattern = re.compile(include_pattern(['Go', 'C++']))
+    assert pattern.match('a/b.go')
+    assert pattern.match('a/b.cpp')
+    assert not pattern.match('a/b.py')
+    assert not pattern.match('a/bgo')
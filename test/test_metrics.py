@@ -0,0 +1,79 @@
+import os
+import tempfile
+import urllib.request
+import unittest
+
+from badcode.metrics import Registry
+from badcode.metrics import start_http_server
+
+def test_counter():
+    registry = Registry()
+    counter = registry.counter('test_total', 'Test counter.')
+    counter.inc()
+    counter.inc(2)
+    counter.inc(cache='disk')
+    assert 3 == counter.get()
+    assert 1 == counter.get(cache='disk')
+    assert 0 == counter.get(cache='memory')
+    assert registry.render() == (
+        '# HELP test_total Test counter.\n'
+        '# TYPE test_total counter\n'
+        'test_total 3\n'
+        'test_total{cache="disk"} 1\n')
+
+def test_histogram():
+    registry = Registry()
+    histogram = registry.histogram('test_seconds', 'Test histogram.', buckets=[1, 5])
+    histogram.observe(0.5)
+    histogram.observe(1)
+    histogram.observe(7.5)
+    with histogram.time(stage='a'):
+        pass
+    assert 3 == histogram.count()
+    assert 9.0 == histogram.sum()
+    assert 1 == histogram.count(stage='a')
+    lines = registry.render().splitlines()
+    assert 'test_seconds_bucket{le="1"} 2' in lines
+    assert 'test_seconds_bucket{le="5"} 2' in lines
+    assert 'test_seconds_bucket{le="+Inf"} 3' in lines
+    assert 'test_seconds_sum 9.0' in lines
+    assert 'test_seconds_count 3' in lines
+    assert 'test_seconds_count{stage="a"} 1' in lines
+
+def test_drain_merge():
+    worker = Registry()
+    parent = Registry()
+    for registry in (worker, parent):
+        registry.counter('test_total', 'Test counter.')
+        registry.histogram('test_seconds', 'Test histogram.', buckets=[1])
+    worker._metrics['test_total'].inc(2)
+    worker._metrics['test_seconds'].observe(2)
+    parent._metrics['test_total'].inc()
+    parent.merge(worker.drain())
+    assert 3 == parent._metrics['test_total'].get()
+    assert 1 == parent._metrics['test_seconds'].count()
+    assert 0 == worker._metrics['test_total'].get()
+
+    parent.merge(worker.drain())
+    assert 3 == parent._metrics['test_total'].get()
+
+def test_write():
+    registry = Registry()
+    registry.counter('test_total', 'Test counter.').inc()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'metrics.prom')
+        registry.write(path)
+        with open(path) as f:
+            assert registry.render() == f.read()
+
+def test_http_server():
+    registry = Registry()
+    registry.counter('test_total', 'Test counter.').inc()
+    server = start_http_server('127.0.0.1', 0, registry)
+    try:
+        url = 'http://127.0.0.1:%d/metrics' % server.server_address[1]
+        with urllib.request.urlopen(url) as response:
+            assert registry.render() == response.read().decode('utf-8')
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,119 @@
+import os
+import random
+import tempfile
+import unittest
+
+from badcode.bblfshutil import UAST, WILDCARD
+from badcode.compact import CompactUAST
+from badcode.model import LanguageModels
+from badcode.model import MappedModel
+from badcode.model import is_mapped_model
+from badcode.model import load_model
+from badcode.model import write_mapped_model
+from badcode.stats import Stats
+
+from .factories import random_uast
+
+def test_mapped_model():
+    rnd = random.Random(42)
+    stats = Stats()
+    for n in range(300):
+        uast = random_uast(rnd, 2, wildcards=True)
+        stats.deleted('repo1', uast, 'text %d' % n)
+        stats.totals[uast]['score'] = rnd.random()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'model')
+        write_mapped_model(stats, path)
+        assert is_mapped_model(path)
+        model = load_model(path)
+        assert isinstance(model, MappedModel)
+        assert len(stats.totals) == len(model)
+
+        patterns = list(stats.totals.keys())
+
+        for _ in range(300):
+            uast = random_uast(rnd, 2, wildcards=rnd.random() < 0.2)
+            expected = stats.match(uast)
+            matched = model.match(uast)
+            if expected is None:
+                assert matched is None
+                continue
+            assert [n.key for n in expected[0]] == [n.key for n in matched[0]]
+            assert expected[1] == matched[1]
+            found = model.match_all(uast)
+            expected_all = [p for p in patterns if p.match(uast)]
+            assert len(expected_all) == len(found)
+            for idx, p in zip(found, expected_all):
+                assert CompactUAST.from_tree(p) == model.pattern(idx)
+                assert stats.text[p] == model.text(idx)
+                assert stats.totals[p]['score'] == model.totals(idx)['score']
+                assert stats.totals[p]['deleted'] == model.totals(idx)['deleted']
+        model.close()
+
+def test_mapped_model_match_many():
+    rnd = random.Random(3)
+    stats = Stats()
+    for n in range(300):
+        uast = random_uast(rnd, 2, wildcards=True)
+        stats.deleted('repo1', uast, 'text %d' % n)
+        stats.totals[uast]['score'] = rnd.random()
+    uasts = [random_uast(rnd, 2, wildcards=rnd.random() < 0.1) for _ in range(300)]
+    uasts += uasts[:50]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'model')
+        write_mapped_model(stats, path)
+        model = MappedModel(path)
+        found = model.match_many(uasts)
+        expected = stats.match_many(uasts)
+        assert [model.match_all(u) for u in uasts] == model._match_distinct(uasts)
+        assert len(expected) == len(found)
+        assert any(expected)
+        for matches, expected_matches in zip(found, expected):
+            assert [(CompactUAST.from_tree(m.pattern), m.text, m.score) for m in expected_matches] == \
+                [(m.pattern, m.text, m.score) for m in matches]
+        model.close()
+
+def test_load_model_stats():
+    stats = Stats()
+    a = UAST(key=('A', 'a'))
+    stats.added('repo1', a, 'a')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'stats.db')
+        stats.save(path)
+        assert not is_mapped_model(path)
+        model = load_model(path)
+        assert isinstance(model, Stats)
+        assert (a, 'a') == model.match(a)
+
+def test_language_models():
+    rnd = random.Random(1)
+    stats = Stats()
+    uast = random_uast(rnd, 2, wildcards=False)
+    stats.deleted('repo1', uast, 'text')
+    stats.totals[uast]['score'] = 1.0
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        template = os.path.join(tmpdir, '{language}', 'model')
+        models = LanguageModels(template, ['Go', 'C++', 'Python'])
+        assert models.path('C++') == os.path.join(tmpdir, 'cpp', 'model')
+        os.mkdir(os.path.join(tmpdir, 'go'))
+        write_mapped_model(stats, models.path('Go'))
+
+        assert models.available() == ['Go']
+        assert models.loaded() == []
+        assert models.get('Python') is None
+        assert models.get('Java') is None
+        assert models.get(None) is None
+        assert models.loaded() == []
+        model = models.get('Go')
+        assert model.match(uast) is not None
+        assert models.loaded() == ['Go']
+        assert models.get('Go') is model
+
+        # models trained later are found
+        os.mkdir(os.path.join(tmpdir, 'python'))
+        write_mapped_model(stats, models.path('Python'))
+        assert models.available() == ['Go', 'Python']
+        assert models.get('Python') is not None
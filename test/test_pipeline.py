@@ -0,0 +1,88 @@
+import os
+import tempfile
+
+import badcode
+from badcode.pipeline import Pipeline
+from badcode.pipeline import Stage
+from badcode.pipeline import package_sources
+from badcode.pipeline import read_key
+
+def _read(path):
+    with open(path) as f:
+        return f.read()
+
+def _write(value, path):
+    with open(path, 'w') as f:
+        f.write(value)
+
+def _upper(paths, value, params):
+    if value is None:
+        value = _read(paths[0])
+    return value.upper() + params.get('suffix', '')
+
+def _join(paths, value, params):
+    if value is None:
+        value = _read(paths[0])
+    return '+'.join([value] + [_read(p) for p in paths[1:]])
+
+def _stages(tmpdir, suffix='!'):
+    path = lambda name: os.path.join(tmpdir, name)
+    return [
+        Stage('source', path('source')),
+        Stage('a', path('a'), inputs=['source'], run=_upper, save=_write,
+            params={'suffix': suffix}),
+        Stage('b', path('b'), inputs=['source'], run=_upper, save=_write),
+        Stage('c', path('c'), inputs=['a', 'b'], run=_join, save=_write),
+        Stage('d', path('d'), inputs=['c'], run=_upper, save=_write),
+    ]
+
+def test_pipeline():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        _write('x', os.path.join(tmpdir, 'source'))
+        pipeline = Pipeline(_stages(tmpdir))
+        assert ['a', 'b', 'c', 'd'] == pipeline.run()
+        assert 'X!+X' == _read(os.path.join(tmpdir, 'd'))
+        keys = pipeline.keys()
+        assert keys['d'] == read_key(os.path.join(tmpdir, 'd'))
+        assert [] == pipeline.run()
+
+        # parameters only invalidate the stages depending on them
+        assert ['a', 'c', 'd'] == Pipeline(_stages(tmpdir, suffix='?')).run()
+        assert 'X?+X' == _read(os.path.join(tmpdir, 'd'))
+
+        # missing artifacts are run again
+        os.unlink(os.path.join(tmpdir, 'b'))
+        assert ['b'] == Pipeline(_stages(tmpdir, suffix='?')).run()
+
+        # as well as everything depending on a changed source
+        _write('y', os.path.join(tmpdir, 'source'))
+        assert ['a', 'b', 'c', 'd'] == Pipeline(_stages(tmpdir, suffix='?')).run(workers=2)
+        assert 'Y?+Y' == _read(os.path.join(tmpdir, 'd'))
+
+def test_pipeline_tasks():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        _write('x', os.path.join(tmpdir, 'source'))
+        pipeline = Pipeline(_stages(tmpdir))
+        stale = pipeline.stale()
+        names = lambda tasks: [[s.name for s in t] for t in tasks]
+        # c only takes a in memory if b was run before
+        assert [['a'], ['b'], ['c', 'd']] == names(pipeline.tasks(stale, parallel=False))
+        stale = [stale[1], stale[0]] + stale[2:]
+        assert [['b'], ['a', 'c', 'd']] == names(pipeline.tasks(stale, parallel=False))
+        assert [['b'], ['a'], ['c', 'd']] == names(pipeline.tasks(stale, parallel=True))
+
+def test_pipeline_sources():
+    sources = [os.path.basename(p) for p in package_sources(badcode)]
+    for name in ['compact.py', 'index.py', 'runs.py', 'stats.py', 'tree.py']:
+        assert name in sources
+    with tempfile.TemporaryDirectory() as tmpdir:
+        _write('x', os.path.join(tmpdir, 'source'))
+        module = os.path.join(tmpdir, 'module.py')
+        _write('A = 1', module)
+        stages = lambda: [
+            Stage('source', os.path.join(tmpdir, 'source')),
+            Stage('a', os.path.join(tmpdir, 'a'), inputs=['source'], run=_upper,
+                save=_write, modules=[module]),
+        ]
+        assert ['a'] == Pipeline(stages()).run()
+        assert [] == Pipeline(stages()).run()
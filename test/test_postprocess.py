@@ -0,0 +1,111 @@
+import argparse
+import itertools
+import os
+import random
+import tempfile
+import unittest
+
+from badcode import postprocess as postprocess_module
+from badcode.bblfshutil import UAST, WILDCARD
+from badcode.languages import language_path
+from badcode.model import load_model
+from badcode.pipeline import Pipeline
+from badcode.postprocess import compute_ranking
+from badcode.postprocess import compute_scores
+from badcode.postprocess import merge_similar
+from badcode.postprocess import postprocess
+from badcode.postprocess import postprocess_stages
+from badcode.postprocess import score1
+from badcode.postprocess import similar_pairs
+from badcode.stats import Stats
+
+from .test_store import as_dicts
+from .test_store import fill
+
+def _similar_pairs(seqs):
+    expected = []
+    for i, j in itertools.combinations(range(len(seqs)), 2):
+        a, b = seqs[i], seqs[j]
+        if len(a) != len(b):
+            continue
+        if sum(1 for x, y in zip(a, b) if x != y) == 1:
+            expected.append((i, j))
+    return expected
+
+def test_similar_pairs():
+    rnd = random.Random(42)
+    seqs = [[rnd.randint(1, 3) for _ in range(rnd.randint(1, 4))] for _ in range(200)]
+    assert _similar_pairs(seqs) == similar_pairs(seqs)
+    assert [] == similar_pairs([])
+
+def test_similar_pairs_collisions(monkeypatch):
+    # with few hash values, most buckets mix different sequences
+    monkeypatch.setattr(postprocess_module, '_HASH_MOD', 5)
+    rnd = random.Random(42)
+    seqs = [[rnd.randint(1, 3) for _ in range(rnd.randint(1, 5))] for _ in range(200)]
+    assert _similar_pairs(seqs) == similar_pairs(seqs)
+
+def test_merge_similar():
+    a = UAST(key=('A', 'a'), children=(UAST(key=('B', 'b')),))
+    b = UAST(key=('A', 'a'), children=(UAST(key=('B', 'c')),))
+    c = UAST(key=('A', 'a'), children=(UAST(key=('C', 'c')),))
+    merged = UAST(key=('A', 'a'), children=(UAST(key=('B', WILDCARD)),))
+
+    stats = Stats()
+    stats.deleted('repo1', a, 'a')
+    stats.deleted('repo1', b, 'b')
+    stats.added('repo1', c, 'c')
+    merge_similar(stats)
+    assert {'added': 0, 'deleted': 2, 'merged': 2, 'merged_negative': 2} == stats.totals[merged]
+    merged = UAST(key=('A', 'a'), children=(UAST(key=(WILDCARD, 'c')),))
+    assert {'added': 0, 'deleted': 1, 'merged': 1, 'merged_negative': 1} == stats.totals[merged]
+    merged = UAST(key=('A', 'a'), children=(UAST(key=(WILDCARD, WILDCARD)),))
+    assert {'added': 0, 'deleted': 1, 'merged': 1, 'merged_negative': 1} == stats.totals[merged]
+    assert 6 == len(stats.totals)
+
+def test_compute_scores():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'stats.db')
+        expected = fill(Stats(), random.Random(1))
+        expected.save_run(path)
+        stats = Stats.load(path)
+        scores = compute_scores(path)
+        assert len(stats.totals) == len(scores)
+        for uast in stats.totals:
+            assert score1(stats, uast) == scores[uast.fingerprint]
+
+        ranked = Stats.load(path)
+        merge_similar(stats)
+        merge_similar(ranked)
+        compute_ranking(stats)
+        compute_ranking(ranked, scores=scores)
+        assert as_dicts(stats) == as_dicts(ranked)
+
+def test_postprocess():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        args = argparse.Namespace(
+            stats=os.path.join(tmpdir, 'stats.db'),
+            languages=['Go', 'Python'],
+            stats_store='memory',
+            min_score=0.5,
+            postprocess_workers=1)
+        for n, language in enumerate(args.languages):
+            path = str(language_path(args.stats, language))
+            os.mkdir(os.path.dirname(path))
+            fill(Stats(), random.Random(n)).save_run(path)
+
+        postprocess(args)
+        for language in args.languages:
+            path = str(language_path(args.stats, language))
+            model = load_model(path + '_merged_ranked_pruned_mapped')
+            pruned = Stats.load(path + '_merged_ranked_pruned')
+            assert 0 < len(model) == len(pruned.totals)
+
+        stages = lambda: postprocess_stages(
+            str(language_path(args.stats, 'Go')), args, prefix='go:')
+        assert [] == Pipeline(stages()).stale()
+        args.min_score = 0.6
+        assert ['go:pruned', 'go:mapped'] == [s.name for s in Pipeline(stages()).stale()]
+        args.postprocess_workers = 2
+        postprocess(args)
+        assert [] == Pipeline(stages()).stale()
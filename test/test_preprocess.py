@@ -0,0 +1,85 @@
+import collections
+import random
+
+from badcode import preprocess
+from badcode.preprocess import Preprocessor
+from badcode.preprocess import Walk
+from badcode.preprocess import _chunk_path
+from badcode.preprocess import _repo_path
+from badcode.runs import read_last_commit
+from badcode.stats import Stats
+
+from .factories import assert_same_stats
+from .factories import random_stats
+
+def walk(n_commits: int) -> Walk:
+    return Walk('repo1', ['Go'], None, 'c%d' % n_commits,
+        ['c%d' % n for n in range(1, n_commits + 1)])
+
+def test_chunks():
+    w = walk(10)
+    chunks = Preprocessor(bblfshd='', history_chunk_size=4).chunks(w)
+    assert [4, 4, 2] == [len(c.commits) for c in chunks]
+    assert [0, 1, 2] == [c.index for c in chunks]
+    assert w.commits == [commit for c in chunks for commit in c.commits]
+    assert all(c.head == w.head and c.languages == w.languages for c in chunks)
+
+    assert [10] == [len(c.commits) for c in Preprocessor(bblfshd='', history_chunk_size=10).chunks(w)]
+    assert [10] == [len(c.commits) for c in Preprocessor(bblfshd='', history_chunk_size=20).chunks(w)]
+    for size in [0, -1]:
+        chunks = Preprocessor(bblfshd='', history_chunk_size=size).chunks(w)
+        assert [10] == [len(c.commits) for c in chunks]
+
+def test_chunks_approximate_counting():
+    preprocessor = Preprocessor(bblfshd='', history_chunk_size=4,
+        approximate_counting={'epsilon': 0.01, 'delta': 0.01, 'capacity': 10, 'min_count': 2})
+    assert [10] == [len(c.commits) for c in preprocessor.chunks(walk(10))]
+
+def test_finish(tmp_path, monkeypatch):
+    monkeypatch.setattr(preprocess, 'DEFAULT_STATS_DIR', tmp_path)
+    rnd = random.Random(42)
+    w = walk(10)
+    chunks = Preprocessor(bblfshd='', history_chunk_size=4).chunks(w)
+    expected = Stats()
+    _chunk_path('repo1', 'Go', 0).parent.mkdir(parents=True)
+    for chunk in chunks:
+        stats = random_stats(rnd, 'repo1')
+        stats.last_commit['repo1'] = chunk.head
+        stats.save_run(str(_chunk_path('repo1', 'Go', chunk.index)))
+        expected += stats
+
+    Preprocessor(bblfshd='').finish(w, len(chunks))
+    stats_path = _repo_path('repo1', 'Go', 'stats.db')
+    assert_same_stats(expected, Stats.load(str(stats_path)))
+    assert {'repo1': w.head} == read_last_commit(str(stats_path))
+    assert not any(_chunk_path('repo1', 'Go', c.index).exists() for c in chunks)
+
+class FakeClient:
+
+    def __init__(self) -> None:
+        self.calls = 0
+
+    def version(self):
+        self.calls += 1
+        return collections.namedtuple('Version', ['version', 'build'])('v1', 'b1')
+
+def test_uast_cache_per_process(tmp_path):
+    client = FakeClient()
+    preprocessor = Preprocessor(bblfshd='', uast_cache_dir=str(tmp_path / 'a'))
+    cache = preprocessor._get_uast_cache(client)
+    assert cache is not None
+    assert cache is preprocessor._get_uast_cache(client)
+    assert cache is Preprocessor(bblfshd='', uast_cache_dir=str(tmp_path / 'a'))._get_uast_cache(client)
+    assert 1 == client.calls
+    other = Preprocessor(bblfshd='', uast_cache_dir=str(tmp_path / 'b'))._get_uast_cache(client)
+    assert other is not cache
+    assert Preprocessor(bblfshd='')._get_uast_cache(client) is None
+
+def test_discard(tmp_path, monkeypatch):
+    monkeypatch.setattr(preprocess, 'DEFAULT_STATS_DIR', tmp_path)
+    w = walk(10)
+    _chunk_path('repo1', 'Go', 0).parent.mkdir(parents=True)
+    for n in [0, 2]:
+        Stats().save_run(str(_chunk_path('repo1', 'Go', n)))
+    Preprocessor(bblfshd='').discard(w, 3)
+    assert not any(_chunk_path('repo1', 'Go', n).exists() for n in range(3))
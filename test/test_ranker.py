@@ -0,0 +1,53 @@
+import random
+import unittest
+
+from badcode.ranker import Ranker
+from badcode.ranker import StreamingRanker
+from badcode.ranker import TDigest
+
+def test_ranker():
+    scores = {'a': 0.5, 'b': 0.1, 'c': 0.5, 'd': 0.9, 'e': -0.2}
+    r = Ranker(lambda x: scores[x])
+    for e in scores:
+        r.add(e)
+    r.finalize()
+    assert 0.0 == r.get('e')
+    assert 0.2 == r.get('b')
+    assert 0.4 == r.get('a')
+    assert 0.4 == r.get('c')
+    assert 0.8 == r.get('d')
+
+def test_ranker_same_as_scan():
+    rnd = random.Random(42)
+    scores = [rnd.randint(0, 50) / 50.0 for _ in range(1000)]
+    r = Ranker(lambda x: scores[x])
+    for e in range(len(scores)):
+        r.add(e)
+    r.finalize()
+    for e, score in enumerate(scores):
+        below = len([1 for s in scores if s < score])
+        assert float(below) / len(scores) == r.get(e)
+
+def test_streaming_ranker():
+    rnd = random.Random(42)
+    scores = [rnd.gauss(0, 1) for _ in range(20000)]
+    exact = Ranker(lambda x: scores[x])
+    approx = StreamingRanker(lambda x: scores[x])
+    for e in range(len(scores)):
+        exact.add(e)
+        approx.add(e)
+    exact.finalize()
+    approx.finalize()
+    for e in range(0, len(scores), 7):
+        assert abs(exact.get(e) - approx.get(e)) < 0.01
+
+def test_tdigest_rank():
+    d = TDigest(compression=20)
+    assert 0.0 == d.rank(1.0)
+    for v in range(1000):
+        d.add(float(v))
+    assert 1000 == d.count
+    assert 0.0 == d.rank(0.0)
+    assert 1000.0 == d.rank(1000.0)
+    for v in (1.0, 10.0, 250.0, 500.0, 900.0, 999.0):
+        assert abs(d.rank(v) - v) < 1000 * 0.02
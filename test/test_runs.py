@@ -0,0 +1,113 @@
+import os
+import random
+import tempfile
+import unittest
+
+from badcode.bblfshutil import UAST
+from badcode.runs import MAGIC
+from badcode.runs import RunWriter
+from badcode.runs import _HEADER
+from badcode.runs import is_run
+from badcode.runs import merge_runs
+from badcode.runs import read_last_commit
+from badcode.runs import read_run
+from badcode.runs import read_version
+from badcode.runs import stable_hash
+from badcode.stats import Stats
+
+from .factories import assert_same_stats
+from .factories import random_stats
+
+def test_stable_hash():
+    a = UAST(key=('A', 'a'), children=(UAST(key=('B', 'b')),))
+    b = UAST(key=('A', 'a'), children=(UAST(key=('B', 'b')),))
+    c = UAST(key=('A', 'a'), children=(UAST(key=('B', 'c')),))
+    assert stable_hash(a) == stable_hash(b)
+    assert stable_hash(a) != stable_hash(c)
+    assert 0xcf854831e51f7c9d == stable_hash(a)
+
+def test_save_load_run():
+    stats = random_stats(random.Random(1), 'repo1')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'stats.db')
+        stats.save_run(path)
+        assert is_run(path)
+        hashes = [r[0] for r in read_run(path)]
+        assert sorted(hashes) == hashes
+        assert_same_stats(stats, Stats.load(path))
+
+def test_merge_runs():
+    rnd = random.Random(42)
+    repos = ['repo%d' % n for n in range(5)]
+    local_stats = [random_stats(rnd, repo) for repo in repos]
+    expected = Stats()
+    for stats in local_stats:
+        expected += stats
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = []
+        for repo, stats in zip(repos, local_stats):
+            path = os.path.join(tmpdir, repo)
+            stats.save_run(path)
+            paths.append(path)
+        for workers in (1, 3):
+            output = os.path.join(tmpdir, 'merged%d' % workers)
+            merge_runs(paths, output, workers=workers)
+            assert_same_stats(expected, Stats.load(output))
+
+        path = os.path.join(tmpdir, 'merged_again')
+        merge_runs([os.path.join(tmpdir, 'merged1'), paths[0]], path)
+        expected += local_stats[0]
+        assert_same_stats(expected, Stats.load(path))
+
+def test_last_commit():
+    rnd = random.Random(7)
+    a = random_stats(rnd, 'repo1')
+    a.last_commit['repo1'] = 'aaaa'
+    b = random_stats(rnd, 'repo1')
+    b.last_commit['repo1'] = 'bbbb'
+    c = random_stats(rnd, 'repo2')
+    c.last_commit['repo2'] = 'cccc'
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = []
+        for n, stats in enumerate((a, b, c)):
+            path = os.path.join(tmpdir, 'run%d' % n)
+            stats.save_run(path)
+            paths.append(path)
+        assert {'repo1': 'aaaa'} == read_last_commit(paths[0])
+        assert {'repo1': 'aaaa'} == Stats.load(paths[0]).last_commit
+
+        output = os.path.join(tmpdir, 'merged')
+        merge_runs(paths, output)
+        assert {'repo1': 'bbbb', 'repo2': 'cccc'} == read_last_commit(output)
+
+        expected = Stats()
+        for stats in (a, b, c):
+            expected += stats
+        assert expected.last_commit == read_last_commit(output)
+        assert_same_stats(expected, Stats.load(output))
+
+def test_upgrade_run():
+    stats = random_stats(random.Random(3), 'repo1')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'old')
+        # a version 2 run, keyed by another hash
+        writer = RunWriter(path, ['repo1'], {'repo1': 'aaaa'})
+        writer._f.seek(0)
+        writer._f.write(_HEADER.pack(MAGIC, 2))
+        writer._f.seek(0, os.SEEK_END)
+        for n, uast in enumerate(stats.totals):
+            writer.write((n, (n, n), uast, stats.text[uast], stats.totals[uast],
+                {'repo1': (n, stats.per_repo['repo1'][uast])}))
+        writer.close()
+        assert 2 == read_version(path)
+
+        output = os.path.join(tmpdir, 'merged')
+        merge_runs([path], output)
+        assert 3 == read_version(path)
+        hashes = [r[0] for r in read_run(output)]
+        assert [stable_hash(r[2]) for r in read_run(output)] == hashes
+        assert sorted(hashes) == hashes
+        assert_same_stats(stats, Stats.load(output))
+        assert {'repo1': 'aaaa'} == read_last_commit(output)
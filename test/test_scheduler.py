@@ -0,0 +1,58 @@
+import os
+import time
+
+from badcode.scheduler import Job
+from badcode.scheduler import Scheduler
+
+
+def identity(x):
+    return x
+
+def fail_on(x, bad):
+    if x == bad:
+        raise ValueError('bad job: %s' % x)
+    return x
+
+def crash_on(x, bad):
+    if x == bad:
+        os._exit(1)
+    return x
+
+def crash_on_slow(x, bad):
+    if x == bad:
+        os._exit(1)
+    time.sleep(0.5)
+    return x
+
+def test_run_largest_first():
+    jobs = [Job('job%d' % i, 'g%d' % (i % 2), cost, (i,))
+        for i, cost in enumerate([3, 10, 1, 5])]
+    scheduler = Scheduler(identity, workers=1)
+    results = scheduler.run(jobs)
+    assert list(results.keys()) == ['job1', 'job3', 'job0', 'job2']
+    assert results == {'job0': 0, 'job1': 1, 'job2': 2, 'job3': 3}
+    assert scheduler.failed == []
+    assert scheduler.throughput['g0'][0] == 4
+    assert scheduler.throughput['g1'][0] == 15
+
+def test_run_failed():
+    jobs = [Job('job%d' % i, 'g', 1, (i, 2)) for i in range(4)]
+    scheduler = Scheduler(fail_on, workers=2, retries=1)
+    results = scheduler.run(jobs)
+    assert results == {'job0': 0, 'job1': 1, 'job3': 3}
+    assert scheduler.failed == [jobs[2]]
+
+def test_run_crashed():
+    jobs = [Job('job%d' % i, 'g', 1, (i, 1)) for i in range(4)]
+    scheduler = Scheduler(crash_on, workers=2, retries=2)
+    results = scheduler.run(jobs)
+    assert results == {'job0': 0, 'job2': 2, 'job3': 3}
+    assert scheduler.failed == [jobs[1]]
+
+def test_run_crashed_no_retries():
+    # jobs next to a crashing job are not charged for it
+    jobs = [Job('job%d' % i, 'g', 1, (i, 1)) for i in range(4)]
+    scheduler = Scheduler(crash_on_slow, workers=4, retries=0)
+    results = scheduler.run(jobs)
+    assert results == {'job0': 0, 'job2': 2, 'job3': 3}
+    assert scheduler.failed == [jobs[1]]
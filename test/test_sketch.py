@@ -0,0 +1,52 @@
+import collections
+import random
+import unittest
+
+from badcode.sketch import CountMinSketch
+from badcode.sketch import SpaceSaving
+
+def zipf_stream(rnd: random.Random, n_keys: int, n: int):
+    weights = [1.0 / (k + 1) for k in range(n_keys)]
+    return rnd.choices(range(n_keys), weights=weights, k=n)
+
+def test_count_min_sketch():
+    stream = zipf_stream(random.Random(42), 5000, 20000)
+    sketch = CountMinSketch(epsilon=0.001, delta=0.01)
+    assert 2719 == sketch.width
+    assert 5 == sketch.depth
+    for key in stream:
+        sketch.add(key)
+    exact = collections.Counter(stream)
+    bound = sketch.epsilon * len(stream)
+    errors = [sketch.estimate(k) - exact[k] for k in range(5000)]
+    assert min(errors) >= 0
+    assert sum(1 for e in errors if e > bound) <= 0.01 * len(errors)
+
+def test_space_saving():
+    stream = zipf_stream(random.Random(42), 5000, 20000)
+    summary = SpaceSaving(capacity=100)
+    for key in stream:
+        summary.add(key)
+    assert 100 == len(summary)
+    exact = collections.Counter(stream)
+    for key, count in summary.counts.items():
+        assert count >= exact[key]
+        assert summary.lower_bound(key) <= exact[key]
+    for key, count in exact.items():
+        if count > len(stream) / 100:
+            assert key in summary
+
+    summary.remove(0)
+    assert 0 not in summary
+    assert summary.floor + 1 == summary.add(0)
+
+def test_space_saving_remove():
+    summary = SpaceSaving(capacity=2)
+    summary.add('a')
+    summary.add('a')
+    summary.add('b')
+    assert 2 == summary.add('c')
+    assert 'b' not in summary
+    summary.remove('a')
+    # b may have been seen before, so it still inherits the evicted count
+    assert 2 == summary.add('b')
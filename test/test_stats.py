@@ -2,7 +2,9 @@
 import unittest
 
 from bblfsh import Node
-from badcode.bblfshutil import UAST
+from badcode.bblfshutil import UAST, WILDCARD
+from badcode.stats import ApproximateStats
+from badcode.stats import Match
 from badcode.stats import Stats
 
 def test_stats_iadd():
@@ -20,4 +22,72 @@ def test_stats_iadd():
     s3 += s1
     s3 += s2
 
-    assert {'added': 1, 'deleted': 1} == s3.totals[a]
\ No newline at end of file
+    assert {'added': 1, 'deleted': 1} == s3.totals[a]
+
+def test_stats_match():
+    a = UAST(key=('A', 'A'), children=(UAST(key=('B', 'B')),))
+    b = UAST(key=('A', 'A'), children=(UAST(key=('B', WILDCARD)),))
+    c = UAST(key=('A', 'A'), children=(UAST(key=('B', 'C')),))
+
+    s = Stats()
+    s.added('repo1', a, 'a')
+    assert (a, 'a') == s.match(a)
+    assert s.match(c) is None
+
+    s.deleted('repo1', b, 'b')
+    assert (b, 'b') == s.match(c)
+
+def test_stats_match_many():
+    a = UAST(key=('A', 'A'), children=(UAST(key=('B', 'B')),))
+    b = UAST(key=('A', 'A'), children=(UAST(key=('B', WILDCARD)),))
+    c = UAST(key=('A', 'A'), children=(UAST(key=('B', 'C')),))
+    d = UAST(key=('D', 'D'))
+
+    s = Stats()
+    s.added('repo1', a, 'a')
+    s.deleted('repo1', b, 'b')
+    assert [[Match(a, 'a', 0.0), Match(b, 'b', 0.0)], [Match(b, 'b', 0.0)], []] == s.match_many([a, c, d])
+
+    s.totals[a]['score'] = 0.5
+    s.totals[b]['score'] = 0.9
+    found = s.match_many([a, c, a])
+    assert [Match(b, 'b', 0.9), Match(a, 'a', 0.5)] == found[0]
+    assert [Match(b, 'b', 0.9)] == found[1]
+    assert found[0] is found[2]
+    assert [] == s.match_many([])
+
+def test_approximate_stats():
+    a = UAST(key=('A', 'A'))
+    b = UAST(key=('B', 'B'))
+
+    s = ApproximateStats(epsilon=0.01, delta=0.01, capacity=10, min_count=2)
+    s.added('repo1', a, 'a')
+    s.deleted('repo1', b, 'b')
+    assert {} == s.totals
+    assert {} == s.text
+
+    s.deleted('repo1', a, 'a')
+    assert {'added': 1, 'deleted': 1} == s.totals[a]
+    assert {'added': 1, 'deleted': 1} == s.per_repo['repo1'][a]
+    assert 'a' == s.text[a]
+    assert b not in s.totals
+
+    s.added('repo1', a, 'a')
+    assert {'added': 2, 'deleted': 1} == s.totals[a]
+    assert (a, 'a') == s.match(a)
+
+    stats = s.to_stats()
+    assert type(stats) is Stats
+    assert [a] == list(stats.totals)
+
+def test_approximate_stats_singletons():
+    s = ApproximateStats(epsilon=0.01, delta=0.01, capacity=10, min_count=2)
+    a = UAST(key=('A', 'A'))
+    for n in range(1000):
+        s.added('repo1', UAST(key=('B', str(n))), 'b')
+        if n % 100 == 0:
+            s.added('repo1', a, 'a')
+            s.added('repo1', a, 'a')
+    assert 0 == sum(1 for u in s.totals if u != a)
+    assert a in s.totals
+    assert 10 == len(s.candidates)
@@ -0,0 +1,115 @@
+import os
+import random
+import tempfile
+import unittest
+
+from badcode.bblfshutil import UAST
+from badcode.postprocess import compute_ranking
+from badcode.postprocess import merge_same_text
+from badcode.postprocess import merge_similar
+from badcode.postprocess import prune
+from badcode.stats import SqliteStats
+from badcode.stats import Stats
+from badcode.stats import is_sqlite
+
+def fill(stats: Stats, rnd: random.Random) -> Stats:
+    for _ in range(300):
+        repo = rnd.choice(['repo1', 'repo2', 'repo3'])
+        uast = UAST(key=('A', rnd.choice('abcdefgh')), children=(
+            UAST(key=(rnd.choice('BCD'), rnd.choice('xyz'))),
+        ))
+        text = 'text %s' % uast
+        if rnd.random() < 0.5:
+            stats.added(repo, uast, text)
+        else:
+            stats.deleted(repo, uast, text)
+    stats.last_commit['repo1'] = 'abc'
+    return stats
+
+def nonzero(counts):
+    # reading a missing count adds a zero to in-memory stats
+    return dict((k, v) for k, v in counts.items() if v != 0)
+
+def as_dicts(stats: Stats):
+    return (
+        dict((u, nonzero(c)) for u, c in stats.totals.items()),
+        dict((r, dict((u, nonzero(c)) for u, c in d.items())) for r, d in stats.per_repo.items()),
+        dict(stats.text.items()),
+        dict(stats.last_commit))
+
+def test_sqlite_stats():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'stats.sqlite')
+        expected = fill(Stats(), random.Random(1))
+        stats = fill(SqliteStats(path, cache_size=4, batch_size=3), random.Random(1))
+        assert as_dicts(expected) == as_dicts(stats)
+        assert len(expected.totals) == len(stats.totals)
+        assert set(expected.per_repo) == set(stats.per_repo)
+        stats.close()
+
+        assert is_sqlite(path)
+        stats = Stats.load(path)
+        assert isinstance(stats, SqliteStats)
+        assert as_dicts(expected) == as_dicts(stats)
+
+        other = fill(Stats(), random.Random(2))
+        expected += other
+        stats += other
+        assert as_dicts(expected) == as_dicts(stats)
+
+        saved = os.path.join(tmpdir, 'saved.sqlite')
+        stats.save(saved)
+        stats.close()
+        assert as_dicts(expected) == as_dicts(Stats.load(saved))
+
+def as_lists(stats: Stats):
+    return (
+        [(u, nonzero(c)) for u, c in stats.totals.items()],
+        [(r, [(u, nonzero(c)) for u, c in d.items()]) for r, d in stats.per_repo.items()],
+        list(stats.text.items()))
+
+def fill_same_text(stats: Stats, rnd: random.Random) -> Stats:
+    # patterns of the same size share texts, so merge_same_text keeps the
+    # first one of each text in iteration order
+    for _ in range(300):
+        repo = rnd.choice(['repo1', 'repo2', 'repo3'])
+        child = UAST(key=(rnd.choice('BCD'), rnd.choice('xyz')))
+        uast = UAST(key=('A', rnd.choice('abcdefgh')), children=(child,))
+        text = 'text %s' % (child.key,)
+        if rnd.random() < 0.5:
+            stats.added(repo, uast, text)
+        else:
+            stats.deleted(repo, uast, text)
+    return stats
+
+def test_sqlite_stats_order():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'stats.sqlite')
+        expected = fill(Stats(), random.Random(1))
+        stats = fill(SqliteStats(path, cache_size=4, batch_size=3), random.Random(1))
+        assert as_lists(expected) == as_lists(stats)
+        uast = next(iter(expected.totals))
+        for s in (expected, stats):
+            counts = s.totals[uast]
+            del s.totals[uast]
+            s.totals[uast] = counts
+        assert as_lists(expected) == as_lists(stats)
+
+def test_sqlite_stats_postprocess():
+    for fill_stats in (fill, fill_same_text):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            run_path = os.path.join(tmpdir, 'stats.db')
+            expected = fill_stats(Stats(), random.Random(1))
+            expected.save_run(run_path)
+            expected = Stats.load(run_path)
+            stats = SqliteStats.create(os.path.join(tmpdir, 'stats.sqlite'), run_path,
+                cache_size=4, batch_size=3)
+            assert as_lists(expected) == as_lists(stats)
+
+            for s in (expected, stats):
+                merge_same_text(s)
+                merge_similar(s)
+                compute_ranking(s)
+                prune(s, min_score=0.5)
+            assert len(stats.totals) > 0
+            assert as_lists(expected) == as_lists(stats)
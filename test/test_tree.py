@@ -1,4 +1,7 @@
 
+import os
+import subprocess
+import sys
 import unittest
 
 from badcode.tree import Tree
@@ -57,8 +60,42 @@ def test_state():
     ])
 
     state = t.__getstate__()
-    assert list(state.keys()) == ['key', 'children']
+    assert list(state.keys()) == ['key', 'children', 'fingerprint']
 
     t2 = Tree(key=0)
     t2.__setstate__(state)
-    assert t == t2
\ No newline at end of file
+    assert t == t2
+    assert t.fingerprint == t2._fingerprint
+
+def test_fingerprint():
+    a = Tree(key=('A', 'a'), children=[Tree(key=('B', 'b')), Tree(key=('C', 'c'))])
+    b = Tree(key=('A', 'a'), children=[Tree(key=('C', 'c')), Tree(key=('B', 'b'))])
+    c = Tree(key=('A', 'a'), children=[Tree(key=('B', 'b'), children=[Tree(key=('C', 'c'))])])
+    assert a.fingerprint != b.fingerprint
+    assert a.fingerprint != c.fingerprint
+    assert a.children[0].fingerprint == c.children[0].with_children([]).fingerprint
+    assert Tree(key=('Ab', '')).fingerprint != Tree(key=('A', 'b')).fingerprint
+
+    # the same in every process, regardless of string hash randomization
+    code = ('from badcode.tree import Tree; '
+        'print(Tree(key=("A", "a"), children=[Tree(key=("B", "b"))]).fingerprint)')
+    fingerprints = set()
+    for seed in ['1', '2']:
+        env = dict(os.environ, PYTHONHASHSEED=seed)
+        fingerprints.add(int(subprocess.check_output([sys.executable, '-c', code], env=env)))
+    assert 1 == len(fingerprints)
+
+def test_replace_key():
+    t = Tree(key=1, children=[
+        Tree(key=2),
+        Tree(key=3)
+    ])
+    t2 = t.replace_key(1, 4)
+    assert t2 == Tree(key=1, children=[
+        Tree(key=2),
+        Tree(key=4)
+    ])
+    assert t == Tree(key=1, children=[
+        Tree(key=2),
+        Tree(key=3)
+    ])